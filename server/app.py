@@ -1,30 +1,40 @@
 import click
+import importlib.util
 import logging
 import os
 import warnings
-import io
 import queue
-import sys
 from pathlib import Path
-import json
+import subprocess
+import sys
 import threading
 import time
-import re
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from typing import List, Tuple
 
 from server.lib.entities import Model, Provider
 from server.lib.inference import ProviderDetails, InferenceManager, InferenceRequest
+from server.lib.inference.connections import ConnectionPool
+from server.lib.inference.engine import InferenceEngine
+from server.lib.inference.rate_limits import RateLimits
+from server.lib.inference.retries import RetryPolicy
+from server.lib.inference.completion_cache import CompletionCache, CACHE_MODES, OFF
+from server.lib.inference.single_flight import SingleFlight
+from server.lib.inference.huggingface.model_cache import ModelCache
+from server.lib.inference.huggingface.prefix_cache import PrefixCache
 from server.lib.event_emitter import EventEmitter, EVENTS
-from server.lib.storage import Storage
-from server.lib.sseserver import SSEQueueWithTopic
+from server.lib.storage import APP_DIR, Storage
+from server.lib.sseserver import Event, SSEQueueWithTopic, COALESCE, OVERFLOW_POLICIES
 from server.lib.api import api_bp
 
 from flask import Flask, g, send_from_directory
 from flask_cors import CORS
 
-from transformers import AutoTokenizer, AutoModel
-from huggingface_hub import hf_hub_download, try_to_load_from_cache, scan_cache_dir, _CACHED_NO_EXIST
+from huggingface_hub import HfApi, file_download, hf_hub_download, try_to_load_from_cache, scan_cache_dir, _CACHED_NO_EXIST
+from huggingface_hub.utils import tqdm as hf_tqdm
 
 # Monkey patching for warnings, for convenience
 def warning_on_one_line(message, category, filename, lineno, file=None, line=None):
@@ -35,6 +45,9 @@ warnings.formatwarning = warning_on_one_line
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# weight formats the local models are never loaded from
+SKIPPED_WEIGHT_EXTENSIONS = (".h5", ".msgpack", ".ot", ".onnx", ".onnx_data", ".tflite", ".ckpt")
+
 app = Flask(__name__)
 
 @app.route('/', defaults={'path': ''})
@@ -59,131 +72,200 @@ app.register_blueprint(api_bp)
 
 CORS(app)
 
-class RedirectStderr:
-    def __init__(self, new_stderr):
-        self.new_stderr = new_stderr
-        self.old_stderr = None
-
-    def __enter__(self):
-        self.old_stderr = sys.stderr
-        sys.stderr = self.new_stderr
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stderr = self.old_stderr
-
-@contextmanager
-def redirect_stderr(new_stderr):
-    with RedirectStderr(new_stderr):
-        yield
-
-class MonitorThread(threading.Thread):
-    def __init__(self, model, output_buffer):
-        super().__init__()
-        self.model = model
-        self.output_buffer = output_buffer
-        self._stop_event = threading.Event()
+class DownloadProgressBar(hf_tqdm):
+    '''
+    Stands in for the progress bars huggingface_hub creates while a DownloadProgressTracker download runs
+    Bars of a tracked model print nothing and push each update to the tracker instead,
+    downloads of other threads, like from_pretrained in the model loaders, keep the stock progress bar
+    '''
+    tracker = None
+
+    def __init__(self, *args, **kwargs):
+        self.tracked = self.tracker is not None and self.tracker.is_tracking()
+        if self.tracked:
+            kwargs["disable"] = True
+        super().__init__(*args, **kwargs)
+        self.downloaded = self.reported = self.n
+        if self.tracked:
+            self.tracker.on_start(self)
+
+    def update(self, n=1):
+        self.downloaded += n
+        if self.tracked:
+            self.tracker.on_update(self)
+        return super().update(n)
+
+    def close(self):
+        if self.tracked:
+            self.tracker.on_close(self)
+        super().close()
+
+class DownloadProgressTracker:
+    '''
+    Turns huggingface_hub file download progress into MODEL_DOWNLOAD_UPDATE events, at most one per interval and model
+    The model a download belongs to is the one tracked by the downloading thread
+    '''
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
         self.event_emitter = EventEmitter()
-
-    def run(self):
-        with redirect_stderr(self.output_buffer):
-            # Code that may generate errors goes here
-            output_buffer = self.output_buffer
-            current_shard = 0
-            total_shards = 0
-            last_line = 0
-   
-            while not self._stop_event.is_set():
-                try:
-                    lines = output_buffer.getvalue().splitlines()[last_line:]
-                    last_line += len(lines)
-
-                    for line in lines:
-                        if line == "":
-                            continue
-
-                        if line.startswith("Downloading shards:"):
-                            if progress := re.search(r"\| (\d+)/(\d+) \[", line):
-                                current_shard, total_shards = int(progress[1]), int(progress[2])
-                        elif line.startswith("Downloading"):
-                            logger.info(line)
-                            percentage = re.search(r":\s+(\d+)%", line)
-                            percentage = percentage[0][2:] if percentage else ""
-
-                            progress = re.search(r"\[(.*?)\]", line)
-                            if progress and "?" not in progress[0]:
-                                current_duration, rest = progress[0][1:-1].split("<")
-                                total_duration, speed = rest.split(",")
-
-                                if download_size := re.search(r"\| (.*?)\[", line):
-                                    current_size, total_size = download_size[0][2:-1].strip().split("/")
-
-                                self.event_emitter.emit(EVENTS.MODEL_DOWNLOAD_UPDATE, self.model, {
-                                    'current_shard': current_shard,
-                                    'total_shards': total_shards,
-                                    'percentage': percentage.strip(),
-                                    'current_duration': current_duration,
-                                    'total_duration': total_duration,
-                                    'speed': speed.strip(),
-                                    'current_size': current_size,
-                                    'total_size': total_size,
-                                })
-                except Exception as e:
-                    logger.info(f"""[ERROR] {str(e)}""")
-                time.sleep(0.5)
-
-    def stop(self):
-        self._stop_event.set()
+        self.local = threading.local()
+        self.progress = {}
+        self.original_tqdm = None
+        self._lock = threading.Lock()
+
+        DownloadProgressBar.tracker = self
+
+    @contextmanager
+    def download(self, model: Model, total_shards: int = 0, total_size: int = 0):
+        '''
+        Tracks the download of model as a whole, its files may be fetched by several threads
+        huggingface_hub 0.13 takes no progress bar class per file download, so its module-level one is swapped
+        while any model is downloading and restored after the last one
+        '''
+        with self._lock:
+            if not self.progress:
+                self.original_tqdm = file_download.tqdm
+                file_download.tqdm = DownloadProgressBar
+            self.progress[model.name] = {
+                'model': model, 'current_shard': 0, 'total_shards': total_shards,
+                'downloaded': 0, 'total': total_size, 'sized': total_size > 0,
+                'started': time.monotonic(), 'last_emit': 0,
+            }
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.progress.pop(model.name, None)
+                if not self.progress:
+                    file_download.tqdm = self.original_tqdm
+
+    @contextmanager
+    def track(self, model: Model):
+        '''
+        Attributes the downloads made by the current thread to model
+        '''
+        self.local.model = model
+        try:
+            yield
+        finally:
+            self.local.model = None
+
+    def skip(self, model: Model, size: int):
+        '''
+        Accounts for a file of model that is already in the cache
+        '''
+        with self._lock:
+            if (progress := self.progress.get(model.name)) is not None:
+                progress['current_shard'] += 1
+                progress['downloaded'] += size
+
+    def is_tracking(self) -> bool:
+        '''
+        Whether the current thread downloads files of a tracked model
+        '''
+        with self._lock:
+            return self.__get_progress__() is not None
+
+    def __get_progress__(self):
+        model = getattr(self.local, 'model', None)
+        return self.progress.get(model.name) if model is not None else None
+
+    def on_start(self, bar: DownloadProgressBar):
+        with self._lock:
+            if (progress := self.__get_progress__()) is None:
+                return
+            progress['current_shard'] += 1
+            progress['total_shards'] = max(progress['total_shards'], progress['current_shard'])
+            progress['downloaded'] += bar.downloaded
+            if not progress['sized']:
+                progress['total'] += bar.total or 0
+
+    def on_update(self, bar: DownloadProgressBar, force: bool = False):
+        with self._lock:
+            if (progress := self.__get_progress__()) is None:
+                return
+            progress['downloaded'] += bar.downloaded - bar.reported
+            bar.reported = bar.downloaded
+
+            now = time.monotonic()
+            if not force and now - progress['last_emit'] < self.interval:
+                return
+            progress['last_emit'] = now
+            model, update = progress['model'], self.__format_progress__(progress, now)
+
+        logger.info(f"Downloading {model.name}: {update['percentage']}% ({update['current_size']}/{update['total_size']})")
+        self.event_emitter.emit(EVENTS.MODEL_DOWNLOAD_UPDATE, model, update)
+
+    def on_close(self, bar: DownloadProgressBar):
+        self.on_update(bar, force=True)
+
+    def __format_progress__(self, progress: dict, now: float) -> dict:
+        elapsed = now - progress['started']
+        downloaded, total = progress['downloaded'], progress['total']
+        speed = downloaded / elapsed if elapsed > 0 else 0
+        remaining = (total - downloaded) / speed if speed > 0 and total else 0
+
+        return {
+            'current_shard': progress['current_shard'],
+            'total_shards': progress['total_shards'],
+            'percentage': str(int(downloaded * 100 / total)) if total else "",
+            'current_duration': hf_tqdm.format_interval(elapsed),
+            'total_duration': hf_tqdm.format_interval(remaining),
+            'speed': f"{hf_tqdm.format_sizeof(speed)}B/s",
+            'current_size': hf_tqdm.format_sizeof(downloaded),
+            'total_size': hf_tqdm.format_sizeof(total),
+        }
 
 class NotificationManager:
     def __init__(self, sse_queue: SSEQueueWithTopic):
         self.event_emitter = EventEmitter()
         self.event_emitter.on(EVENTS.MODEL_UPDATED, self.__model_updated_callback__)
         self.event_emitter.on(EVENTS.MODEL_ADDED, self.__model_added_callback__)
-        #TODO Fix the bug where SSE gets blocked
-        #self.event_emitter.on(EVENTS.MODEL_DOWNLOAD_UPDATE, self.__model_download_update_callback__)
+        self.event_emitter.on(EVENTS.MODEL_DOWNLOAD_UPDATE, self.__model_download_update_callback__)
         self.sse_queue = sse_queue
 
     def __model_added_callback__(self, model_name, model):
         if model.status == 'ready':
-            self.sse_queue.publish(json.dumps({
-                'type': 'notification',
-                'data': {
-                    'message': {
-                        'event': 'modelAdded',
-                        'data': {
-                            'model': model.name,
-                            'provider': model.provider
-                        }
+            self.sse_queue.publish(Event('notification', {
+                'message': {
+                    'event': 'modelAdded',
+                    'data': {
+                        'model': model.name,
+                        'provider': model.provider
                     }
                 }
             }))
 
     def __model_updated_callback__(self, model_name, model):
         if model.status == 'ready':
-            self.sse_queue.publish(json.dumps({
-                'type': 'notification',
-                'data': {
-                    'message': {
-                        'event': 'modelAdded' if model.enabled == True else 'modelRemoved',
-                        'data': {
-                            'model': model.name,
-                            'provider': model.provider
-                        }
+            self.sse_queue.publish(Event('notification', {
+                'message': {
+                    'event': 'modelAdded' if model.enabled == True else 'modelRemoved',
+                    'data': {
+                        'model': model.name,
+                        'provider': model.provider
                     }
                 }
             }))
 
+    @staticmethod
+    def merge(last: Event, message: Event):
+        '''
+        A newer download progress notification for the same model replaces a buffered one
+        '''
+        last_message, new_message = last.data['message'], message.data['message']
+        if last_message['event'] == new_message['event'] == 'modelDownloadProgress' and last_message['data']['model'] == new_message['data']['model']:
+            return message
+        return None
+
     def __model_download_update_callback__(self, _, model, progress):
-        self.sse_queue.publish(json.dumps({
-            'type': 'notification',
-            'data': {
-                'message': {
-                    'event': 'modelDownloadProgress',
-                    'data': {
-                        'model': model.name,
-                        'provider': model.provider,
-                        'progress': progress
-                    }
+        self.sse_queue.publish(Event('notification', {
+            'message': {
+                'event': 'modelDownloadProgress',
+                'data': {
+                    'model': model.name,
+                    'provider': model.provider,
+                    'progress': progress
                 }
             }
         }))
@@ -191,13 +273,23 @@ class NotificationManager:
 ### Perhaps this should be a singleton or each provider should have its own instance
 ### For now this will only deal with HuggingFace
 class DownloadManager:
-    def __init__(self, storage: Storage):
+    '''
+    Downloads the files of pending local models from the HuggingFace hub into the cache
+    Several models download at once, and the files (shards) of a model are fetched in parallel
+    Partially downloaded files are resumed, so pending models pick up where they left off after a restart
+    '''
+    def __init__(self, storage: Storage, max_workers: int = 2, max_shard_workers: int = 4):
         logger.info("Initializing download manager...")
 
         self.event_emitter = EventEmitter()
         self.event_emitter.on(EVENTS.MODEL_ADDED, self.__model_added_callback__)
         self.storage = storage
         self.model_queue = queue.Queue()
+        self.queued = set()
+        self._lock = threading.Lock()
+        self.max_workers = max_workers
+        self.shard_executor = ThreadPoolExecutor(max_workers=max_shard_workers, thread_name_prefix="model-download")
+        self.progress_tracker = DownloadProgressTracker()
         self.__initialization_check__()
 
     def __initialization_check__(self):
@@ -205,7 +297,7 @@ class DownloadManager:
 
         for model in models:
             if model.status == 'pending':
-                self.model_queue.put(model)
+                self.__enqueue__(model)
 
         # TODO: In the future it might make sense to have local provider specific instances
         cache_info = scan_cache_dir()
@@ -228,59 +320,120 @@ class DownloadManager:
                     )
                     hugging_face_local.add_model(model)
 
-        t = threading.Thread(target=self.__download_loop__)
-        t.start()
+        for _ in range(self.max_workers):
+            t = threading.Thread(target=self.__download_loop__, daemon=True)
+            t.start()
 
         logger.info("Download loop started...")
 
     def __model_added_callback__(self, model_name, model):
         if model.status == 'pending':
-            self.model_queue.put(model)
+            self.__enqueue__(model)
+
+    def __enqueue__(self, model: Model):
+        with self._lock:
+            if model.name in self.queued:
+                return
+            self.queued.add(model.name)
+        self.model_queue.put(model)
      
     def __download_loop__(self):
         while True:
+            model = self.model_queue.get()
             try:
-                output_buffer = io.StringIO()
-                with redirect_stderr(output_buffer):
-                    model = self.model_queue.get(block=False)
+                logger.info(f"Inside loop, about to download model {model.name}")
 
-                    monitor_thread =  MonitorThread(model, output_buffer)
-                    monitor_thread.start()
+                self.__download_model__(model)
 
-                    logger.info("Inside loop, about to download model", model.name)
+                model.status = 'ready'
 
-                    _ = AutoTokenizer.from_pretrained(model.name)
-                    _ = AutoModel.from_pretrained(model.name)
+                self.storage.update_model(model.name, model)
 
-                    model.status = 'ready'
-
-                    self.storage.update_model(model.name, model)
-
-                    monitor_thread.stop()
-                    monitor_thread.join()
-                    
-                    logger.info("Finished downloading model", model.name)
-            except queue.Empty:
-                time.sleep(1)
+                logger.info(f"Finished downloading model {model.name}")
             except Exception as e:
-                logger.error("error", e)
-                logger.error(f"Failed to download {model.name} from {model.provider}")
+                logger.error(f"Failed to download {model.name} from {model.provider}: {e}")
             finally:
-                time.sleep(1)
+                with self._lock:
+                    self.queued.discard(model.name)
+
+    def __download_model__(self, model: Model):
+        files = self.__select_files__(model.name)
+        total_size = sum(size for _, size in files)
+
+        with self.progress_tracker.download(model, total_shards=len(files), total_size=total_size):
+            futures = [
+                self.shard_executor.submit(self.__download_file__, model, filename, size)
+                for filename, size in files
+            ]
+            for future in futures:
+                future.result()
+
+    def __download_file__(self, model: Model, filename: str, size: int):
+        if isinstance(try_to_load_from_cache(model.name, filename), str):
+            self.progress_tracker.skip(model, size)
+            return
+
+        with self.progress_tracker.track(model):
+            hf_hub_download(model.name, filename, resume_download=True)
+
+    def __select_files__(self, repo_id: str) -> List[Tuple[str, int]]:
+        '''
+        Lists the files of a model repository, leaving out weights in formats the model is not loaded from
+        '''
+        model_info = HfApi().model_info(repo_id, files_metadata=True)
+        files = [(sibling.rfilename, sibling.size or 0) for sibling in model_info.siblings]
+
+        # transformers.utils.is_safetensors_available, without importing transformers
+        use_safetensors = importlib.util.find_spec("safetensors") is not None and any(filename.endswith(".safetensors") for filename, _ in files)
+        skipped_extensions = SKIPPED_WEIGHT_EXTENSIONS + ((".bin",) if use_safetensors else (".safetensors",))
+
+        return [(filename, size) for filename, size in files if not filename.endswith(skipped_extensions)]
 
 class GlobalStateManager:
-    def __init__(self, storage):
-        self.sse_manager = SSEQueueWithTopic()
-        self.sse_manager.add_topic("inferences")
-        self.sse_manager.add_topic("notifications")
+    def __init__(
+        self, storage, local_model_memory=None, http_pool_size=32, http_timeout=60,
+        max_remote_workers=32, max_local_workers=8, max_batch_size=8, prefix_cache_memory=512,
+        download_workers=2, download_shard_workers=4, sse_buffer_size=256, sse_overflow_policy="block", rate_limits=None,
+        max_retries=2, retry_backoff=0.5, hedge_requests=False,
+        completion_cache=OFF, completion_cache_size=1024, completion_cache_disk=256, cache_replay_speed=0, dedupe_requests=True
+    ):
+        self.sse_manager = SSEQueueWithTopic(maxsize=sse_buffer_size, policy=sse_overflow_policy)
+        self.sse_manager.add_topic("notifications", policy=COALESCE, merge=NotificationManager.merge)
 
         self.notification_manager = NotificationManager(self.sse_manager.get_topic("notifications"))
 
+        self.connection_pool = ConnectionPool(pool_maxsize=http_pool_size, timeout=http_timeout)
         self.inference_manager = InferenceManager(
-            self.sse_manager.get_topic("inferences")
+            self.sse_manager,
+            model_cache=ModelCache(
+                memory_budget_mb=local_model_memory,
+                max_batch_size=max_batch_size,
+                prefix_cache=PrefixCache(memory_budget_mb=prefix_cache_memory) if prefix_cache_memory > 0 else None
+            ),
+            connection_pool=self.connection_pool,
+            rate_limits=RateLimits(rate_limits),
+            retry_policy=RetryPolicy(max_retries=max_retries, base_delay=retry_backoff),
+            hedge_requests=hedge_requests,
+            completion_cache=CompletionCache(
+                mode=completion_cache,
+                max_entries=completion_cache_size,
+                disk_dir=os.path.join(APP_DIR, 'completion-cache') if completion_cache_disk > 0 else None,
+                disk_budget_mb=completion_cache_disk,
+                replay_speed=cache_replay_speed
+            ) if completion_cache != OFF else None,
+            single_flight=SingleFlight() if dedupe_requests else None
+        )
+        self.inference_engine = InferenceEngine(
+            self.text_generation,
+            self.inference_manager.get_announcer(),
+            providers=self.inference_manager.get_providers(),
+            max_remote_workers=max_remote_workers,
+            max_local_workers=max_local_workers
         )
         self.storage = storage
-        self.download_manager = DownloadManager(storage)
+        self.download_manager = DownloadManager(
+            storage, max_workers=download_workers, max_shard_workers=download_shard_workers
+        )
 
     def get_storage(self):
         return self.storage
@@ -288,37 +441,79 @@ class GlobalStateManager:
     def get_sse_manager(self):
         return self.sse_manager
 
+    def get_connection_pool(self):
+        return self.connection_pool
+
+    def get_inference_engine(self):
+        return self.inference_engine
+
     def text_generation(self, inference_request: InferenceRequest):
         provider = self.storage.get_provider(inference_request.model_provider)
 
+        model = self.storage.get_provider_model(inference_request.model_provider, inference_request.model_name)
+
         provider_details = ProviderDetails(
             api_key=provider.api_key ,
-            version_key=None
+            version_key=None,
+            load_mode=model.load_mode if model is not None else None
         )
         logger.info(f"Received inference request {inference_request.model_provider}")
 
-        if inference_request.model_provider == "openai":
-            return self.inference_manager.openai_text_generation(provider_details, inference_request)
-        elif inference_request.model_provider == "cohere":
-            return self.inference_manager.cohere_text_generation(provider_details, inference_request)
-        elif inference_request.model_provider == "huggingface":
-            return self.inference_manager.huggingface_text_generation(provider_details, inference_request)
-        elif inference_request.model_provider == "forefront":
-            return self.inference_manager.forefront_text_generation(provider_details, inference_request)
-        elif inference_request.model_provider == "huggingface-local":
-            return self.inference_manager.local_text_generation(provider_details, inference_request)
-        elif inference_request.model_provider == "anthropic":
-            return self.inference_manager.anthropic_text_generation(provider_details, inference_request)
-        elif inference_request.model_provider == "aleph-alpha":
-            return self.inference_manager.aleph_alpha_text_generation(provider_details, inference_request)
-        else:
-            raise Exception(
-                f"Unknown model provider, {inference_request.model_provider}. Please add a generation function in InferenceManager or route in ModelManager.text_generation"
-            )
-    
+        return self.inference_manager.text_generation(provider_details, inference_request)
+
     def get_announcer(self):
         return self.inference_manager.get_announcer()
 
+    def get_metrics(self):
+        return {
+            "engine": self.inference_engine.get_stats(),
+            **self.inference_manager.get_metrics(),
+            "storage": self.storage.get_stats(),
+            "sse": self.sse_manager.get_stats(),
+        }
+
+def parse_rate_limits(ctx, param, values) -> dict:
+    '''
+    Parses PROVIDER=RPM[:TPM] into {provider: (requests per minute, tokens per minute)}
+    '''
+    limits = {}
+    for value in values:
+        try:
+            provider, rates = value.split("=")
+            requests_per_minute, _, tokens_per_minute = rates.partition(":")
+            limits[provider] = (int(requests_per_minute) or None, int(tokens_per_minute) if tokens_per_minute else None)
+        except ValueError:
+            raise click.BadParameter(f"{value} is not in the form PROVIDER=RPM[:TPM], e.g. openai=3500:90000")
+    return limits
+
+# packages that are only imported once a provider or local model needs them
+DEFERRED_PACKAGES = ["torch", "transformers", "openai", "anthropic", "aleph_alpha_client", "sseclient"]
+
+def report_startup_profile(limit: int = 15):
+    '''
+    Imports the server in a fresh interpreter with -X importtime and reports the import time per top level package
+    '''
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server.app"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+
+    packages = defaultdict(int)
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        packages[name.strip().split(".")[0]] += int(self_us)
+
+    total = sum(packages.values())
+    click.echo(f"Startup import time: {total / 1e6:.3f}s ({len(packages)} packages)")
+    for package, self_us in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:limit]:
+        click.echo(f"  {package:<24} {self_us / 1e3:9.1f}ms {self_us / total:6.1%}")
+
+    deferred = [package for package in DEFERRED_PACKAGES if package not in packages]
+    click.echo(f"Deferred until first use: {', '.join(deferred) if deferred else 'none'}")
+
 @click.group()
 def cli():
     pass
@@ -331,7 +526,34 @@ def cli():
 @click.option('--env', '-e', default=".env", help='Path to the environment file for storing and reading API keys. Default: .env.')
 @click.option('--models', '-m', default=None, help='Path to the configuration file for loading models. Default: None.')
 @click.option('--log-level', '-l', default='INFO', help='Set the logging level. Default: INFO.', type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']))
-def run(host, port, debug, env, models, log_level):
+@click.option('--local-model-memory', default=None, type=float, help='Memory budget in MB for keeping local models loaded. Default: 80% of device memory.')
+@click.option('--http-pool-size', default=32, help='Maximum number of keep-alive connections per provider host. Default: 32.')
+@click.option('--http-timeout', default=60, type=float, help='Timeout in seconds for requests to remote providers. Default: 60.')
+@click.option('--max-remote-workers', default=32, help='Maximum number of remote provider streams running at once. Default: 32.')
+@click.option('--max-local-workers', default=8, help='Maximum number of local generations running at once. Default: 8.')
+@click.option('--max-batch-size', default=8, help='Maximum number of requests decoded together in one batch per local model. Default: 8.')
+@click.option('--prefix-cache-memory', default=512, type=float, help='Memory budget in MB for reusing prompt key/value caches of local models, 0 disables it. Default: 512.')
+@click.option('--download-workers', default=2, help='Number of local models downloaded at once. Default: 2.')
+@click.option('--download-shard-workers', default=4, help='Number of model files fetched in parallel. Default: 4.')
+@click.option('--save-window', default=0.5, type=float, help='Seconds model changes are collected before models.json is written. Default: 0.5.')
+@click.option('--sse-buffer-size', default=256, help='Number of messages buffered per streaming client. Default: 256.')
+@click.option('--sse-overflow-policy', default='block', type=click.Choice(OVERFLOW_POLICIES), help='What happens when a streaming client falls a full buffer behind. Default: block.')
+@click.option('--rate-limit', 'rate_limits', multiple=True, callback=parse_rate_limits, metavar='PROVIDER=RPM[:TPM]', help='Requests and tokens per minute allowed for each API key of a provider, can be repeated. Default: no limit until the provider returns a rate limit error.')
+@click.option('--max-retries', default=2, help='Number of times a remote request that fails before its first token is sent again. Default: 2.')
+@click.option('--retry-backoff', default=0.5, type=float, help='Base delay in seconds of the jittered exponential backoff between retries. Default: 0.5.')
+@click.option('--hedge-requests/--no-hedge-requests', default=False, help='Send a second request when the first token of a remote provider takes longer than its p95. Default: False.')
+@click.option('--completion-cache', default=OFF, type=click.Choice(CACHE_MODES), help='Which completions are cached and replayed for identical requests. Default: off.')
+@click.option('--completion-cache-size', default=1024, help='Number of cached completions kept in memory. Default: 1024.')
+@click.option('--completion-cache-disk', default=256, type=float, help='Disk budget in MB for cached completions, 0 keeps them in memory only. Default: 256.')
+@click.option('--cache-replay-speed', default=0, type=float, help='Pace of replayed completions relative to the original stream, 0 replays instantly. Default: 0.')
+@click.option('--dedupe-requests/--no-dedupe-requests', default=True, help='Share one generation between identical greedy requests that are in flight at the same time. Default: True.')
+@click.option('--profile-startup', is_flag=True, default=False, help='Report the import time per package and the server initialization time before starting. Default: False.')
+def run(
+    host, port, debug, env, models, log_level, local_model_memory, http_pool_size, http_timeout,
+    max_remote_workers, max_local_workers, max_batch_size, prefix_cache_memory, download_workers, download_shard_workers,
+    save_window, sse_buffer_size, sse_overflow_policy, rate_limits, max_retries, retry_backoff, hedge_requests,
+    completion_cache, completion_cache_size, completion_cache_disk, cache_replay_speed, dedupe_requests, profile_startup
+):
     """
     Run the OpenPlayground server.
 
@@ -344,14 +566,64 @@ def run(host, port, debug, env, models, log_level):
     --env, -e: Path to the environment file for storing and reading API keys. Default: .env.
     --models, -m: Path to the configuration file for loading models. Default: None.
     --log-level, -l: Set the logging level. Default: INFO. Choices: DEBUG, INFO, WARNING, ERROR, CRITICAL.
+    --local-model-memory: Memory budget in MB for keeping local models loaded. Default: 80% of device memory.
+    --http-pool-size: Maximum number of keep-alive connections per provider host. Default: 32.
+    --http-timeout: Timeout in seconds for requests to remote providers. Default: 60.
+    --max-remote-workers: Maximum number of remote provider streams running at once. Default: 32.
+    --max-local-workers: Maximum number of local generations running at once. Default: 8.
+    --max-batch-size: Maximum number of requests decoded together in one batch per local model. Default: 8.
+    --prefix-cache-memory: Memory budget in MB for reusing prompt key/value caches of local models, 0 disables it. Default: 512.
+    --download-workers: Number of local models downloaded at once. Default: 2.
+    --download-shard-workers: Number of model files fetched in parallel. Default: 4.
+    --save-window: Seconds model changes are collected before models.json is written. Default: 0.5.
+    --sse-buffer-size: Number of messages buffered per streaming client. Default: 256.
+    --sse-overflow-policy: What happens when a streaming client falls a full buffer behind. Default: block. Choices: drop_oldest (drop the oldest buffered message), coalesce (merge tokens into the newest buffered message), block (make generation wait for the client).
+    --rate-limit: Requests and tokens per minute allowed for each API key of a provider, as PROVIDER=RPM[:TPM], can be repeated. Default: no limit until the provider returns a rate limit error, then requests back off for its Retry-After and their concurrency is halved.
+    --max-retries: Number of times a remote request that fails before its first token is sent again. Default: 2.
+    --retry-backoff: Base delay in seconds of the jittered exponential backoff between retries. Default: 0.5.
+    --hedge-requests/--no-hedge-requests: Send a second request when the first token of a remote provider takes longer than its p95, the first one to stream is used. Default: False.
+    --completion-cache: Which completions are cached and replayed for identical requests. Default: off. Choices: off, deterministic (requests that decode greedily: temperature 0, or top k 1 for local and Hugging Face models), all.
+    --completion-cache-size: Number of cached completions kept in memory. Default: 1024.
+    --completion-cache-disk: Disk budget in MB for cached completions, 0 keeps them in memory only. Default: 256.
+    --cache-replay-speed: Pace of replayed completions relative to the original stream, 0 replays instantly. Default: 0.
+    --dedupe-requests/--no-dedupe-requests: Share one generation between identical requests that decode greedily (temperature 0, or top k 1 for local and Hugging Face models) made with the same API key that are in flight at the same time, requests joining late get the tokens sent so far first. Default: True.
+    --profile-startup: Report the import time per package and the server initialization time before starting. Default: False.
 
     Example usage:
 
     $ openplayground run --host=0.0.0.0 --port=8080 --debug --env=keys.env --models=models.json --log-level=DEBUG
     """
     logging.basicConfig(level=getattr(logging, log_level.upper()))
-    storage = Storage(models, env)
-    app.config['GLOBAL_STATE'] = GlobalStateManager(storage)
+    if profile_startup:
+        report_startup_profile()
+
+    start = time.perf_counter()
+    storage = Storage(models, env, save_window=save_window)
+    app.config['GLOBAL_STATE'] = GlobalStateManager(
+        storage,
+        local_model_memory=local_model_memory,
+        http_pool_size=http_pool_size,
+        http_timeout=http_timeout,
+        max_remote_workers=max_remote_workers,
+        max_local_workers=max_local_workers,
+        max_batch_size=max_batch_size,
+        prefix_cache_memory=prefix_cache_memory,
+        download_workers=download_workers,
+        download_shard_workers=download_shard_workers,
+        sse_buffer_size=sse_buffer_size,
+        sse_overflow_policy=sse_overflow_policy,
+        rate_limits=rate_limits,
+        max_retries=max_retries,
+        retry_backoff=retry_backoff,
+        hedge_requests=hedge_requests,
+        completion_cache=completion_cache,
+        completion_cache_size=completion_cache_size,
+        completion_cache_disk=completion_cache_disk,
+        cache_replay_speed=cache_replay_speed,
+        dedupe_requests=dedupe_requests
+    )
+    if profile_startup:
+        click.echo(f"Server initialized in {(time.perf_counter() - start) * 1000:.1f}ms")
 
     app.run(host=host, port=port, debug=debug)
 
@@ -2,7 +2,6 @@ import logging
 import json
 
 from ..entities import ProviderEncoder, ModelEncoder
-from ..sse import Message
 from .inference import inference_bp
 from .provider import provider_bp
 from flask import g, Blueprint, current_app, stream_with_context, Response
@@ -116,6 +115,19 @@ def providers_check_api_keys():
         mimetype='application/json'
     )
 
+@api_bp.route('/metrics', methods=['GET'])
+def metrics():
+    '''
+    Returns runtime metrics of the inference pipeline
+    '''
+    logger.info("Getting metrics")
+
+    return current_app.response_class(
+        response=json.dumps(g.get('global_state').get_metrics(), indent=4),
+        status=200,
+        mimetype='application/json'
+    )
+
 @api_bp.route("/notifications", methods=['GET'])
 def notifications():
     '''
@@ -132,16 +144,15 @@ def notifications():
 
         messages = SSE_MANAGER.listen("notifications")
         try:
-            while True:
-                message = messages.get()
-                message = json.loads(message)
-                if message["type"] == "done":
+            while (message := messages.get()) is not None:
+                if message.type == "done":
                     logger.info("Done streaming SSE")
                     break
-                print("Sending message: ", message)
-                logger.info(f"Yielding message: {message}")
-                yield str(Message(**message))
+                logger.debug(f"Yielding message: {message}")
+                yield message.encode()
         except GeneratorExit:
             logger.info("GeneratorExit")
+        finally:
+            messages.close()
 
     return Response(stream_with_context(generator()), mimetype='text/event-stream')
\ No newline at end of file
@@ -1,19 +1,20 @@
 import logging
-import json
 import time
-import threading
+import uuid
 
 from .response_utils import create_response_message
-from ..inference import InferenceRequest, InferenceResult, InferenceRequest
-from ..sse import Message
+from ..inference import InferenceRequest
+from ..sseserver import Event
 
-from concurrent.futures import ThreadPoolExecutor
 from flask import g, request, Response, stream_with_context, Blueprint, current_app
-from typing import List, Tuple
+from typing import Iterator, List
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+MAX_COALESCE_MS = 1000
+DEFAULT_COALESCE_MAX_TOKENS = 64
+
 inference_bp = Blueprint('inference', __name__, url_prefix='/inference')
 
 @inference_bp.before_app_request
@@ -31,7 +32,11 @@ def stream_inference():
     if not is_valid_request_data(data):
         return create_response_message("Invalid request", 400)
 
-    request_uuid = "1"
+    stream_options = extract_stream_options(data)
+    if stream_options is None:
+        return create_response_message("Invalid streamOptions", 400)
+
+    request_uuid = str(uuid.uuid4())
     prompt = data['prompt']
     models = data['models']
     
@@ -40,22 +45,62 @@ def stream_inference():
     if not all_tasks:
         return create_response_message("Invalid Request", 400)
 
-    thread = threading.Thread(target=bulk_completions, args=(global_state, all_tasks,))
-    thread.start()
+    # the channel is subscribed to before any task runs, so no early token can be lost
+    SSE_MANAGER = global_state.get_sse_manager()
+    SSE_MANAGER.add_topic(request_uuid, merge=global_state.get_announcer().merge)
+    messages = SSE_MANAGER.listen(request_uuid)
+
+    global_state.get_announcer().register(request_uuid)
+    global_state.get_inference_engine().submit(all_tasks)
 
-    return stream_response(global_state, request_uuid)
+    return stream_response(global_state, request_uuid, messages, *stream_options)
+
+@inference_bp.route("/text/cancel/<request_uuid>", methods=["POST"])
+def cancel_inference(request_uuid):
+    '''
+    Stops every model of a running request, its uuid is sent in the X-Request-Id header of the stream response
+    The stream ends with the usual "done" event once the models have stopped
+    '''
+    logger.info(f"Path: {request.path}, Request: {request_uuid}")
+
+    global_state = g.get('global_state')
+    if not global_state.get_announcer().cancel(request_uuid):
+        return create_response_message("Request not found", 404)
+
+    return create_response_message("Cancelled", 200)
 
 def is_valid_request_data(data):
     return isinstance(data['prompt'], str) and isinstance(data['models'], list)
 
+def extract_stream_options(data):
+    '''
+    Reads the optional {"streamOptions": {"coalesceMs": ..., "maxTokens": ...}} of a request
+    Tokens of the same model arriving within coalesceMs are sent as one event, at most maxTokens at a time
+    Returns (coalesce_ms, max_tokens), (0, 1) streams every token on its own and None means the options are invalid
+    '''
+    options = data.get('streamOptions') or {}
+    if not isinstance(options, dict):
+        return None
+
+    coalesce_ms = options.get('coalesceMs', 0)
+    max_tokens = options.get('maxTokens', DEFAULT_COALESCE_MAX_TOKENS)
+    if not isinstance(coalesce_ms, (int, float)) or not 0 <= coalesce_ms <= MAX_COALESCE_MS:
+        return None
+    if not isinstance(max_tokens, int) or max_tokens < 1:
+        return None
+
+    if coalesce_ms == 0:
+        return 0, 1
+    return coalesce_ms, max_tokens
+
 def create_inference_request(model, storage, prompt, request_uuid):
     model_name, provider_name, model_tag, parameters = extract_model_data(model)
     model_name = model_name.removeprefix(f"{provider_name}:")
-    provider = next((provider for provider in storage.get_providers() if provider.name == provider_name), None)
-    if provider is None or not provider.has_model(model_name):
+    model = storage.get_provider_model(provider_name, model_name)
+    if model is None:
         return None
     
-    if validate_parameters(provider.get_model(model_name), parameters):
+    if validate_parameters(model, parameters):
         return InferenceRequest(uuid=request_uuid, model_name=model_name, model_tag=model_tag,
             model_provider=provider_name, model_parameters=parameters, prompt=prompt
         )
@@ -79,51 +124,78 @@ def validate_parameters(model, parameters):
                 return False
     return True
 
-def stream_response(global_state, uuid):
+def read_batches(messages, coalesce_ms: float, max_tokens: int) -> Iterator[List[Event]]:
+    '''
+    Yields lists of events, collecting up to max_tokens events that arrive within coalesce_ms of the first one
+    '''
+    while (event := messages.get()) is not None:
+        batch = [event]
+        deadline = time.monotonic() + coalesce_ms / 1000
+        while len(batch) < max_tokens and batch[-1].type != "done" and (remaining := deadline - time.monotonic()) > 0:
+            if (event := messages.get(timeout=remaining)) is None:
+                break
+            batch.append(event)
+        yield batch
+
+def merge_tokens(batch: List[Event]) -> List[Event]:
+    '''
+    Merges the "infer" events of each model into one event carrying the concatenated text,
+    the per token message, probability and distribution are kept in its "tokens" list
+    Any other event ends the merge, so it stays ordered after the tokens sent before it
+    '''
+    merged, open_indices = [], {}
+    for event in batch:
+        if event.type != "infer":
+            merged.append(event)
+            open_indices.clear()
+            continue
+
+        model_key = tuple(event.data[key] for key in ("modelName", "modelTag", "modelProvider"))
+        index = open_indices.get(model_key)
+        if index is None:
+            open_indices[model_key] = len(merged)
+            merged.append(event)
+            continue
+
+        last = merged[index]
+        if "tokens" not in last.data:
+            # published events are shared with other subscribers, the merge goes into a copy
+            last = merged[index] = Event("infer", {**last.data, "tokens": [token_details(last.data)]})
+        last.data["tokens"].append(token_details(event.data))
+        last.data["message"] += event.data["message"]
+        last.data.update({key: event.data[key] for key in ("prob", "topNDistribution") if key in event.data})
+    return merged
+
+def token_details(data: dict) -> dict:
+    return {key: data[key] for key in ("message", "prob", "topNDistribution") if key in data}
+
+def stream_response(global_state, uuid, messages, coalesce_ms: float = 0, max_tokens: int = 1):
     @stream_with_context
     def generator():
         SSE_MANAGER = global_state.get_sse_manager()
-        messages = SSE_MANAGER.listen("inferences")
         try:
-            while True:
-                message = json.loads(message := messages.get())
-                if message["type"] == "done":
+            for batch in read_batches(messages, coalesce_ms, max_tokens):
+                done = batch[-1].type == "done"
+                if len(batch) > 1:
+                    # every event of the batch goes out in a single chunk
+                    chunk = b"".join(event.encode() for event in merge_tokens(batch) if event.type != "done")
+                else:
+                    chunk = b"" if done else batch[0].encode()
+                if chunk:
+                    logger.debug("Yielding messages: %s", chunk)
+                    yield chunk
+                if done:
                     logger.info("Done streaming SSE")
                     break
-                logger.debug(f"Yielding message: {json.dumps(message)}")
-                yield str(Message(**message))
         except GeneratorExit:
             logger.info("GeneratorExit")
-            SSE_MANAGER.publish("inferences", message=json.dumps({"uuid": uuid}))
-
-    return Response(stream_with_context(generator()), mimetype='text/event-stream')
-
-def bulk_completions(global_state, tasks: List[InferenceRequest]):
-    time.sleep(1)
-    local_tasks, remote_tasks = split_tasks_by_provider(tasks)
-
-    if remote_tasks:
-        with ThreadPoolExecutor(max_workers=len(remote_tasks)) as executor:
-            futures = [executor.submit(global_state.text_generation, task) for task in remote_tasks]
-            [future.result() for future in futures]
-
-    for task in local_tasks:
-        global_state.text_generation(task)
-
-    global_state.get_announcer().announce(InferenceResult(
-        uuid=tasks[0].uuid,
-        model_name=None,
-        model_tag=None,
-        model_provider=None,
-        token=None,
-        probability=None,
-        top_n_distribution=None
-    ), event="done")
-
-def split_tasks_by_provider(tasks: List[InferenceRequest]) -> Tuple[List[InferenceRequest], List[InferenceRequest]]:
-    local_tasks, remote_tasks = [], []
-
-    for task in tasks:
-        (local_tasks if task.model_provider == "huggingface-local" else remote_tasks).append(task)
-
-    return local_tasks, remote_tasks
\ No newline at end of file
+            global_state.get_announcer().cancel(uuid)
+        finally:
+            messages.close()
+            SSE_MANAGER.remove_topic(uuid)
+
+    return Response(
+        stream_with_context(generator()),
+        mimetype='text/event-stream',
+        headers={"X-Request-Id": uuid, "Access-Control-Expose-Headers": "X-Request-Id"}
+    )
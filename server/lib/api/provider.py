@@ -1,6 +1,5 @@
 import logging
 import json
-import requests
 
 from .response_utils import create_response_message
 from ..entities import Model, ModelEncoder
@@ -108,8 +107,10 @@ def provider_models_search(provider_name):
     
     search_url = search_url.replace('{searchQuery}', search_name)
 
-    response = requests.get(search_url)
-    content_json = response.json()
+    connection_pool = g.get('global_state').get_connection_pool()
+    session = connection_pool.get_session(provider_name)
+    with session.get(search_url, timeout=connection_pool.timeout) as response:
+        content_json = response.json()
     models = content_json.get('models', [])
     models = list(map(lambda model: {'name': model['id']}, models))
 
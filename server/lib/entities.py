@@ -4,7 +4,8 @@ from .event_emitter import EventEmitter, EVENTS
 
 class Model:
     def __init__(
-        self, name: str, enabled: bool, capabilities: List[str],  provider: str, status: str, parameters: dict = None
+        self, name: str, enabled: bool, capabilities: List[str],  provider: str, status: str, parameters: dict = None,
+        load_mode: str = None
     ):
         self.name = name
         self.capabilities = capabilities
@@ -12,6 +13,8 @@ class Model:
         self.provider = provider
         self.status = status
         self.parameters = parameters
+        # how a local model is loaded, None for the default
+        self.load_mode = load_mode
 
     def copy(self):
         return Model(
@@ -20,7 +23,8 @@ class Model:
             enabled=self.enabled,
             provider=self.provider,
             status=self.status,
-            parameters=self.parameters.copy()
+            parameters=self.parameters.copy(),
+            load_mode=self.load_mode
         )
 
     def __repr__(self):
@@ -37,6 +41,8 @@ class ModelEncoder(json.JSONEncoder):
                 "capabilities": obj.capabilities,
                 "enabled": obj.enabled, "status": obj.status, "parameters": obj.parameters
             }
+            if obj.load_mode is not None:
+                properties["loadMode"] = obj.load_mode
             if self.serialize_as_list:
                 return {**{"name": obj.name, "provider": obj.provider}, **properties}
             else:
@@ -53,6 +59,7 @@ class Provider:
         self.event_emitter = EventEmitter()
         self.name = name
         self.models = models
+        self.models_by_name = {model.name: model for model in models}
         self.remote_inference = remote_inference
         self.default_capabilities = default_capabilities
         self.default_parameters = default_parameters
@@ -61,31 +68,39 @@ class Provider:
         self.search_url = search_url
     
     def has_model(self, model_name: str) -> bool:
-        return any(model.name == model_name for model in self.models)
+        return model_name in self.models_by_name
     
     def get_model(self, model_name: str) -> Model:
-        for model in self.models:
-            if model.name == model_name:
-                return model
+        return self.models_by_name.get(model_name)
+
+    def replace_model(self, model_name: str, model: Model) -> bool:
+        '''
+        Swaps the stored model without emitting an event, returns False if there is no such model
+        '''
+        current = self.models_by_name.get(model_name)
+        if current is None:
+            return False
+        if current is not model:
+            self.models[self.models.index(current)] = model
+            del self.models_by_name[model_name]
+            self.models_by_name[model.name] = model
+        return True
             
     def update_model(self, model_name: str, model: Model) -> None:
-        for i, m in enumerate(self.models):
-            if m.name == model_name:
-                self.models[i] = model
-                self.event_emitter.emit(EVENTS.MODEL_UPDATED, model)
-                return
+        if self.replace_model(model_name, model):
+            self.event_emitter.emit(EVENTS.MODEL_UPDATED, model)
     
     def add_model(self, model: Model) -> None:
         self.models.append(model)
+        self.models_by_name[model.name] = model
         print("Added model!")
         self.event_emitter.emit(EVENTS.MODEL_ADDED, model)
 
     def remove_model(self, model_name: str) -> None:
-        for model in self.models:
-            if model.name == model_name:
-                self.models.remove(model)
-                self.event_emitter.emit(EVENTS.MODEL_REMOVED, model)
-                return
+        model = self.models_by_name.pop(model_name, None)
+        if model is not None:
+            self.models.remove(model)
+            self.event_emitter.emit(EVENTS.MODEL_REMOVED, model)
             
     def copy(self):
         return Provider(
@@ -118,7 +133,7 @@ class ProviderEncoder(json.JSONEncoder):
             if not self.serialize_models_as_list:
                 models = dict(zip([model["name"] for model in models], models))
         
-            return {self.to_camel_case(k): v for k, v in obj.__dict__.items() if k not in {'models', 'event_emitter'}} | {'models': models}
+            return {self.to_camel_case(k): v for k, v in obj.__dict__.items() if k not in {'models', 'models_by_name', 'event_emitter'}} | {'models': models}
         return super().default(obj)
     
     @staticmethod
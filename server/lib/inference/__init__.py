@@ -1,20 +1,28 @@
-import anthropic
-import cachetools
+import hashlib
+import itertools
+import json
 import math
-import openai
 import os
-import json
+import queue
 import requests
-import sseclient
-import urllib
+import threading
+import time
 import traceback
 import logging
 
-from aleph_alpha_client import Client as aleph_client, CompletionRequest, Prompt
-from datetime import datetime
 from dataclasses import dataclass
-from typing import Callable, Union
-from .huggingface.hf import HFInference
+from typing import TYPE_CHECKING, Tuple, Union
+from .cancellation import CancellationRegistry, CancellationToken
+from .connections import ConnectionPool
+from .huggingface.model_cache import ModelCache
+from .providers import GeneratedToken, ProviderBackend, ProviderRegistry
+from .rate_limits import RateLimits
+from .retries import Attempt, AttemptStats, RetryPolicy
+from .single_flight import Flight, SingleFlight
+from ..sseserver import Event
+
+if TYPE_CHECKING:
+    from .completion_cache import CachedCompletion, CompletionCache
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -25,9 +33,11 @@ class ProviderDetails:
     Args:
         api_key (str): API key for provider
         version_key (str): version key for provider
+        load_mode (str): how a local model is loaded, see huggingface.load_modes, None for the default
     '''
     api_key: str
     version_key: str
+    load_mode: str = None
 
 @dataclass
 class InferenceRequest:
@@ -47,6 +57,34 @@ class InferenceRequest:
     model_parameters: dict
     prompt: str
 
+    def key(self, credential: str = None) -> str:
+        '''
+        Identifies what is generated, equal for requests with the same provider, model, parameters and prompt
+        made with the same credential, so a completion is only ever shared with whoever could have generated it
+        '''
+        canonical = json.dumps({
+            "provider": self.model_provider,
+            "model": self.model_name,
+            "parameters": canonicalize(self.model_parameters),
+            "prompt": hashlib.sha256(self.prompt.encode()).hexdigest(),
+            "credential": hashlib.sha256(credential.encode()).hexdigest() if credential else None,
+        }, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+def canonicalize(value):
+    '''
+    Makes equal parameters encode the same, 1 and 1.0 or differently ordered keys do not change the key of a request
+    '''
+    if isinstance(value, dict):
+        return {str(key): canonicalize(value[key]) for key in sorted(value)}
+    elif isinstance(value, (list, tuple)):
+        return [canonicalize(item) for item in value]
+    elif isinstance(value, bool) or value is None:
+        return value
+    elif isinstance(value, (int, float)):
+        return float(value)
+    return value
+
 @dataclass
 class ProablityDistribution:
     '''
@@ -79,15 +117,15 @@ class InferenceResult:
     probability: Union[float, None]
     top_n_distribution: Union[ProablityDistribution, None]
 
-InferenceFunction = Callable[[str, InferenceRequest], None]
-
 class InferenceAnnouncer:
-    def __init__(self, sse_topic):
-        self.sse_topic = sse_topic
-        self.cancel_cache = cachetools.TTLCache(maxsize=1000, ttl=60)
+    '''
+    Publishes inference results to the SSE channel of the request they belong to
+    '''
+    def __init__(self, sse_manager):
+        self.sse_manager = sse_manager
+        self.cancellations = CancellationRegistry()
 
-    def __format_message__(self, event: str, infer_result: InferenceResult) -> str:
-        logger.debug("formatting message")
+    def __format_message__(self, event: str, infer_result: InferenceResult) -> Event:
         encoded = {
             "message": infer_result.token,
             "modelName": infer_result.model_name,
@@ -105,35 +143,95 @@ class InferenceAnnouncer:
                 "tokens": infer_result.top_n_distribution.tokens
             }
 
-        return json.dumps({"data": encoded, "type": event})
+        return Event(event, encoded)
     
     def announce(self, infer_result: InferenceResult, event: str):
-        if infer_result.uuid in self.cancel_cache:
+        # "done" still ends the stream of a client that cancelled explicitly
+        if event != "done" and self.is_cancelled(infer_result.uuid):
             return False
 
         message = None
         if event == "done":
-            message = json.dumps({"data": {}, "type": "done"})
+            message = Event("done", {})
         else:
             message = self.__format_message__(event=event, infer_result=infer_result)
 
-        logger.debug(f"Announcing {event} for uuid: {infer_result.uuid}, message: {message}")
-        self.sse_topic.publish(message)
+        logger.debug("Announcing %s for uuid: %s, message: %s", event, infer_result.uuid, message)
+        try:
+            # "done" is published from the engine loop, which must never wait for a slow listener
+            delivered = self.sse_manager.publish(infer_result.uuid, message, block=event != "done")
+        except ValueError:
+            delivered = 0
+
+        if not delivered:
+            # the channel is torn down once the client stops streaming
+            logger.info(f"Channel closed for uuid: {infer_result.uuid}")
+            self.cancel(infer_result.uuid)
+            return False
 
         return True
 
-    def cancel_callback(self, message):
-        if message['type'] == 'pmessage':
-            data = json.loads(message['data'])
-            uuid = data['uuid']
-            logger.info(f"Received cancel message for uuid: {uuid}")
-            self.cancel_cache[uuid] = True      
-   
-class InferenceManager:
-    def __init__(self, sse_topic):
-        self.announcer = InferenceAnnouncer(sse_topic)
+    def merge(self, last: Event, message: Event) -> Union[Event, None]:
+        '''
+        Merges two buffered "infer" events of the same model into one carrying both tokens, used by the coalesce overflow policy
+        Per token probabilities can not be merged, the merged event keeps those of the newest token
+        '''
+        if last.type != "infer" or message.type != "infer":
+            return None
+
+        if any(last.data[key] != message.data[key] for key in ("modelName", "modelTag", "modelProvider")):
+            return None
+
+        return Event("infer", {**message.data, "message": last.data["message"] + message.data["message"]})
+
+    def register(self, uuid: str) -> CancellationToken:
+        return self.cancellations.register(uuid)
+
+    def get_cancellation(self, uuid: str) -> CancellationToken:
+        '''
+        Returns the token of a running request, the route registers it before scheduling the request and the engine
+        releases it once every task returned
+        '''
+        token = self.cancellations.get(uuid)
+        if token is None:
+            raise RuntimeError(f"Inference request {uuid} is not registered, it was never scheduled or has already finished")
+        return token
+
+    def is_cancelled(self, uuid: str) -> bool:
+        token = self.cancellations.get(uuid)
+        return token is not None and token.cancelled
+
+    def cancel(self, uuid: str) -> bool:
+        '''
+        Cancels every task of the request, returns False if it is not running
+        '''
+        logger.info(f"Received cancel message for uuid: {uuid}")
+        return self.cancellations.cancel(uuid)
+
+    def release(self, uuid: str):
+        self.cancellations.release(uuid)
 
-    def __error_handler__(self, inference_fn: InferenceFunction, provider_details: ProviderDetails, inference_request: InferenceRequest):
+class InferenceManager:
+    def __init__(
+        self, sse_manager, model_cache: ModelCache = None, connection_pool: ConnectionPool = None, rate_limits: RateLimits = None,
+        retry_policy: RetryPolicy = None, hedge_requests: bool = False, completion_cache: "CompletionCache" = None,
+        single_flight: SingleFlight = None
+    ):
+        self.announcer = InferenceAnnouncer(sse_manager)
+        self.model_cache = model_cache if model_cache is not None else ModelCache()
+        self.connection_pool = connection_pool if connection_pool is not None else ConnectionPool()
+        self.providers = ProviderRegistry(connection_pool=self.connection_pool, model_cache=self.model_cache)
+        self.rate_limits = rate_limits if rate_limits is not None else RateLimits()
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.hedge_requests = hedge_requests
+        self.attempt_stats = AttemptStats()
+        self.completion_cache = completion_cache
+        self.single_flight = single_flight
+
+    def __error_handler__(
+        self, backend: ProviderBackend, provider_details: ProviderDetails, inference_request: InferenceRequest,
+        cache_key: str = None, flight_key: str = None
+    ):
         logger.info(f"Requesting inference from {inference_request.model_name} on {inference_request.model_provider}")
         infer_result = InferenceResult(
             uuid=inference_request.uuid,
@@ -157,28 +255,13 @@ class InferenceManager:
             return
 
         try:
-            inference_fn(provider_details, inference_request)
-        except openai.error.Timeout as e:
-            infer_result.token = f"[ERROR] OpenAI API request timed out: {e}"
-            logger.error(f"OpenAI API request timed out: {e}")
-        except openai.error.APIError as e:
-            infer_result.token = f"[ERROR] OpenAI API returned an API Error: {e}"
-            logger.error(f"OpenAI API returned an API Error: {e}")
-        except openai.error.APIConnectionError as e:
-            infer_result.token = f"[ERROR] OpenAI API request failed to connect: {e}"
-            logger.error(f"OpenAI API request failed to connect: {e}")
-        except openai.error.InvalidRequestError as e:
-            infer_result.token = f"[ERROR] OpenAI API request was invalid: {e}"
-            logger.error(f"OpenAI API request was invalid: {e}")
-        except openai.error.AuthenticationError as e:
-            infer_result.token = f"[ERROR] OpenAI API request was not authorized: {e}"
-            logger.error(f"OpenAI API request was not authorized: {e}")
-        except openai.error.PermissionError as e:
-            infer_result.token = f"[ERROR] OpenAI API request was not permitted: {e}"
-            logger.error(f"OpenAI API request was not permitted: {e}")
-        except openai.error.RateLimitError as e:
-            infer_result.token = f"[ERROR] OpenAI API request exceeded rate limit: {e}"
-            logger.error(f"OpenAI API request exceeded rate limit: {e}")
+            try:
+                self.__stream__(backend, provider_details, inference_request, cache_key, flight_key)
+            except Exception:
+                # closing the upstream stream on cancel makes the provider loop fail, that is expected
+                if not self.announcer.is_cancelled(inference_request.uuid):
+                    raise
+                logger.info(f"Stopped inference for {inference_request.uuid} - {inference_request.model_name} after cancel")
         except requests.exceptions.RequestException as e:
             logging.error(f"RequestException: {e}")
             infer_result.token = f"[ERROR] No response from {infer_result.model_provider } after sixty seconds"
@@ -190,482 +273,268 @@ class InferenceManager:
                 infer_result.token = f"[ERROR] Error parsing response from API: {e}"
                 logger.error(f"Error parsing response from API: {e}")
         except Exception as e:
-            infer_result.token = f"[ERROR] {e}"
-            logger.error(f"Error: {e}")
+            error = backend.format_error(e)
+            infer_result.token = f"[ERROR] {error}"
+            logger.error(f"Error: {error}")
         finally:
             if infer_result.token is None:
                 infer_result.token = "[COMPLETED]"
             self.announcer.announce(infer_result, event="status")
             logger.info(f"Completed inference for {inference_request.model_name} on {inference_request.model_provider}")
     
-    def __openai_chat_generation__(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        openai.api_key = provider_details.api_key
-
-        current_date = datetime.now().strftime("%Y-%m-%d")
-
-        if inference_request.model_name == "gpt-4":
-            system_content = "You are GPT-4, a large language model trained by OpenAI. Answer as concisely as possible"
-        else:
-            system_content = f"You are ChatGPT, a large language model trained by OpenAI. Answer as concisely as possible. Knowledge cutoff: 2021-09-01 Current date: {current_date}"
-
-        response = openai.ChatCompletion.create(
-             model=inference_request.model_name,
-             messages = [
-                {"role": "system", "content": system_content},
-                {"role": "user", "content": inference_request.prompt},
-            ],
-            temperature=inference_request.model_parameters['temperature'],
-            max_tokens=inference_request.model_parameters['maximumLength'],
-            top_p=inference_request.model_parameters['topP'],
-            frequency_penalty=inference_request.model_parameters['frequencyPenalty'],
-            presence_penalty=inference_request.model_parameters['presencePenalty'],
-            stream=True,
-            timeout=60
-        )
-
-        tokens = ""
-        cancelled = False
-
-        for event in response:
-            response = event['choices'][0]
-            if response['finish_reason'] == "stop":
-                break
-
-            delta = response['delta']
-
-            if "content" not in delta:
-                continue
-
-            generated_token = delta["content"]
-            tokens += generated_token
-
-            infer_response = InferenceResult(
-                uuid=inference_request.uuid,
-                model_name=inference_request.model_name,
-                model_tag=inference_request.model_tag,
-                model_provider=inference_request.model_provider,
-                token=generated_token,
-                probability=None,
-                top_n_distribution=None
-             )
-
-            if cancelled: continue
-
-            if not self.announcer.announce(infer_response, event="infer"):
-                cancelled = True
-                logger.info(f"Cancelled inference for {inference_request.uuid} - {inference_request.model_name}")
-
-    def __openai_text_generation__(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        openai.api_key = provider_details.api_key
-
-        response = openai.Completion.create(
-            model=inference_request.model_name,
-            prompt=inference_request.prompt,
-            temperature=inference_request.model_parameters['temperature'],
-            max_tokens=inference_request.model_parameters['maximumLength'],
-            top_p=inference_request.model_parameters['topP'],
-            stop=None if len(inference_request.model_parameters['stopSequences']) == 0 else inference_request.model_parameters['stopSequences'],
-            frequency_penalty=inference_request.model_parameters['frequencyPenalty'],
-            presence_penalty=inference_request.model_parameters['presencePenalty'],
-            logprobs=5,
-            stream=True
+    def __start__(
+        self, backend: ProviderBackend, provider_details: ProviderDetails, inference_request: InferenceRequest,
+        cancellation: CancellationToken, hedge: bool = False
+    ) -> Union[Attempt, None]:
+        '''
+        Sends a request once the rate limiter admits it, returns None if it was cancelled while queued
+        A hedge is only sent if the rate limiter has room for it right away
+        '''
+        attempt_cancellation = CancellationToken(inference_request.uuid)
+        if backend.capabilities.local:
+            cancellation.on_cancel(attempt_cancellation.cancel)
+            return Attempt(backend.generate(provider_details, inference_request, attempt_cancellation), attempt_cancellation)
+
+        limiter = self.rate_limits.get(inference_request.model_provider, provider_details.api_key, backend.capabilities.max_concurrency)
+        # about four characters per token for the prompt, plus everything the completion may use
+        tokens = len(inference_request.prompt) // 4 + int(inference_request.model_parameters.get('maximumLength', 0))
+
+        admitted_at = limiter.try_acquire(tokens) if hedge else limiter.acquire(tokens, cancellation)
+        if admitted_at is None:
+            return None
+
+        cancellation.on_cancel(attempt_cancellation.cancel)
+        return Attempt(
+            backend.generate(provider_details, inference_request, attempt_cancellation), attempt_cancellation,
+            limiter=limiter, admitted_at=admitted_at, hedge=hedge
         )
-        cancelled = False
 
-        for event in response:
-            generated_token = event['choices'][0]['text']
-            infer_response = None
+    def __first_token__(
+        self, backend: ProviderBackend, provider_details: ProviderDetails, inference_request: InferenceRequest, cancellation: CancellationToken
+    ) -> Tuple[Union[Attempt, None], Union[GeneratedToken, None]]:
+        '''
+        Sends the request and waits for its first token
+        With hedging, a second request is sent once the first token takes longer than the p95 of the provider,
+        whichever request gets its first token first streams and the other one is cancelled
+        '''
+        provider = inference_request.model_provider
+        start = time.monotonic()
+        hedge_after = None
+        if self.hedge_requests and backend.capabilities.streaming and not backend.capabilities.local:
+            hedge_after = self.attempt_stats.percentile(provider, 0.95)
+
+        attempt = self.__start__(backend, provider_details, inference_request, cancellation)
+        if attempt is None:
+            return None, None
+
+        if hedge_after is None:
+            first = attempt.first()
+            self.attempt_stats.record_first_token(provider, time.monotonic() - start)
+            return attempt, first
+
+        results = queue.Queue()
+        lock = threading.Lock()
+        winner = None
+
+        def wait_for_first_token(attempt: Attempt):
+            error, first = None, None
             try:
-                chosen_log_prob = 0
-                likelihood = event['choices'][0]["logprobs"]['top_logprobs'][0]
-
-                prob_dist = ProablityDistribution(
-                    log_prob_sum=0, simple_prob_sum=0, tokens={},
-                )
-
-                for token, log_prob in likelihood.items():
-                    simple_prob = round(math.exp(log_prob) * 100, 2)
-                    prob_dist.tokens[token] = [log_prob, simple_prob]
-
-                    if token == generated_token:
-                        chosen_log_prob = round(log_prob, 2)
-  
-                    prob_dist.simple_prob_sum += simple_prob
-                
-                prob_dist.tokens = dict(
-                    sorted(prob_dist.tokens.items(), key=lambda item: item[1][0], reverse=True)
-                )
-                prob_dist.log_prob_sum = chosen_log_prob
-                prob_dist.simple_prob_sum = round(prob_dist.simple_prob_sum, 2)
-             
-                infer_response = InferenceResult(
-                    uuid=inference_request.uuid,
-                    model_name=inference_request.model_name,
-                    model_tag=inference_request.model_tag,
-                    model_provider=inference_request.model_provider,
-                    token=generated_token,
-                    probability=event['choices'][0]['logprobs']['token_logprobs'][0],
-                    top_n_distribution=prob_dist
-                )
-            except IndexError:
-                infer_response = InferenceResult(
-                    uuid=inference_request.uuid,
-                    model_name=inference_request.model_name,
-                    model_tag=inference_request.model_tag,
-                    model_provider=inference_request.model_provider,
-                    token=generated_token,
-                    probability=-1,
-                    top_n_distribution=None
-                )
-
-            if cancelled: continue
-
-            if not self.announcer.announce(infer_response, event="infer"):
-                cancelled = True
-                logger.info(f"Cancelled inference for {inference_request.uuid} - {inference_request.model_name}")
-
-    def openai_text_generation(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        # TODO: Add a meta field to the inference so we know when a model is chat vs text
-        if inference_request.model_name in ["gpt-3.5-turbo", "gpt-4"]:
-            self.__error_handler__(self.__openai_chat_generation__, provider_details, inference_request)
-        else:
-            self.__error_handler__(self.__openai_text_generation__, provider_details, inference_request)
-
-    def __cohere_text_generation__(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        with requests.post("https://api.cohere.ai/generate",
-            headers={
-                "Authorization": f"Bearer {provider_details.api_key}",
-                "Content-Type": "application/json",
-                "Cohere-Version": "2021-11-08",
-            },
-            data=json.dumps({
-                "prompt": inference_request.prompt,
-                "model": inference_request.model_name,
-                "temperature": float(inference_request.model_parameters['temperature']),
-                "p": float(inference_request.model_parameters['topP']),
-                "k": int(inference_request.model_parameters['topK']),
-                "stopSequences": inference_request.model_parameters['stopSequences'],
-                "frequencyPenalty": float(inference_request.model_parameters['frequencyPenalty']),
-                "presencePenalty": float(inference_request.model_parameters['presencePenalty']),
-                "return_likelihoods": "GENERATION",
-                "max_tokens": int(inference_request.model_parameters['maximumLength']),
-                "stream": True,
-            }),
-            stream=True
-        ) as response:
-            if response.status_code != 200:
-                raise Exception(f"Request failed: {response.status_code} {response.reason}")
-
-            cancelled = False
-
-            for token in response.iter_lines():
-                token = token.decode('utf-8')
-                token_json = json.loads(token)
-                if cancelled: continue
-
-                if not self.announcer.announce(InferenceResult(
-                    uuid=inference_request.uuid,
-                    model_name=inference_request.model_name,
-                    model_tag=inference_request.model_tag,
-                    model_provider=inference_request.model_provider,
-                    token=token_json['text'],
-                    probability=None, #token_json['likelihood']
-                    top_n_distribution=None
-                ), event="infer"):
-                    cancelled = True
-                    logger.info(f"Cancelled inference for {inference_request.uuid} - {inference_request.model_name}")
-
-    def cohere_text_generation(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        self.__error_handler__(self.__cohere_text_generation__, provider_details, inference_request)
-    
-    def __huggingface_text_generation__(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        response = requests.request("POST",
-            f"https://api-inference.huggingface.co/models/{inference_request.model_name}",
-            headers={"Authorization": f"Bearer {provider_details.api_key}"},
-            json={
-                "inputs": inference_request.prompt,
-                "stream": True,
-                "parameters": {
-                    "max_length": min(inference_request.model_parameters['maximumLength'], 250), # max out at 250 tokens per request, we should handle for this in client side but just in case
-                    "temperature": inference_request.model_parameters['temperature'],
-                    "top_k": inference_request.model_parameters['topK'],
-                    "top_p": inference_request.model_parameters['topP'],
-                    "repetition_penalty": inference_request.model_parameters['repetitionPenalty'],
-                    "stop_sequences": inference_request.model_parameters['stopSequences'],
-                },
-                "options": {
-                    "use_cache": False
-                }
-            },
-            timeout=60
-        )
-
-        content_type = response.headers["content-type"]
-
-        cancelled = False
-
-        if response.status_code != 200:
-            raise Exception(f"Request failed: {response.status_code} {response.reason}")
-
-        if content_type == "application/json":
-            return_data = json.loads(response.content.decode("utf-8"))
-            outputs = return_data[0]["generated_text"]
-            outputs = outputs.removeprefix(inference_request.prompt)
-
-            self.announcer.announce(InferenceResult(
-                uuid=inference_request.uuid,
-                model_name=inference_request.model_name,
-                model_tag=inference_request.model_tag,
-                model_provider=inference_request.model_provider,
-                token=outputs,
-                probability=None,
-                top_n_distribution=None
-            ), event="infer")
-        else:
-            total_tokens = 0
-            for response in response.iter_lines():
-                response = response.decode('utf-8')
-                if response == "":
-                    continue
-
-                response_json = json.loads(response[5:])
-                if "error" in response:
-                    error = response_json["error"]
-                    raise Exception(f"{error}")
-
-                token = response_json['token']
-
-                total_tokens += 1
-
-                if token["special"]:
-                    continue
-
-                if cancelled: continue
-
-                if not self.announcer.announce(
-                    InferenceResult(
-                        uuid=inference_request.uuid,
-                        model_name=inference_request.model_name,
-                        model_tag=inference_request.model_tag,
-                        model_provider=inference_request.model_provider,
-                        token=" " if token['id'] == 3 else token['text'],
-                        probability=token['logprob'],
-                        top_n_distribution=None,
-                    ),
-                    event="infer",
-                ):
-                    cancelled = True
-                    logger.info(f"Cancelled inference for {inference_request.uuid} - {inference_request.model_name}")
-           
-    def huggingface_text_generation(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        self.__error_handler__(self.__huggingface_text_generation__, provider_details, inference_request)
-
-    def __forefront_text_generation__(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        with requests.post(
-                f"https://shared-api.forefront.link/organization/gPn2ZLSO3mTh/{inference_request.model_name}/completions/{provider_details.version_key}",
-                headers={
-                    "Authorization": f"Bearer {provider_details.api_key}",
-                    "Content-Type": "application/json",
-                },
-                data=json.dumps({
-                    "text": inference_request.prompt,
-                    "top_p": float(inference_request.model_parameters['topP']),
-                    "top_k": int(inference_request.model_parameters['topK']),
-                    "temperature":  float(inference_request.model_parameters['temperature']),
-                    "repetition_penalty":  float(inference_request.model_parameters['repetitionPenalty']),
-                    "length": int(inference_request.model_parameters['maximumLength']),
-                    "stop": inference_request.model_parameters['stopSequences'],
-                    "logprobs": 5,
-                    "stream": True,
-                }),
-                stream=True
-            ) as response:
-            if response.status_code != 200:
-                raise Exception(f"Request failed: {response.status_code} {response.reason}")
-            cancelled = False
-            total_tokens = 0
-            aggregate_string_length = 0
-
-            for packet in sseclient.SSEClient(response).events():
-                generated_token = None
-                probability = None
-                prob_dist = None
-
-                if packet.event == "update":
-                    packet.data = urllib.parse.unquote(packet.data)
-                    generated_token = packet.data[aggregate_string_length:]
-                    aggregate_string_length = len(packet.data)
-
-                    if not self.announcer.announce(InferenceResult(
-                        uuid=inference_request.uuid,
-                        model_name=inference_request.model_name,
-                        model_tag=inference_request.model_tag,
-                        model_provider=inference_request.model_provider,
-                        token=generated_token,
-                        probability=probability,
-                        top_n_distribution=prob_dist
-                    ), event="infer"):
-                        cancelled = True
-                        logger.info(f"Cancelled inference for {inference_request.uuid} - {inference_request.model_name}")
-                elif packet.event == "message":
-                    data = json.loads(packet.data)
-
-                    logprobs = data["logprobs"][0]
-                    tokens = logprobs["tokens"]
-                    token_logprobs = logprobs["token_logprobs"]
-
-                    new_tokens = tokens[total_tokens:]
-
-                    for index, new_token in enumerate(new_tokens):
-                        generated_token = new_token
-
-                        probability = token_logprobs[total_tokens + index]
-                        top_logprobs = logprobs["top_logprobs"][total_tokens + index]
-
-                        chosen_log_prob = 0
-                        prob_dist = ProablityDistribution(
-                            log_prob_sum=0, simple_prob_sum=0, tokens={},
-                        )
-
-                        for token, log_prob in top_logprobs.items():
-                            if log_prob == -3000.0: continue
-                            simple_prob = round(math.exp(log_prob) * 100, 2)
-                            prob_dist.tokens[token] = [log_prob, simple_prob]
-
-                            if token == generated_token:
-                                chosen_log_prob = round(log_prob, 2)
-
-                            prob_dist.simple_prob_sum += simple_prob
-
-                        prob_dist.tokens = dict(
-                            sorted(prob_dist.tokens.items(), key=lambda item: item[1][0], reverse=True)
-                        )
-                        prob_dist.log_prob_sum = chosen_log_prob
-                        prob_dist.simple_prob_sum = round(prob_dist.simple_prob_sum, 2)
-
-                        if not self.announcer.announce(InferenceResult(
-                            uuid=inference_request.uuid,
-                            model_name=inference_request.model_name,
-                            model_tag=inference_request.model_tag,
-                            model_provider=inference_request.model_provider,
-                            token=generated_token,
-                            probability=probability,
-                            top_n_distribution=prob_dist
-                        ), event="infer"):
-                            cancelled = True
-                            logger.info(f"Cancelled inference for {inference_request.uuid} - {inference_request.model_name}")
-
-                    total_tokens = len(tokens)
-                elif packet.event == "end":
-                    break
-                else:
+                first = attempt.first()
+            except Exception as e:
+                error = e
+
+            with lock:
+                # a losing request that was still waiting closes itself, the winner streams from the calling thread
+                if winner is not None:
+                    attempt.close()
+                    return
+                results.put((attempt, first, error))
+
+        attempts = [attempt]
+        threading.Thread(target=wait_for_first_token, args=(attempt,), name="first-token", daemon=True).start()
+
+        hedged = False
+        while True:
+            try:
+                attempt, first, error = results.get(timeout=None if hedged else max(0.0, start + hedge_after - time.monotonic()))
+            except queue.Empty:
+                hedged = True
+                hedge = self.__start__(backend, provider_details, inference_request, cancellation, hedge=True)
+                if hedge is None:
+                    # the rate limiter has no room for a hedge, keep waiting for the first request
                     continue
+                logger.info(f"Hedging inference for {inference_request.uuid} - {inference_request.model_name} after {hedge_after * 1000:.0f}ms")
+                self.attempt_stats.count(provider, "hedges")
+                attempts.append(hedge)
+                threading.Thread(target=wait_for_first_token, args=(hedge,), name="first-token", daemon=True).start()
+                continue
 
-                if cancelled: continue
-
-    def forefront_text_generation(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        self.__error_handler__(self.__forefront_text_generation__, provider_details, inference_request)
+            attempts.remove(attempt)
+            # a failed request only loses if the other one may still stream
+            if error is None or not attempts:
+                break
 
-    def __local_text_generation__(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        cancelled = False
-        logger.info(f"Starting inference for {inference_request.uuid} - {inference_request.model_name}")
+        with lock:
+            winner = attempt
+            for other in attempts:
+                other.cancellation.cancel()
+        # losers that already returned their first token are no longer running and are closed here
+        while not results.empty():
+            results.get()[0].close()
 
-        hf = HFInference(inference_request.model_name)
-        output = hf.generate(
-            prompt=inference_request.prompt,
-            max_length=int(inference_request.model_parameters['maximumLength']),
-            top_p=float(inference_request.model_parameters['topP']),
-            top_k=int(inference_request.model_parameters['topK']),
-            temperature=float(inference_request.model_parameters['temperature']),
-            repetition_penalty=float(inference_request.model_parameters['repetitionPenalty']),
-            stop_sequences=None,
-        )
+        if error is not None:
+            raise error
 
-        infer_response = None
-        for generated_token in output:
-            if cancelled: break
-            infer_response = InferenceResult(
-                uuid=inference_request.uuid,
-                model_name=inference_request.model_name,
-                model_tag=inference_request.model_tag,
-                model_provider=inference_request.model_provider,
-                token=generated_token,
-                probability=None,
-                top_n_distribution=None
-            )
-        
-            if not self.announcer.announce(infer_response, event="infer"):
-                cancelled = True
-                logger.info(f"Cancelled inference for {inference_request.uuid} - {inference_request.model_name}")
-
-    def local_text_generation(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-       self.__error_handler__(self.__local_text_generation__, provider_details, inference_request)
-    
-    def __anthropic_text_generation__(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        c = anthropic.Client(provider_details.api_key)
-
-        response = c.completion_stream(
-            prompt=f"{anthropic.HUMAN_PROMPT} {inference_request.prompt}{anthropic.AI_PROMPT}",
-            stop_sequences=[anthropic.HUMAN_PROMPT] + inference_request.model_parameters['stopSequences'],
-            temperature=float(inference_request.model_parameters['temperature']),
-            top_p=float(inference_request.model_parameters['topP']),
-            max_tokens_to_sample=inference_request.model_parameters['maximumLength'],
-            model=inference_request.model_name,
-            stream=True,
-        )
+        self.attempt_stats.record_first_token(provider, time.monotonic() - start)
+        if winner.hedge:
+            self.attempt_stats.count(provider, "hedgesWon")
+        return winner, first
 
-        completion = ""
-        cancelled = False
-
-        for data in response:
-            new_completion = data["completion"]
-            generated_token = new_completion[len(completion):]
-            if cancelled: continue
-
-            if not self.announcer.announce(InferenceResult(
-                uuid=inference_request.uuid,
-                model_name=inference_request.model_name,
-                model_tag=inference_request.model_tag,
-                model_provider=inference_request.model_provider,
-                token=generated_token,
-                probability=None,
-                top_n_distribution=None
-             ), event="infer"):
-                cancelled = True
-                logger.info(f"Cancelled inference for {inference_request.uuid} - {inference_request.model_name}")
-
-            completion = new_completion
-
-    def anthropic_text_generation(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        self.__error_handler__(self.__anthropic_text_generation__, provider_details, inference_request)
-    
-    def __aleph_alpha_text_generation__(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        client = aleph_client(provider_details.api_key)
-        
-        request = CompletionRequest(
-            prompt = Prompt.from_text(inference_request.prompt),
-            temperature= inference_request.model_parameters['temperature'],
-            maximum_tokens=inference_request.model_parameters['maximumLength'],
-            top_p=float(inference_request.model_parameters['topP']),
-            top_k=int(inference_request.model_parameters['topK']),
-            presence_penalty=float(inference_request.model_parameters['repetitionPenalty']),
-            stop_sequences=inference_request.model_parameters['stopSequences']
-        )
-        
-        response = client.complete(request, model=inference_request.model_name)
-        
-        self.announcer.announce(InferenceResult(
+    def __announce_token__(self, inference_request: InferenceRequest, generated: GeneratedToken) -> bool:
+        if self.announcer.announce(InferenceResult(
             uuid=inference_request.uuid,
             model_name=inference_request.model_name,
             model_tag=inference_request.model_tag,
             model_provider=inference_request.model_provider,
-            token=response.completions[0].completion,
-            probability=None,
-            top_n_distribution=None
-        ), event="infer")
+            token=generated.token,
+            probability=generated.probability,
+            top_n_distribution=generated.top_n_distribution
+        ), event="infer"):
+            return True
+
+        logger.info(f"Cancelled inference for {inference_request.uuid} - {inference_request.model_name}")
+        return False
+
+    def __replay__(self, completion: "CachedCompletion", inference_request: InferenceRequest, cancellation: CancellationToken):
+        logger.info(f"Replaying cached completion for {inference_request.uuid} - {inference_request.model_name}")
+        replay_speed = self.completion_cache.replay_speed
+        start = time.monotonic()
+        for generated, offset in completion:
+            if replay_speed > 0:
+                delay = start + offset / replay_speed - time.monotonic()
+                if delay > 0 and cancellation.wait(delay):
+                    return
+            if not self.__announce_token__(inference_request, generated):
+                return
+
+    def __stream__(
+        self, backend: ProviderBackend, provider_details: ProviderDetails, inference_request: InferenceRequest,
+        cache_key: str = None, flight_key: str = None
+    ):
+        '''
+        Announces the tokens of the request, a cached completion is replayed and, with a flight_key, an identical
+        request in flight is followed instead of generating it again
+        '''
+        cancellation = self.announcer.get_cancellation(inference_request.uuid)
+        if cache_key is not None:
+            completion = self.completion_cache.get(cache_key)
+            if completion is not None:
+                return self.__replay__(completion, inference_request, cancellation)
+
+        if flight_key is None:
+            return self.__generate__(backend, provider_details, inference_request, cancellation, cache_key)
+
+        flight, leader = self.single_flight.join(flight_key, inference_request.uuid)
+        # the generation goes on for as long as any of the identical requests is still streaming
+        cancellation.on_cancel(flight.leave)
+        if not leader:
+            for generated in flight.follow(cancellation):
+                if not self.__announce_token__(inference_request, generated):
+                    return
+            return
+
+        error = None
+        try:
+            self.__generate__(backend, provider_details, inference_request, flight.cancellation, cache_key, flight)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.single_flight.finish(flight, error)
+
+    def __generate__(
+        self, backend: ProviderBackend, provider_details: ProviderDetails, inference_request: InferenceRequest,
+        cancellation: CancellationToken, cache_key: str = None, flight: Flight = None
+    ):
+        '''
+        Generates the request, failures before the first token are retried with backoff
+        Stops once cancellation is, for a shared generation that is when no request follows it anymore
+        '''
+        for retry in itertools.count():
+            try:
+                attempt, first = self.__first_token__(backend, provider_details, inference_request, cancellation)
+                break
+            except Exception as e:
+                if cancellation.cancelled or retry >= self.retry_policy.max_retries or not backend.is_retryable(e):
+                    raise
+
+                delay = self.retry_policy.delay(retry)
+                logger.warning(f"Retrying inference for {inference_request.uuid} - {inference_request.model_name} in {delay:.2f}s after: {e}")
+                self.attempt_stats.count(inference_request.model_provider, "retries")
+                if cancellation.wait(delay):
+                    return
+
+        if attempt is None:
+            logger.info(f"Cancelled inference for {inference_request.uuid} - {inference_request.model_name} while it was queued")
+            return
+
+        completion = []
+        start = time.monotonic()
+        announcing = True
+        error = None
+        try:
+            for generated in itertools.chain([] if first is None else [first], attempt.tokens):
+                if cache_key is not None:
+                    completion.append((generated, time.monotonic() - start))
+                if flight is not None:
+                    flight.publish(generated)
+
+                if announcing and not self.__announce_token__(inference_request, generated):
+                    announcing = False
+                if not announcing and (flight is None or cancellation.cancelled):
+                    break
+            else:
+                # a cancelled stream may end early without an error
+                if cache_key is not None and not cancellation.cancelled:
+                    self.completion_cache.put(cache_key, completion)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # runs the cleanup of the backend, which drops the upstream stream when leaving early
+            attempt.close(error)
+
+    def text_generation(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
+        '''
+        Only requests the backend decodes greedily share a generation in flight or, in deterministic mode, are cached,
+        sampled ones would all get the same completion
+        '''
+        backend = self.providers.get(inference_request.model_provider)
+        deterministic = backend.is_deterministic(inference_request)
+
+        cache_key = None
+        if self.completion_cache is not None and self.completion_cache.accepts(deterministic):
+            cache_key = inference_request.key(provider_details.api_key)
+        flight_key = None
+        if self.single_flight is not None and deterministic:
+            flight_key = inference_request.key(provider_details.api_key)
+        self.__error_handler__(backend, provider_details, inference_request, cache_key, flight_key)
 
-    def aleph_alpha_text_generation(self, provider_details: ProviderDetails, inference_request: InferenceRequest):
-        self.__error_handler__(self.__aleph_alpha_text_generation__, provider_details, inference_request)
-    
     def get_announcer(self):
-        return self.announcer 
\ No newline at end of file
+        return self.announcer
+
+    def get_providers(self) -> ProviderRegistry:
+        return self.providers
+
+    def get_metrics(self):
+        return {
+            "modelCache": self.model_cache.get_stats(),
+            "prefixCache": self.model_cache.prefix_cache.get_stats() if self.model_cache.prefix_cache is not None else None,
+            "connections": self.connection_pool.get_stats(),
+            "cancellation": self.announcer.cancellations.get_stats(),
+            "providers": self.providers.get_stats(),
+            "rateLimits": self.rate_limits.get_stats(),
+            "attempts": self.attempt_stats.get_stats(),
+            "completionCache": self.completion_cache.get_stats() if self.completion_cache is not None else None,
+            "singleFlight": self.single_flight.get_stats() if self.single_flight is not None else None,
+        }
\ No newline at end of file
@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+class CancellationToken:
+    '''
+    Cancellation state shared by every task of one inference request
+    Callbacks registered with on_cancel free upstream resources (HTTP streams, decode slots) as soon as it is cancelled
+    '''
+    def __init__(self, uuid: str):
+        self.uuid = uuid
+        self.cancelled_at = None
+        self.callbacks = []
+        self.event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancelled_at is not None
+
+    def cancel(self) -> bool:
+        '''
+        Returns False if the token was already cancelled
+        '''
+        with self._lock:
+            if self.cancelled_at is not None:
+                return False
+            self.cancelled_at = time.monotonic()
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            self.__run__(callback)
+        return True
+
+    def on_cancel(self, callback: Callable[[], None]):
+        '''
+        Runs callback once the token is cancelled, right away if it already is
+        '''
+        with self._lock:
+            if self.cancelled_at is None:
+                self.callbacks.append(callback)
+                return
+        self.__run__(callback)
+
+    def wait(self, timeout: float) -> bool:
+        '''
+        Sleeps for up to timeout seconds, returns True as soon as the token is cancelled
+        '''
+        return self.event.wait(timeout)
+
+    def __run__(self, callback: Callable[[], None]):
+        try:
+            callback()
+        except Exception as e:
+            logger.debug(f"Cancel callback for {self.uuid} failed: {e}")
+
+class CancellationRegistry:
+    '''
+    Cancellation tokens of the running inference requests
+    Releasing a cancelled request records how long it took from the cancel until all of its tasks returned
+    '''
+    def __init__(self):
+        self.tokens = {}
+        self._lock = threading.Lock()
+
+        self.cancelled = 0
+        self.freed = 0
+        self.last_freed_ms = 0.0
+        self.max_freed_ms = 0.0
+        self.total_freed_ms = 0.0
+
+    def register(self, uuid: str) -> CancellationToken:
+        with self._lock:
+            if uuid not in self.tokens:
+                self.tokens[uuid] = CancellationToken(uuid)
+            return self.tokens[uuid]
+
+    def get(self, uuid: str) -> CancellationToken:
+        return self.tokens.get(uuid)
+
+    def cancel(self, uuid: str) -> bool:
+        '''
+        Returns False if there is no running request with that uuid
+        '''
+        token = self.get(uuid)
+        if token is None:
+            return False
+        if token.cancel():
+            logger.info(f"Cancelled inference request {uuid}")
+            self.cancelled += 1
+        return True
+
+    def release(self, uuid: str):
+        with self._lock:
+            token = self.tokens.pop(uuid, None)
+
+        if token is not None and token.cancelled:
+            elapsed_ms = (time.monotonic() - token.cancelled_at) * 1000
+            logger.info(f"Freed inference request {uuid} {elapsed_ms:.2f}ms after it was cancelled")
+            self.freed += 1
+            self.last_freed_ms = elapsed_ms
+            self.max_freed_ms = max(self.max_freed_ms, elapsed_ms)
+            self.total_freed_ms += elapsed_ms
+
+    def get_stats(self) -> dict:
+        return {
+            "running": len(self.tokens),
+            "cancelled": self.cancelled,
+            "freed": self.freed,
+            "lastCancelToFreedMs": round(self.last_freed_ms, 3),
+            "maxCancelToFreedMs": round(self.max_freed_ms, 3),
+            "avgCancelToFreedMs": round(self.total_freed_ms / self.freed, 3) if self.freed else 0.0,
+        }
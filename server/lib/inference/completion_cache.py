@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import List, Optional, Tuple
+from . import ProablityDistribution
+from .providers import GeneratedToken
+
+logger = logging.getLogger(__name__)
+
+# which completions are cached
+OFF = "off"
+DETERMINISTIC = "deterministic"
+ALL = "all"
+CACHE_MODES = (OFF, DETERMINISTIC, ALL)
+
+# a cached completion, every token with the seconds since the first token it arrived at
+CachedCompletion = List[Tuple[GeneratedToken, float]]
+
+class CompletionCache:
+    '''
+    Caches the full token stream of completed requests, probabilities included, in a memory LRU backed by a directory on disk
+    Entries are keyed by InferenceRequest.key
+    Replaying a hit at replay_speed 1 keeps the pace of the original stream, 2 is twice as fast and 0 sends everything at once
+    The disk tier drops the least recently used entries once it grows past disk_budget_mb
+    '''
+    def __init__(
+        self, mode: str = DETERMINISTIC, max_entries: int = 1024, disk_dir: str = None, disk_budget_mb: float = 256, replay_speed: float = 0
+    ):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown completion cache mode {mode}")
+
+        self.mode = mode
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.disk_budget = disk_budget_mb * 1024**2
+        self.replay_speed = replay_speed
+        self.entries = OrderedDict()
+        # key -> size of the file, least recently used first
+        self.disk_entries = OrderedDict()
+        self.disk_size = 0
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.__scan_disk__()
+
+    def __scan_disk__(self):
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-len(".json")], stat.st_size))
+
+        for _, key, size in sorted(files):
+            self.disk_entries[key] = size
+            self.disk_size += size
+        logger.info(f"Found {len(self.disk_entries)} cached completions on disk ({self.disk_size / 1024**2:.1f}MB)")
+
+    def accepts(self, deterministic: bool) -> bool:
+        '''
+        Whether a request is cached, in deterministic mode only requests its backend decodes greedily are
+        '''
+        return self.mode == ALL or (self.mode == DETERMINISTIC and deterministic)
+
+    def __path__(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[CachedCompletion]:
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return self.entries[key]
+
+            on_disk = key in self.disk_entries
+
+        completion = self.__read__(key) if on_disk else None
+        with self._lock:
+            if completion is None:
+                self.misses += 1
+                return None
+
+            self.disk_hits += 1
+            if key in self.disk_entries:
+                self.disk_entries.move_to_end(key)
+            self.__remember__(key, completion)
+
+        try:
+            # keeps the least recently used order across restarts
+            os.utime(self.__path__(key))
+        except OSError:
+            pass
+        return completion
+
+    def put(self, key: str, completion: CachedCompletion):
+        with self._lock:
+            self.stores += 1
+            self.__remember__(key, completion)
+
+        if self.disk_dir is not None:
+            self.__write__(key, completion)
+
+    def __remember__(self, key: str, completion: CachedCompletion):
+        self.entries[key] = completion
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def __read__(self, key: str) -> Optional[CachedCompletion]:
+        try:
+            with open(self.__path__(key), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read cached completion {key}: {e}")
+            with self._lock:
+                self.disk_size -= self.disk_entries.pop(key, 0)
+            return None
+
+        return [
+            (
+                GeneratedToken(
+                    token,
+                    probability=probability,
+                    top_n_distribution=None if distribution is None else ProablityDistribution(**distribution)
+                ),
+                offset
+            )
+            for token, probability, distribution, offset in data
+        ]
+
+    def __write__(self, key: str, completion: CachedCompletion):
+        data = [
+            [
+                generated.token,
+                generated.probability,
+                None if generated.top_n_distribution is None else asdict(generated.top_n_distribution),
+                offset
+            ]
+            for generated, offset in completion
+        ]
+
+        # written next to the final file and moved in place, a crash never leaves a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(temp_path, self.__path__(key))
+        except OSError as e:
+            logger.warning(f"Could not write cached completion {key}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        size = os.path.getsize(self.__path__(key))
+        with self._lock:
+            self.disk_size += size - self.disk_entries.pop(key, 0)
+            self.disk_entries[key] = size
+
+            evicted = []
+            while self.disk_size > self.disk_budget and len(self.disk_entries) > 1:
+                evicted_key, evicted_size = self.disk_entries.popitem(last=False)
+                self.disk_size -= evicted_size
+                evicted.append(evicted_key)
+
+        for evicted_key in evicted:
+            try:
+                os.remove(self.__path__(evicted_key))
+            except OSError:
+                pass
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "mode": self.mode,
+                "entries": len(self.entries),
+                "maxEntries": self.max_entries,
+                "diskEntries": len(self.disk_entries),
+                "diskMB": round(self.disk_size / 1024**2, 3),
+                "memoryHits": self.memory_hits,
+                "diskHits": self.disk_hits,
+                "misses": self.misses,
+                "hitRate": round(hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
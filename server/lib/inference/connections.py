@@ -0,0 +1,81 @@
+import logging
+import requests
+import threading
+
+from requests.adapters import HTTPAdapter
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+class ConnectionPool:
+    '''
+    Keeps one pooled, keep-alive HTTP session (or SDK client) per provider and API key
+    so that consecutive requests to a provider reuse TCP and TLS connections
+    '''
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 32, timeout: float = 60):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.sessions = {}
+        self.clients = {}
+        self._lock = threading.Lock()
+
+    def __mount__(self, session: requests.Session, max_retries=0) -> requests.Session:
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=max_retries,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get_session(self, provider: str, api_key: str = None) -> requests.Session:
+        key = (provider, api_key)
+        with self._lock:
+            if key not in self.sessions:
+                logger.info(f"Creating HTTP session for {provider}")
+                self.sessions[key] = self.__mount__(requests.Session())
+            return self.sessions[key]
+
+    def get_client(self, provider: str, api_key: str, factory: Callable, session_attribute: str = None):
+        '''
+        Returns the cached SDK client for provider and API key, creating it with factory on first use
+        session_attribute names the requests.Session the client keeps, it is then pooled and reported as well
+        '''
+        key = (provider, api_key)
+        with self._lock:
+            if key not in self.clients:
+                logger.info(f"Creating client for {provider}")
+                client = factory()
+                if session_attribute is not None:
+                    session = getattr(client, session_attribute)
+                    adapter = session.get_adapter("https://")
+                    self.__mount__(session, max_retries=adapter.max_retries)
+                    self.sessions[(provider, api_key, session_attribute)] = session
+                self.clients[key] = client
+            return self.clients[key]
+
+    def get_stats(self) -> dict:
+        stats = {}
+        with self._lock:
+            sessions = list(self.sessions.items())
+
+        for key, session in sessions:
+            provider = key[0]
+            provider_stats = stats.setdefault(provider, {"sessions": 0, "connections": 0, "requests": 0, "reused": 0})
+            provider_stats["sessions"] += 1
+
+            adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+            for adapter in adapters.values():
+                for pool_key in adapter.poolmanager.pools.keys():
+                    try:
+                        pool = adapter.poolmanager.pools[pool_key]
+                    except KeyError:
+                        continue
+                    provider_stats["connections"] += pool.num_connections
+                    provider_stats["requests"] += pool.num_requests
+
+            provider_stats["reused"] = provider_stats["requests"] - provider_stats["connections"]
+
+        return stats
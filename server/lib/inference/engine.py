@@ -0,0 +1,127 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Callable, List
+from . import InferenceAnnouncer, InferenceRequest, InferenceResult
+from .providers import ProviderRegistry
+
+logger = logging.getLogger(__name__)
+
+class ProviderLimiter:
+    '''
+    Caps the tasks running against one provider, unbounded when max_concurrency is None
+    Only used from the engine loop thread
+    '''
+    def __init__(self, max_concurrency: int = None):
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self.active = 0
+        self.waiting = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.semaphore is not None:
+            self.waiting += 1
+            try:
+                await self.semaphore.acquire()
+            finally:
+                self.waiting -= 1
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if self.semaphore is not None:
+                self.semaphore.release()
+
+    def get_stats(self) -> dict:
+        return {"active": self.active, "waiting": self.waiting, "maxConcurrency": self.max_concurrency}
+
+class InferenceEngine:
+    '''
+    Runs inference requests as coroutines on one shared event loop thread
+    The blocking provider streams run on a bounded executor shared by every request,
+    local generation runs on its own, smaller executor
+    Each provider is further limited to the max_concurrency of its backend capabilities, requests over it wait their turn
+    '''
+    def __init__(
+        self, text_generation: Callable[[InferenceRequest], None], announcer: InferenceAnnouncer,
+        providers: ProviderRegistry = None, max_remote_workers: int = 32, max_local_workers: int = 8
+    ):
+        self.text_generation = text_generation
+        self.announcer = announcer
+        self.providers = providers if providers is not None else ProviderRegistry()
+        self.remote_executor = ThreadPoolExecutor(max_workers=max_remote_workers, thread_name_prefix="remote-inference")
+        self.local_executor = ThreadPoolExecutor(max_workers=max_local_workers, thread_name_prefix="local-inference")
+        self.max_remote_workers = max_remote_workers
+        self.max_local_workers = max_local_workers
+
+        self.active_requests = 0
+        self.active_tasks = 0
+        self.completed_requests = 0
+        self.limiters = {}
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.__run_loop__, name="inference-engine", daemon=True)
+        self.thread.start()
+
+    def __run_loop__(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, tasks: List[InferenceRequest]) -> concurrent.futures.Future:
+        '''
+        Schedules all tasks of a request, the returned future resolves once "done" has been announced
+        '''
+        return asyncio.run_coroutine_threadsafe(self.__run_request__(tasks), self.loop)
+
+    async def __run_request__(self, tasks: List[InferenceRequest]):
+        self.active_requests += 1
+        try:
+            results = await asyncio.gather(*(self.__run_task__(task) for task in tasks), return_exceptions=True)
+            for task, result in zip(tasks, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Inference for {task.model_name} on {task.model_provider} failed: {result}")
+        finally:
+            self.active_requests -= 1
+            self.completed_requests += 1
+            # every task has returned, so a cancelled request has freed its upstream resources by now
+            self.announcer.release(tasks[0].uuid)
+            self.announcer.announce(InferenceResult(
+                uuid=tasks[0].uuid,
+                model_name=None,
+                model_tag=None,
+                model_provider=None,
+                token=None,
+                probability=None,
+                top_n_distribution=None
+            ), event="done")
+
+    async def __run_task__(self, task: InferenceRequest):
+        capabilities = self.providers.get_capabilities(task.model_provider)
+        executor = self.local_executor if capabilities.local else self.remote_executor
+
+        if task.model_provider not in self.limiters:
+            self.limiters[task.model_provider] = ProviderLimiter(capabilities.max_concurrency)
+
+        self.active_tasks += 1
+        try:
+            async with self.limiters[task.model_provider].slot():
+                await self.loop.run_in_executor(executor, self.text_generation, task)
+        finally:
+            self.active_tasks -= 1
+
+    def get_stats(self) -> dict:
+        return {
+            "activeRequests": self.active_requests,
+            "activeTasks": self.active_tasks,
+            "completedRequests": self.completed_requests,
+            "maxRemoteWorkers": self.max_remote_workers,
+            "maxLocalWorkers": self.max_local_workers,
+            "providers": {provider: limiter.get_stats() for provider, limiter in list(self.limiters.items())},
+        }
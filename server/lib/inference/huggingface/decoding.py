@@ -0,0 +1,300 @@
+import logging
+import torch
+
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+from ..cancellation import CancellationToken
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class SamplingParams:
+    '''
+    Args:
+        temperature (float): logits are divided by it before sampling
+        top_k (int): only the top_k most likely tokens are sampled from, 0 keeps every token and 1 decodes greedily
+        top_p (float): only the smallest set of most likely tokens whose probabilities add up to top_p is sampled from
+        repetition_penalty (float): logits of tokens already in the prompt or the completion are scaled down by it
+        num_beams (int): hypotheses kept by beam search, 1 samples a single sequence
+        logprobs (int): most likely alternatives reported with every token, 0 reports no probabilities
+    '''
+    temperature: float = 1.0
+    top_k: int = 0
+    top_p: float = 1.0
+    repetition_penalty: float = 1.0
+    num_beams: int = 1
+    logprobs: int = 0
+
+    @property
+    def greedy(self) -> bool:
+        return self.top_k == 1 or self.temperature <= 0
+
+@dataclass
+class DecodedToken:
+    '''
+    Args:
+        token_id (int): generated token
+        logprob (float): log probability of the token, None unless logprobs were asked for
+        top_logprobs (list): (token id, log probability) of the most likely alternatives, most likely first
+    '''
+    token_id: int
+    logprob: Optional[float] = None
+    top_logprobs: Optional[List[Tuple[int, float]]] = None
+
+def apply_repetition_penalty(logits: torch.Tensor, seen: torch.Tensor, penalties: torch.Tensor) -> torch.Tensor:
+    '''
+    Penalizes the tokens marked in seen ([batch, vocab]), penalties holds one value per row ([batch, 1])
+    '''
+    penalized = torch.where(logits < 0, logits * penalties, logits / penalties)
+    return torch.where(seen, penalized, logits)
+
+def filter_logits(logits: torch.Tensor, top_k: List[int], top_p: List[float]) -> torch.Tensor:
+    '''
+    Masks every token outside the top k and then outside the top p of each row with -inf, k and p are per row
+    The vocabulary is only sorted when a row keeps every token, otherwise only the top k are looked at
+    '''
+    vocab_size = logits.shape[-1]
+    top_k = [k if 0 < k < vocab_size else vocab_size for k in top_k]
+
+    if all(p >= 1.0 for p in top_p):
+        if all(k == vocab_size for k in top_k):
+            return logits
+        values = logits.topk(max(top_k), dim=-1).values
+        kth = values.gather(1, torch.tensor(top_k, device=logits.device)[:, None] - 1)
+        return logits.masked_fill(logits < kth, float("-inf"))
+
+    if all(k < vocab_size for k in top_k):
+        sorted_logits, sorted_ids = logits.topk(max(top_k), dim=-1)
+    else:
+        sorted_logits, sorted_ids = logits.sort(dim=-1, descending=True)
+    ranks = torch.arange(sorted_logits.shape[-1], device=logits.device)[None, :]
+    sorted_logits = sorted_logits.masked_fill(ranks >= torch.tensor(top_k, device=logits.device)[:, None], float("-inf"))
+
+    probs = sorted_logits.softmax(dim=-1)
+    # the most likely token is always kept, its preceding mass is 0
+    outside = probs.cumsum(dim=-1) - probs > torch.tensor(top_p, device=logits.device)[:, None]
+    sorted_logits = sorted_logits.masked_fill(outside, float("-inf"))
+    return torch.full_like(logits, float("-inf")).scatter(1, sorted_ids, sorted_logits)
+
+def decoded_tokens(logits: Optional[torch.Tensor], next_tokens: torch.Tensor, sampling: List[SamplingParams]) -> List[DecodedToken]:
+    '''
+    Wraps the chosen token of every row, with its log probability and alternatives for the rows that asked for them
+    Only the probabilities that are reported are normalized, the full log softmax is never materialized
+    '''
+    token_ids = next_tokens.tolist()
+    top = max(params.logprobs for params in sampling)
+    if logits is None or top == 0:
+        return [DecodedToken(token_id) for token_id in token_ids]
+
+    normalizer = logits.logsumexp(dim=-1, keepdim=True)
+    chosen = (logits.gather(1, next_tokens[:, None]) - normalizer)[:, 0].tolist()
+    top_values, top_ids = logits.topk(top, dim=-1)
+    top_values, top_ids = (top_values - normalizer).tolist(), top_ids.tolist()
+
+    return [
+        DecodedToken(token_id, chosen[i], list(zip(top_ids[i][:params.logprobs], top_values[i][:params.logprobs])))
+        if params.logprobs else DecodedToken(token_id)
+        for i, (token_id, params) in enumerate(zip(token_ids, sampling))
+    ]
+
+def select_tokens(
+    logits: torch.Tensor, sampling: List[SamplingParams], seen: torch.Tensor = None, generator: torch.Generator = None
+) -> List[DecodedToken]:
+    '''
+    Picks the next token of every row of logits ([batch, vocab]) with the sampling parameters of that row
+    Greedy rows take the argmax, the others are sampled from their filtered distribution in one multinomial call
+    Reported log probabilities are those of the model after the repetition penalty, before temperature and filtering
+    '''
+    logits = logits.float()
+    if seen is not None:
+        penalties = torch.tensor([params.repetition_penalty for params in sampling], device=logits.device)[:, None]
+        logits = apply_repetition_penalty(logits, seen, penalties)
+
+    next_tokens = logits.argmax(dim=-1)
+    sampled = [i for i, params in enumerate(sampling) if not params.greedy]
+    if sampled:
+        index = torch.tensor(sampled, device=logits.device)
+        rows = [sampling[i] for i in sampled]
+        temperature = torch.tensor([params.temperature for params in rows], device=logits.device)[:, None]
+        filtered = filter_logits(
+            logits.index_select(0, index) / temperature, [params.top_k for params in rows], [params.top_p for params in rows]
+        )
+        choice = torch.multinomial(filtered.softmax(dim=-1), 1, generator=generator)[:, 0]
+        next_tokens = next_tokens.index_copy(0, index, choice)
+
+    return decoded_tokens(logits, next_tokens, sampling)
+
+class ModelRunner:
+    '''
+    Forward passes over copies rows of one prompt with a key/value cache, for decoder-only and encoder-decoder models
+    Every row starts from the same prompt, so reordering the rows only has to reorder the generated ids and the cache
+    '''
+    def __init__(self, model, input_ids: List[int], copies: int = 1):
+        self.model = model
+        self.past = None
+        self.model_kwargs = {}
+
+        prompt = torch.tensor([input_ids] * copies, dtype=torch.long, device=model.device)
+        attention_mask = torch.ones_like(prompt)
+        if model.config.is_encoder_decoder:
+            with torch.inference_mode():
+                encoder_outputs = model.get_encoder()(input_ids=prompt, attention_mask=attention_mask, return_dict=True)
+            self.model_kwargs = {"encoder_outputs": encoder_outputs, "attention_mask": attention_mask}
+            start_token_id = model.generation_config.decoder_start_token_id
+            if start_token_id is None:
+                start_token_id = model.config.decoder_start_token_id
+            self.input_ids = torch.full((copies, 1), start_token_id, dtype=torch.long, device=model.device)
+        else:
+            self.input_ids = prompt
+            self.model_kwargs = {"attention_mask": attention_mask}
+
+    def step(self, next_tokens: torch.Tensor = None) -> torch.Tensor:
+        '''
+        Appends next_tokens ([rows]) and returns the logits ([rows, vocab]) of the token after them
+        '''
+        if next_tokens is not None:
+            self.input_ids = torch.cat([self.input_ids, next_tokens[:, None]], dim=-1)
+            if not self.model.config.is_encoder_decoder:
+                attention_mask = self.model_kwargs["attention_mask"]
+                self.model_kwargs["attention_mask"] = torch.cat([attention_mask, attention_mask[:, -1:]], dim=-1)
+
+        model_inputs = self.model.prepare_inputs_for_generation(
+            self.input_ids, past_key_values=self.past, use_cache=True, **self.model_kwargs
+        )
+        outputs = self.model(**model_inputs, return_dict=True)
+        self.past = outputs.past_key_values
+        return outputs.logits[:, -1, :]
+
+    def reorder(self, index: torch.Tensor):
+        self.input_ids = self.input_ids.index_select(0, index)
+        self.past = tuple(tuple(tensor.index_select(0, index) for tensor in layer) for layer in self.past)
+
+def mark_seen(input_ids: torch.Tensor, vocab_size: int) -> torch.Tensor:
+    return torch.zeros((input_ids.shape[0], vocab_size), dtype=torch.bool, device=input_ids.device).scatter_(1, input_ids, True)
+
+def decode(
+    model, input_ids: List[int], sampling: SamplingParams, max_new_tokens: int, eos_token_ids: List[int],
+    cancellation: CancellationToken = None
+) -> Iterator[DecodedToken]:
+    '''
+    Streams the tokens generated for one prompt, greedily, sampled or with beam search when sampling.num_beams is over 1
+    The end of sequence token is streamed too, cancelling stops before the next forward pass
+    '''
+    if sampling.num_beams > 1:
+        yield from beam_search(model, input_ids, sampling, max_new_tokens, eos_token_ids, cancellation)
+        return
+
+    runner = ModelRunner(model, input_ids)
+    seen = None
+    next_tokens = None
+    for _ in range(max_new_tokens):
+        if cancellation is not None and cancellation.cancelled:
+            return
+
+        with torch.inference_mode():
+            logits = runner.step(next_tokens)
+            if sampling.repetition_penalty != 1.0:
+                seen = mark_seen(runner.input_ids, logits.shape[-1]) if seen is None else seen
+            decoded = select_tokens(logits, [sampling], seen)[0]
+            next_tokens = torch.tensor([decoded.token_id], dtype=torch.long, device=model.device)
+            if seen is not None:
+                seen[0, decoded.token_id] = True
+
+        yield decoded
+        if decoded.token_id in eos_token_ids:
+            return
+
+def common_prefix_length(hypotheses: List[List[DecodedToken]]) -> int:
+    length = min(len(hypothesis) for hypothesis in hypotheses)
+    for i in range(length):
+        token_id = hypotheses[0][i].token_id
+        if any(hypothesis[i].token_id != token_id for hypothesis in hypotheses):
+            return i
+    return length
+
+def beam_search(
+    model, input_ids: List[int], sampling: SamplingParams, max_new_tokens: int, eos_token_ids: List[int],
+    cancellation: CancellationToken = None
+) -> Iterator[DecodedToken]:
+    '''
+    Keeps the num_beams most likely hypotheses, ranked by their summed log probability divided by their length
+    A token is streamed once every hypothesis that can still win agrees on it, the rest of the best one when the search ends
+    '''
+    num_beams = sampling.num_beams
+    runner = ModelRunner(model, input_ids, copies=num_beams)
+    device = model.device
+
+    # the rows start out identical, only the first one is expanded at the first step
+    scores = torch.full((num_beams,), float("-inf"), device=device)
+    scores[0] = 0.0
+    beams: List[List[DecodedToken]] = [[] for _ in range(num_beams)]
+    beam_scores: List[float] = []
+    finished: List[Tuple[float, List[DecodedToken]]] = []
+    seen = None
+    next_tokens = None
+    sent = 0
+
+    for step in range(max_new_tokens):
+        if cancellation is not None and cancellation.cancelled:
+            return
+
+        with torch.inference_mode():
+            logits = runner.step(next_tokens).float()
+            if sampling.repetition_penalty != 1.0:
+                seen = mark_seen(runner.input_ids, logits.shape[-1]) if seen is None else seen
+                penalties = torch.full((num_beams, 1), sampling.repetition_penalty, device=device)
+                logits = apply_repetition_penalty(logits, seen, penalties)
+
+            logprobs = logits.log_softmax(dim=-1)
+            vocab_size = logprobs.shape[-1]
+            top_scores, top_index = (scores[:, None] + logprobs).view(-1).topk(2 * num_beams)
+            beam_index, token_ids = top_index // vocab_size, top_index % vocab_size
+            decoded = decoded_tokens(logprobs[beam_index] if sampling.logprobs else None, token_ids, [sampling] * len(token_ids))
+
+        live, live_scores, keep = [], [], []
+        for score, beam, token in zip(top_scores.tolist(), beam_index.tolist(), decoded):
+            if score == float("-inf"):
+                break
+            hypothesis = beams[beam] + [token]
+            if token.token_id in eos_token_ids:
+                finished.append((score / len(hypothesis), hypothesis))
+            else:
+                live.append(hypothesis)
+                live_scores.append(score)
+                keep.append(beam)
+                if len(live) == num_beams:
+                    break
+
+        finished = sorted(finished, key=lambda item: item[0], reverse=True)[:num_beams]
+        beams, beam_scores = live, live_scores
+        if not live:
+            break
+        # a finished hypothesis stays ahead of the live ones once no live one can catch up with the worst of them
+        if len(finished) == num_beams and finished[-1][0] >= max(live_scores) / (step + 1):
+            break
+
+        contenders = live + [hypothesis for _, hypothesis in finished]
+        stable = common_prefix_length(contenders)
+        yield from live[0][sent:stable]
+        sent = max(sent, stable)
+
+        # fewer live hypotheses than beams are padded with copies that can never be picked
+        while len(live) < num_beams:
+            live.append(live[-1])
+            live_scores.append(float("-inf"))
+            keep.append(keep[-1])
+
+        with torch.inference_mode():
+            scores = torch.tensor(live_scores, device=device)
+            index = torch.tensor(keep, dtype=torch.long, device=device)
+            runner.reorder(index)
+            next_tokens = torch.tensor([hypothesis[-1].token_id for hypothesis in live], dtype=torch.long, device=device)
+            if seen is not None:
+                seen = seen.index_select(0, index)
+                seen[torch.arange(num_beams, device=device), next_tokens] = True
+
+    candidates = finished + [
+        (score / len(hypothesis), hypothesis) for score, hypothesis in zip(beam_scores, beams) if score != float("-inf")
+    ]
+    if candidates:
+        yield from max(candidates, key=lambda item: item[0])[1][sent:]
@@ -0,0 +1,70 @@
+import logging
+
+from typing import List
+from transformers import PreTrainedTokenizerBase
+
+logger = logging.getLogger(__name__)
+
+# tokens of the prompt decoded along with the first generated ones, so that leading spaces come out right
+PROMPT_CONTEXT = 5
+
+class IncrementalDetokenizer:
+    '''
+    Turns generated token ids into text for any tokenizer by decoding a short window of ids instead of single tokens
+    The window starts at prefix_offset, the text of the ids up to read_offset has already been sent
+    Text ending in an incomplete UTF-8 sequence (U+FFFD) is held back until the tokens completing it arrive
+    Every token decodes a window of a few ids, no matter how long the completion gets
+    '''
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, prompt_ids: List[int] = None, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = list(prompt_ids or [])
+        self.prefix_offset = max(len(self.token_ids) - PROMPT_CONTEXT, 0)
+        self.read_offset = len(self.token_ids)
+        self.prefix_text = self.__decode__(self.prefix_offset, self.read_offset)
+        # a context decoding to nothing, like part of a character, cannot show whether the next token starts a word
+        while self.prefix_offset > 0 and (not self.prefix_text or self.prefix_text.endswith("�")):
+            self.prefix_offset = max(self.prefix_offset - PROMPT_CONTEXT, 0)
+            self.prefix_text = self.__decode__(self.prefix_offset, self.read_offset)
+        del self.token_ids[:self.prefix_offset]
+        self.read_offset -= self.prefix_offset
+        self.prefix_offset = 0
+        self.generated = 0
+
+    def __decode__(self, start: int, end: int = None) -> str:
+        return self.tokenizer.decode(
+            self.token_ids[start:end], skip_special_tokens=self.skip_special_tokens, clean_up_tokenization_spaces=False
+        )
+
+    def add(self, token_id: int) -> str:
+        '''
+        Adds a generated token, returns the text it completes, empty while that text is not stable yet
+        '''
+        self.token_ids.append(token_id)
+        self.generated += 1
+
+        text = self.__decode__(self.prefix_offset)
+        if len(text) <= len(self.prefix_text) or text.endswith("�"):
+            return ""
+
+        new_text = text[len(self.prefix_text):]
+        # the next window starts where this one stopped being sent
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self.prefix_text = self.__decode__(self.prefix_offset, self.read_offset)
+        # forgets the ids before the window
+        del self.token_ids[:self.prefix_offset]
+        self.read_offset -= self.prefix_offset
+        self.prefix_offset = 0
+        return new_text
+
+    def flush(self) -> str:
+        '''
+        Text held back at the end of the completion, an incomplete UTF-8 sequence included
+        '''
+        text = self.__decode__(self.prefix_offset)
+        if len(text) <= len(self.prefix_text):
+            return ""
+
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.token_ids)
+        return text[len(self.prefix_text):]
@@ -1,11 +0,0 @@
-from transformers import StoppingCriteria
-import torch
-
-class StoppingCriteriaSub(StoppingCriteria):
-    def __init__(self, stops = []):
-      StoppingCriteria.__init__(self), 
-
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, stops = []):
-      self.stops = stops
-      for i in range(len(stops)):
-        self.stops = self.stops[i]
\ No newline at end of file
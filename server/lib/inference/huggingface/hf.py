@@ -1,17 +1,26 @@
 import os
-import transformers
 import psutil
+import threading
+import time
 import torch
 import importlib
 import logging
-import warnings
 
+from typing import List
 from transformers import AutoTokenizer, AutoConfig, PreTrainedModel, PreTrainedTokenizer, AutoModelForCausalLM
-from .generator import greedy_search_generator
-from .helpers import StoppingCriteriaSub
+from transformers.models.auto.modeling_auto import MODEL_FOR_CAUSAL_LM_MAPPING
+from .decoding import DecodedToken, SamplingParams, decode
+from .detokenizer import IncrementalDetokenizer
+from .load_modes import BF16, DEFAULT, INT8, MMAP
+from .loading import (
+    MappedSafetensors, load_skeleton, quantize_int8, read_safetensors, release_memory, safetensors_files, tensors_size_mb
+)
+from .scheduler import BatchScheduler, supports_batching
+from .stop_sequences import StopSequences
+from ..cancellation import CancellationToken
+from ..providers import GeneratedToken
+from ..providers.helpers import top_n_distribution
 
-# monkey patch for transformers
-transformers.generation.utils.GenerationMixin.greedy_search = greedy_search_generator
 os.environ['TOKENIZERS_PARALLELISM'] = 'true'
 
 # Set constants
@@ -20,48 +29,117 @@ DEVICE = "cuda" if torch.cuda.is_available() else "cpu" # support gpu inference
 
 logger = logging.getLogger(__name__)
 
+def device_memory_mb() -> float:
+    '''
+    Total memory of the device used for inference in MB
+    '''
+    if DEVICE == 'cuda':
+        return torch.cuda.get_device_properties(0).total_memory / 1024**2
+    return psutil.virtual_memory().total / 1024**2
+
 class HFInference:
     '''
     Class for huggingface local inference
+    load_mode is one of load_modes.LOAD_MODES, see load_model
     '''
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, max_batch_size: int = 8, prefix_cache=None, load_mode: str = DEFAULT):
         self.model_name = model_name
+        self.load_mode = load_mode
+        # identifies the model in caches shared by every load mode
+        self.key = f"{model_name}:{load_mode}"
+        self.size_mb = 0
+        # safetensors files the weights are mapped from in the mmap mode, and the memory of the other tensors
+        self.mapped = None
+        self.unmapped_mb = 0.0
+        self.load_seconds = 0.0
+        self.load_rss_mb = 0.0
+        self.generated_tokens = 0
+        self.generation_seconds = 0.0
+        self._lock = threading.Lock()
+
+        start, rss = time.perf_counter(), psutil.Process().memory_info().rss
         self.model, self.tokenizer = self.load_model(model_name)
+        self.load_seconds = time.perf_counter() - start
+        # approximate, other threads allocate meanwhile too
+        self.load_rss_mb = (psutil.Process().memory_info().rss - rss) / 1024**2
+        self.scheduler = None
+
+        eos_token_id = self.model.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+        self.eos_token_ids = [] if eos_token_id is None else eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+
+        if max_batch_size > 1 and supports_batching(self.model):
+            self.scheduler = BatchScheduler(
+                self.model, self.eos_token_ids, max_batch_size=max_batch_size, model_name=self.key, prefix_cache=prefix_cache
+            )
 
     # Helper function to load model from transformers library
     def load_model(self, model_name: str) -> (PreTrainedModel, PreTrainedTokenizer):
         '''
         Load model from transformers library
         dynamically instantiates the right model class for text generation from model config architecture
+        Other load modes than the default build the model without parameters and assign the tensors of its safetensors
+        files to it one at a time, cast to bfloat16 for bf16 and followed by int8 dynamic quantization for int8
+        mmap leaves the weights in the mapped files as they are stored, see loading.MappedSafetensors, files it cannot
+        map, like float16 weights, are loaded as in low_cpu_mem
+        Models without safetensors files are loaded with from_pretrained instead
         '''
         tokenizer = AutoTokenizer.from_pretrained(model_name)
         config = AutoConfig.from_pretrained(model_name) # load config for model
         if config.architectures:
             model_classname = config.architectures[0]
             model_class = getattr(MODULE, model_classname) # get model class from config
-            model = model_class.from_pretrained(model_name, config=config) # dynamically load right model class for text generation
         else:
-            model = AutoModelForCausalLM.from_pretrained(model_name, device_map='auto' if DEVICE == 'cuda' else None)
+            model_class = AutoModelForCausalLM
 
-        param_size = sum(
-            param.nelement() * param.element_size() for param in model.parameters()
-        )
-        buffer_size = sum(
-            buffer.nelement() * buffer.element_size() for buffer in model.buffers()
-        )
-        size_all_mb = (param_size + buffer_size) / 1024**2
-        logger.info('model size: {:.3f}MB'.format(size_all_mb))
+        load_mode = self.load_mode
+        if load_mode in (INT8, MMAP) and DEVICE != 'cpu':
+            logger.warning(f"The {load_mode} load mode only runs on CPU, loading {model_name} in the default mode")
+            load_mode = DEFAULT
+        dtype = torch.bfloat16 if load_mode == BF16 else torch.float32
 
-        if DEVICE == 'cuda':
-            device_memory = torch.cuda.get_device_properties(0).total_memory / 1024**2
+        files = safetensors_files(model_name) if load_mode != DEFAULT else None
+        if files:
+            if model_class is AutoModelForCausalLM:
+                model_class = MODEL_FOR_CAUSAL_LM_MAPPING[type(config)]
+            if load_mode == MMAP:
+                try:
+                    self.mapped = MappedSafetensors(files)
+                except ValueError as e:
+                    logger.warning(f"Cannot map the weights of {model_name}, copying them as float32 instead: {e}")
+            if self.mapped is not None:
+                tensors = self.mapped.tensors()
+            else:
+                tensors = read_safetensors(files, dtype)
+            model = load_skeleton(model_name, model_class, config, tensors)
+        elif model_class is not AutoModelForCausalLM:
+            if load_mode != DEFAULT:
+                logger.info(f"{model_name} has no safetensors weights, loading it with from_pretrained")
+            model = model_class.from_pretrained(model_name, config=config, torch_dtype=dtype) # dynamically load right model class for text generation
         else:
-            device_memory = psutil.virtual_memory().total / 1024**2
+            model = AutoModelForCausalLM.from_pretrained(model_name, device_map='auto' if DEVICE == 'cuda' else None, torch_dtype=dtype)
+
+        if load_mode == INT8:
+            model = quantize_int8(model)
+        if load_mode != DEFAULT:
+            release_memory()
+
+        size_all_mb = tensors_size_mb(model)
+        if self.mapped is not None:
+            self.unmapped_mb = tensors_size_mb(model, include=lambda tensor: not self.mapped.contains(tensor))
+        else:
+            self.unmapped_mb = size_all_mb
+        logger.info('model size: {:.3f}MB ({})'.format(size_all_mb, self.load_mode))
+
+        device_memory = device_memory_mb()
 
         logger.info('device memory: {:.3f}MB'.format(device_memory))
 
         if size_all_mb > device_memory * 0.95: #some padding
             raise Exception('Model size is too large for host to run inference on')
 
+        self.size_mb = size_all_mb
         model.to(DEVICE) # gpu inference if possible
         return model, tokenizer
 
@@ -73,64 +151,127 @@ class HFInference:
             top_p: float, 
             repetition_penalty: float, 
             stop_sequences: list = None,
+            cancellation: CancellationToken = None,
+            num_beams: int = 1,
+            logprobs: int = 0,
             **kwargs
         ):
         '''
-        Generate text from prompt, using monkey patched transformers.generation.utils.GenerationMixin.greedy_search
+        Generate text from prompt, yields a GeneratedToken with the log probability and the top logprobs alternatives
+        of every token when logprobs is set
+        Concurrent requests for the same model are decoded in one batch by the BatchScheduler, beam search and
+        models that cannot be batched run their own decode loop
+        Decoding stops within a token of the first stop sequence, which is never sent, nor is anything after it
+        Cancelling stops decoding at the next token
         '''
         inputs_str = prompt.strip()
-        inputs = self.tokenizer(inputs_str, return_tensors="pt")
-        input_ids = inputs['input_ids'].to(DEVICE)
-        attention_mask = inputs['attention_mask'].to(DEVICE)
+        input_ids = self.tokenizer(inputs_str)['input_ids']
+        sampling = SamplingParams(
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            num_beams=num_beams,
+            logprobs=logprobs,
+        )
+
+        if self.scheduler is not None and num_beams == 1:
+            outputs = self.scheduler.submit(input_ids, max_new_tokens=max_length, sampling=sampling)
+            if cancellation is not None:
+                cancellation.on_cancel(outputs.close)
+            decoded = iter(outputs)
+        else:
+            outputs = decode(self.model, input_ids, sampling, max_length, self.eos_token_ids, cancellation)
+            decoded = outputs
+
+        if cancellation is not None:
+            decoded = self.__until_cancelled__(decoded, cancellation)
 
         try:
-            outputs = self.model.generate(inputs=input_ids, 
-                attention_mask=attention_mask, 
-                max_new_tokens=max_length,
-                temperature=temperature,
-                top_k=top_k,
-                top_p=top_p,
-                repetition_penalty=repetition_penalty,
-                early_stopping=False,
-                # stopping_criteria=stopping_criteria if stopping_criteria else None,
-            )
-        except Exception as e:
-            raise Exception(f"Error generating text: {e}")
-
-        curr_token = ""
-        sentence = "<|endoftext|>"
-        first_token = True
-        for output in outputs:
-            next_token = output
-            if len(next_token.size()) > 1: continue # skip the last generated full array
-            if curr := self.tokenizer.convert_ids_to_tokens(
-                next_token, skip_special_tokens=True
-            ):
-                curr = curr[0] # string with special character potentially
-                if (curr[0] == "Ġ"): # BPE tokenizer
-                    curr_token = curr_token.replace("Ċ", "\n")
-                    curr_token = curr.replace("Ġ", " ")
-                    sentence += curr_token # we can yield here/print here
-                    yield curr_token
-                    # BPE
-                elif (curr[0] == "▁"): # sentence piece tokenizer
-                    if first_token:
-                        curr_token = curr.replace("▁", "")
-                        first_token = False
-                    else:
-                        curr_token = curr.replace("▁", " ")
-                    sentence += curr_token # we can yield here/print here
-                    yield curr_token
-                else:
-                    curr_token = curr
-                    curr_token = curr_token.replace("Ċ", "\n")
-                    yield curr_token
-                    sentence += curr_token
-
-                curr_token = ""
-
-        # dispatch last token, if we can
-        if curr_token != "": 
-            yield curr_token # send only if non empty
-
-        logger.info(f'[COMPLETION]: {sentence}')           
+            yield from self.__tokens_to_text__(decoded, input_ids, StopSequences(stop_sequences or []))
+        finally:
+            # raises GeneratorExit inside the decode loop, which stops it right away
+            if hasattr(outputs, "close"):
+                outputs.close()
+
+    def __until_cancelled__(self, decoded, cancellation: CancellationToken):
+        for token in decoded:
+            if cancellation.cancelled:
+                return
+            yield token
+
+    def __generated__(self, text: str, token: DecodedToken) -> GeneratedToken:
+        if token.logprob is None:
+            return GeneratedToken(text)
+
+        alternatives = {}
+        for token_id, logprob in token.top_logprobs:
+            alternatives.setdefault(self.tokenizer.decode([token_id]), logprob)
+        return GeneratedToken(text, probability=token.logprob, top_n_distribution=top_n_distribution(alternatives, text))
+
+    def __tokens_to_text__(self, decoded, prompt_ids: List[int], stop_sequences: StopSequences):
+        detokenizer = IncrementalDetokenizer(self.tokenizer, prompt_ids)
+        start = time.perf_counter()
+        try:
+            yield from self.__detokenize__(decoded, detokenizer, stop_sequences)
+        finally:
+            with self._lock:
+                self.generated_tokens += detokenizer.generated
+                self.generation_seconds += time.perf_counter() - start
+
+    def __detokenize__(self, decoded, detokenizer: IncrementalDetokenizer, stop_sequences: StopSequences):
+        matcher = stop_sequences.matcher() if stop_sequences else None
+        token = None
+        stopped = False
+        for token in decoded:
+            text = detokenizer.add(token.token_id)
+            if matcher is not None and text:
+                text, stopped = matcher.feed(text)
+            if text:
+                yield self.__generated__(text, token)
+            if stopped:
+                break
+        else:
+            # a character still incomplete when generation ends is sent as is
+            text = detokenizer.flush()
+            if matcher is not None:
+                text, stopped = matcher.feed(text)
+                text += matcher.flush()
+            if text:
+                yield self.__generated__(text, token)
+
+        logger.info(f'[COMPLETION]: {detokenizer.generated} tokens{" until a stop sequence" if stopped else ""}')
+
+    def get_stats(self) -> dict:
+        '''
+        Load mode, memory and throughput of the model, tokens per second are measured while streaming completions
+        '''
+        with self._lock:
+            generated_tokens, generation_seconds = self.generated_tokens, self.generation_seconds
+        return {
+            "loadMode": self.load_mode,
+            "sizeMB": round(self.size_mb, 3),
+            "loadSeconds": round(self.load_seconds, 3),
+            "loadRssMB": round(self.load_rss_mb, 3),
+            "memory": self.get_memory_stats(),
+            "generatedTokens": generated_tokens,
+            "tokensPerSecond": round(generated_tokens / generation_seconds, 3) if generation_seconds else 0.0,
+            "batch": self.scheduler.get_stats() if self.scheduler is not None else None,
+        }
+
+    def get_memory_stats(self) -> dict:
+        '''
+        Memory of the model in this process, shared is memory other processes mapping the same files use too
+        Mapped pages only count once they were read, pss splits shared pages between the processes using them
+        '''
+        if self.mapped is None:
+            return {"privateMB": round(self.size_mb, 3), "sharedMB": 0.0, "pssMB": round(self.size_mb, 3)}
+
+        mapped = self.mapped.memory_mb()
+        if mapped is None:
+            return {"privateMB": None, "sharedMB": None, "pssMB": None}
+        return {
+            "privateMB": round(self.unmapped_mb + mapped["privateMB"], 3),
+            "sharedMB": round(mapped["sharedMB"], 3),
+            "pssMB": round(self.unmapped_mb + mapped["pssMB"], 3),
+        }
@@ -0,0 +1,11 @@
+# how the weights of a local model are loaded, set per model with "loadMode" in models.json
+DEFAULT = "default"
+# weights cast to bfloat16, half the memory of float32
+BF16 = "bf16"
+# linear layers dynamically quantized to int8, CPU only
+INT8 = "int8"
+# weights assigned straight from the safetensors file, without a randomly initialized copy next to them while loading
+LOW_CPU_MEM = "low_cpu_mem"
+# weights left in a memory-mapped safetensors file, worker processes loading the same file share its pages
+MMAP = "mmap"
+LOAD_MODES = (DEFAULT, BF16, INT8, LOW_CPU_MEM, MMAP)
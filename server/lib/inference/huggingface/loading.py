@@ -0,0 +1,339 @@
+import ctypes
+import gc
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import torch
+
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from safetensors import safe_open
+from torch.overrides import TorchFunctionMode
+from transformers import GenerationConfig, PretrainedConfig, PreTrainedModel
+from transformers.modeling_utils import no_init_weights
+from transformers.pytorch_utils import Conv1D
+from transformers.utils import CONFIG_NAME, cached_file
+from .load_modes import BF16, INT8, MMAP
+
+logger = logging.getLogger(__name__)
+
+SAFETENSORS_WEIGHTS = "model.safetensors"
+SAFETENSORS_INDEX = "model.safetensors.index.json"
+PYTORCH_WEIGHTS = "pytorch_model.bin"
+PYTORCH_INDEX = "pytorch_model.bin.index.json"
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+# floating point dtypes models run in on CPU
+CPU_DTYPES = (torch.float32, torch.bfloat16)
+
+INIT_FUNCTIONS = {
+    function for name, function in vars(torch.nn.init).items()
+    if callable(function) and name.endswith("_") and not name.startswith("_")
+}
+
+# no_init_weights sets a flag of transformers for the whole process, only one skeleton is built at a time
+_skeleton_lock = threading.Lock()
+
+def weight_files(model_name: str, weights: str, index: str, local_files_only: bool = False) -> Optional[List[str]]:
+    '''
+    Paths of the weights file of a model or of the shards listed in its index, None if it has neither
+    '''
+    options = dict(
+        _raise_exceptions_for_missing_entries=False, _raise_exceptions_for_connection_errors=False,
+        local_files_only=local_files_only
+    )
+    path = cached_file(model_name, weights, **options)
+    if path is not None:
+        return [path]
+
+    index = cached_file(model_name, index, **options)
+    if index is None:
+        return None
+    with open(index, "r") as f:
+        shards = sorted(set(json.load(f)["weight_map"].values()))
+    paths = [cached_file(model_name, shard, **options) for shard in shards]
+    return None if None in paths else paths
+
+def safetensors_files(model_name: str, local_files_only: bool = False) -> Optional[List[str]]:
+    '''
+    Paths of the safetensors weights of a model, from the hub cache or a local directory, None if it has none
+    '''
+    return weight_files(model_name, SAFETENSORS_WEIGHTS, SAFETENSORS_INDEX, local_files_only)
+
+def estimate_size_mb(model_name: str, load_mode: str) -> float:
+    '''
+    Rough memory the model takes once loaded in load_mode, from the size of its weight files and the dtype they are
+    stored in, 0 if they are not downloaded yet
+    '''
+    try:
+        files = (
+            safetensors_files(model_name, local_files_only=True)
+            or weight_files(model_name, PYTORCH_WEIGHTS, PYTORCH_INDEX, local_files_only=True)
+        )
+        if not files:
+            return 0.0
+        size_mb = sum(os.path.getsize(path) for path in files) / 1024**2
+
+        config = cached_file(
+            model_name, CONFIG_NAME, local_files_only=True,
+            _raise_exceptions_for_missing_entries=False, _raise_exceptions_for_connection_errors=False
+        )
+        stored_dtype = None
+        if config is not None:
+            with open(config, "r") as f:
+                stored_dtype = json.load(f).get("torch_dtype")
+    except (OSError, ValueError) as e:
+        # loading the model reports what is wrong with it
+        logger.debug(f"Cannot estimate the size of {model_name}: {e}")
+        return 0.0
+    stored_bytes = 2 if stored_dtype in ("float16", "bfloat16") else 4
+
+    if load_mode == BF16 or (load_mode == MMAP and stored_dtype == "bfloat16"):
+        loaded_bytes = 2
+    elif load_mode == INT8:
+        loaded_bytes = 1
+    else:
+        loaded_bytes = 4
+    return size_mb * loaded_bytes / stored_bytes
+
+class SkipInit(TorchFunctionMode):
+    '''
+    Turns the torch.nn.init functions into no-ops, so layers leave the memory of their parameters untouched
+    Untouched pages are never made resident, the parameters cost address space until the checkpoint replaces them
+    A torch function mode only applies to the thread that entered it, like torch.device
+    '''
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func in INIT_FUNCTIONS:
+            return args[0] if args else kwargs["tensor"]
+        return func(*args, **kwargs)
+
+def read_safetensors(paths: List[str], dtype: torch.dtype = None) -> Iterator[Tuple[str, torch.Tensor]]:
+    '''
+    Reads one tensor at a time, floating point tensors are cast to dtype
+    Every tensor is copied out of the file, safetensors may map it and a tensor left there keeps all of it mapped
+    '''
+    for path in paths:
+        with safe_open(path, framework="pt") as f:
+            for name in f.keys():
+                tensor = f.get_tensor(name)
+                if dtype is not None and tensor.is_floating_point() and tensor.dtype != dtype:
+                    tensor = tensor.to(dtype)
+                else:
+                    tensor = tensor.clone()
+                yield name, tensor
+
+class MappedSafetensors:
+    '''
+    Safetensors files mapped into memory, their tensors are views of the mapping and are never copied
+    The mapping is copy-on-write: pages are read from the OS page cache, so every process mapping the same file
+    shares them, and a page written to becomes private to the process instead of changing the file
+    Raises ValueError for files that cannot be used as they are, see __validate__
+    '''
+    def __init__(self, paths: List[str]):
+        self.paths = [os.path.realpath(path) for path in paths]
+        self.maps = []
+        # (name, dtype, shape, offset in the mapping) of the tensors of every mapping
+        self.entries = []
+        try:
+            for path in self.paths:
+                with open(path, "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+                self.maps.append(mapped)
+                self.entries.append(self.__validate__(path, mapped))
+        except ValueError:
+            self.close()
+            raise
+
+        # address ranges of the mappings, to tell mapped tensors apart from the others
+        self.ranges = []
+        for mapped in self.maps:
+            start = torch.frombuffer(mapped, dtype=torch.uint8, count=1).data_ptr()
+            self.ranges.append((start, start + len(mapped)))
+
+    def __validate__(self, path: str, mapped: mmap.mmap) -> List[Tuple[str, torch.dtype, List[int], int]]:
+        '''
+        Floating point weights have to be float32 or bfloat16, float16 matmuls and layer norms do not run on CPU,
+        and every tensor has to start at a multiple of its element size to be viewed in place
+        '''
+        header_size, = struct.unpack("<Q", mapped[:8])
+        header = json.loads(mapped[8:8 + header_size])
+        header.pop("__metadata__", None)
+
+        entries = []
+        for name, entry in header.items():
+            dtype = SAFETENSORS_DTYPES.get(entry["dtype"])
+            if dtype is None:
+                raise ValueError(f"{name} in {path} has unsupported dtype {entry['dtype']}")
+            if dtype.is_floating_point and dtype not in CPU_DTYPES:
+                raise ValueError(f"{name} in {path} is stored as {dtype}, which does not run on CPU")
+
+            start, end = entry["data_offsets"]
+            offset = 8 + header_size + start
+            element_size = torch.empty((), dtype=dtype).element_size()
+            if end - start != math.prod(entry["shape"]) * element_size or 8 + header_size + end > len(mapped):
+                raise ValueError(f"{name} in {path} has offsets that do not match its shape")
+            if offset % element_size:
+                raise ValueError(f"{name} in {path} is not aligned to its {element_size} byte elements")
+            entries.append((name, dtype, entry["shape"], offset))
+        return entries
+
+    def tensors(self) -> Iterator[Tuple[str, torch.Tensor]]:
+        for mapped, entries in zip(self.maps, self.entries):
+            for name, dtype, shape, offset in entries:
+                count = math.prod(shape)
+                if count == 0:
+                    yield name, torch.empty(shape, dtype=dtype)
+                    continue
+                tensor = torch.frombuffer(mapped, dtype=dtype, count=count, offset=offset)
+                yield name, tensor.view(shape)
+
+    def close(self):
+        '''
+        Unmaps the files, only possible while no tensor views them
+        '''
+        for mapped in self.maps:
+            mapped.close()
+        self.maps = []
+
+    def contains(self, tensor: torch.Tensor) -> bool:
+        return any(start <= tensor.data_ptr() < end for start, end in self.ranges)
+
+    def memory_mb(self) -> Optional[Dict[str, float]]:
+        '''
+        Resident, shared and private memory of the mappings in this process, read from /proc/self/smaps
+        Pss splits shared pages evenly between the processes mapping them, None where smaps is not available
+        '''
+        fields = {"Rss": 0, "Pss": 0, "Shared_Clean": 0, "Shared_Dirty": 0, "Private_Clean": 0, "Private_Dirty": 0}
+        try:
+            with open("/proc/self/smaps", "r") as f:
+                mapped = False
+                for line in f:
+                    if line[0] in "0123456789abcdef":
+                        # mapping header, "start-end perms offset dev inode path", fields start with a capital
+                        parts = line.split(None, 5)
+                        mapped = len(parts) == 6 and parts[5].rstrip("\n") in self.paths
+                        continue
+                    key, _, value = line.partition(":")
+                    if mapped and key in fields:
+                        fields[key] += int(value.split()[0])
+        except OSError:
+            return None
+        return {
+            "rssMB": fields["Rss"] / 1024,
+            "pssMB": fields["Pss"] / 1024,
+            "sharedMB": (fields["Shared_Clean"] + fields["Shared_Dirty"]) / 1024,
+            "privateMB": (fields["Private_Clean"] + fields["Private_Dirty"]) / 1024,
+        }
+
+def assign_tensors(model: PreTrainedModel, tensors: Iterator[Tuple[str, torch.Tensor]]):
+    '''
+    Puts checkpoint tensors in place of the parameters and buffers of the model, as they are without copying them
+    Checkpoints saved from the base model lack its prefix, those saved from a head model may have one too many
+    '''
+    prefix = f"{model.base_model_prefix}."
+    targets = {name: name for name, _ in model.named_parameters(remove_duplicate=False)}
+    targets.update({name: name for name, _ in model.named_buffers(remove_duplicate=False)})
+    for name in list(targets):
+        if name.startswith(prefix):
+            targets.setdefault(name[len(prefix):], name)
+        else:
+            targets.setdefault(prefix + name, name)
+
+    for checkpoint_name, tensor in tensors:
+        name = targets.get(checkpoint_name)
+        if name is None:
+            continue
+        module_name, _, leaf = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if leaf in module._parameters:
+            module._parameters[leaf] = torch.nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[leaf] = tensor
+
+def load_skeleton(model_name: str, model_class: type, config: PretrainedConfig, tensors: Iterator[Tuple[str, torch.Tensor]]) -> PreTrainedModel:
+    '''
+    Builds the model without initializing its parameters and replaces them with the checkpoint tensors
+    The model is not built on the meta device, buffers left out of checkpoints, like causal masks, are computed
+    while building it and would stay empty there
+    '''
+    with _skeleton_lock, SkipInit(), no_init_weights():
+        model = model_class(config)
+    # kept until the end, so that the ids of the parameters are not reused by the checkpoint tensors
+    placeholders = {id(param): param for param in model.parameters()}
+
+    assign_tensors(model, tensors)
+    model.tie_weights()
+
+    missing = [name for name, param in model.named_parameters() if id(param) in placeholders]
+    if missing:
+        raise RuntimeError(f"{model_name} has no weights for {', '.join(missing[:5])}{' ...' if len(missing) > 5 else ''}")
+
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_name)
+    except (OSError, ValueError):
+        pass
+    return model.eval()
+
+def conv1d_to_linear(model: torch.nn.Module):
+    '''
+    Swaps the Conv1D layers of GPT-2 style models for the equivalent nn.Linear, which quantization knows about
+    '''
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if not isinstance(child, Conv1D):
+                continue
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features, bias=child.bias is not None, device="meta")
+            linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous(), requires_grad=False)
+            if child.bias is not None:
+                linear.bias = torch.nn.Parameter(child.bias.detach(), requires_grad=False)
+            setattr(module, name, linear)
+
+def quantize_int8(model: PreTrainedModel) -> PreTrainedModel:
+    '''
+    Dynamic quantization, linear layers keep int8 weights and quantize their activations on the fly
+    '''
+    conv1d_to_linear(model)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def release_memory():
+    '''
+    Hands the memory of the tensors freed while loading back to the OS, glibc otherwise keeps most of it in its heap
+    '''
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def tensors_size_mb(model: torch.nn.Module, include: Callable[[torch.Tensor], bool] = None) -> float:
+    '''
+    Memory used by the parameters and buffers of the model, quantized weights included, tied weights counted once
+    include filters the tensors counted
+    '''
+    seen = set()
+    total = 0
+
+    def add(value):
+        nonlocal total
+        if isinstance(value, torch.Tensor):
+            if value.is_meta or (include is not None and not include(value)):
+                return
+            key = (value.data_ptr(), value.nelement(), value.dtype)
+            if key not in seen:
+                seen.add(key)
+                total += value.nelement() * value.element_size()
+        elif isinstance(value, (tuple, list)):
+            for item in value:
+                add(item)
+
+    for value in model.state_dict(keep_vars=True).values():
+        add(value)
+    return total / 1024**2
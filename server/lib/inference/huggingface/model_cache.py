@@ -0,0 +1,142 @@
+import logging
+import threading
+
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+from .load_modes import DEFAULT, LOAD_MODES
+from .prefix_cache import PrefixCache
+
+if TYPE_CHECKING:
+    from .hf import HFInference
+
+logger = logging.getLogger(__name__)
+
+class ModelCache:
+    '''
+    Process-wide registry that keeps loaded HFInference (model + tokenizer) pairs resident
+    Least recently used models are evicted once the memory budget (in MB) is exceeded
+    torch and transformers are only imported once the first model is loaded
+    '''
+    def __init__(self, memory_budget_mb: float = None, max_batch_size: int = 8, prefix_cache: PrefixCache = None):
+        self.memory_budget_mb = memory_budget_mb
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.models = OrderedDict()
+        self.load_locks = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, model_name: str, load_mode: str = None) -> "HFInference":
+        '''
+        A model loaded in another mode is a different entry, load_mode defaults to load_modes.DEFAULT
+        '''
+        load_mode = load_mode or DEFAULT
+        if load_mode not in LOAD_MODES:
+            raise ValueError(f"Unknown load mode {load_mode} for {model_name}, expected one of {', '.join(LOAD_MODES)}")
+        key = (model_name, load_mode)
+
+        with self._lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.hits += 1
+                return self.models[key]
+
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+
+        # only one thread loads a given model, the others wait for it and share the result
+        with load_lock:
+            with self._lock:
+                if key in self.models:
+                    self.models.move_to_end(key)
+                    self.hits += 1
+                    return self.models[key]
+                self.misses += 1
+
+            logger.info(f"Loading {model_name} ({load_mode}) into model cache")
+            from .hf import HFInference, device_memory_mb
+            from .loading import estimate_size_mb
+
+            if self.memory_budget_mb is None:
+                self.memory_budget_mb = device_memory_mb() * 0.8
+
+            # makes room before loading, the evicted models and the new one are never resident together
+            estimate_mb = estimate_size_mb(model_name, load_mode)
+            with self._lock:
+                self.__evict__(reserve_mb=estimate_mb)
+
+            try:
+                hf = HFInference(model_name, max_batch_size=self.max_batch_size, prefix_cache=self.prefix_cache, load_mode=load_mode)
+            except Exception:
+                with self._lock:
+                    self.load_locks.pop(key, None)
+                raise
+
+            with self._lock:
+                self.models[key] = hf
+                self.__evict__(keep=key)
+                self.load_locks.pop(key, None)
+
+        return hf
+
+    def __evict__(self, keep: tuple = None, reserve_mb: float = 0.0):
+        '''
+        Evicts least recently used models other than keep until reserve_mb more fits into the budget
+        '''
+        while self.used_memory_mb() + reserve_mb > self.memory_budget_mb:
+            key = next((key for key in self.models if key != keep), None)
+            if key is None:
+                break
+            self.__remove__(key)
+
+        if keep is not None and self.used_memory_mb() > self.memory_budget_mb:
+            logger.warning(f"{self.models[keep].key} exceeds the model cache budget of {self.memory_budget_mb:.3f}MB")
+
+    def __remove__(self, key: tuple):
+        evicted = self.models.pop(key)
+        self.evictions += 1
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear(evicted.key)
+        logger.info(f"Evicted {evicted.key} ({evicted.size_mb:.3f}MB) from model cache")
+
+    def used_memory_mb(self) -> float:
+        return sum(hf.size_mb for hf in self.models.values())
+
+    def evict(self, model_name: str) -> bool:
+        '''
+        Evicts the model in every load mode
+        '''
+        with self._lock:
+            keys = [key for key in self.models if key[0] == model_name]
+            for key in keys:
+                self.__remove__(key)
+            return bool(keys)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            load_modes = {}
+            for hf in self.models.values():
+                stats = load_modes.setdefault(hf.load_mode, {"models": 0, "memoryMB": 0.0, "generatedTokens": 0, "generationSeconds": 0.0})
+                stats["models"] += 1
+                stats["memoryMB"] += hf.size_mb
+                stats["generatedTokens"] += hf.generated_tokens
+                stats["generationSeconds"] += hf.generation_seconds
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resident": {hf.key: hf.get_stats() for hf in self.models.values()},
+                "loadModes": {
+                    load_mode: {
+                        "models": stats["models"],
+                        "memoryMB": round(stats["memoryMB"], 3),
+                        "tokensPerSecond": round(stats["generatedTokens"] / stats["generationSeconds"], 3) if stats["generationSeconds"] else 0.0,
+                    }
+                    for load_mode, stats in load_modes.items()
+                },
+                "usedMemoryMB": round(self.used_memory_mb(), 3),
+                "memoryBudgetMB": round(self.memory_budget_mb, 3) if self.memory_budget_mb is not None else None,
+            }
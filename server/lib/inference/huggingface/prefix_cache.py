@@ -0,0 +1,157 @@
+import logging
+import threading
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, List, Tuple
+
+if TYPE_CHECKING:
+    # scheduler imports torch, which is only loaded with the first local model
+    from .scheduler import PastKeyValues
+
+logger = logging.getLogger(__name__)
+
+# prompts are indexed by the hashes of their prefixes that are a whole number of blocks long
+BLOCK_SIZE = 16
+
+@dataclass
+class PrefixEntry:
+    '''
+    Args:
+        model_name (str): model the key/value cache was computed with
+        token_ids (tuple): prompt token ids covered by the key/value cache
+        past_key_values (PastKeyValues): key/value cache of the prompt
+        size_mb (float): memory used by the key/value cache
+        block_hashes (list): hashes of the block aligned prefixes of token_ids, see block_hashes
+    '''
+    model_name: str
+    token_ids: Tuple[int, ...]
+    past_key_values: "PastKeyValues"
+    size_mb: float
+    block_hashes: List[int]
+
+def common_prefix_length(a: Tuple[int, ...], b: List[int]) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+def block_hashes(token_ids: List[int], block_size: int) -> List[int]:
+    '''
+    Hash of token_ids[:k * block_size] for every whole block k, each chained from the one before so all of them
+    take a single pass over the ids
+    '''
+    hashes, prefix_hash = [], 0
+    for start in range(0, len(token_ids) - block_size + 1, block_size):
+        prefix_hash = hash((prefix_hash, tuple(token_ids[start:start + block_size])))
+        hashes.append(prefix_hash)
+    return hashes
+
+class PrefixCache:
+    '''
+    Keeps the key/value caches of recently seen prompts, keyed by model and a hash of the prompt token ids
+    A new prompt sharing a prefix with a cached one only runs the forward pass over the tokens after it
+    Prompts are found by the hashes of their block aligned prefixes, probed from the longest down, so a lookup
+    does not depend on the number of entries; prefixes shorter than a block are not reused
+    '''
+    def __init__(self, memory_budget_mb: float = 512, block_size: int = BLOCK_SIZE):
+        self.memory_budget_mb = memory_budget_mb
+        self.block_size = block_size
+        self.entries = OrderedDict()
+        # (model name, prefix hash) to the keys of the entries starting with that prefix
+        self.blocks = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+
+    def lookup(self, model_name: str, token_ids: List[int]) -> Tuple[int, "PastKeyValues"]:
+        '''
+        Returns how many leading tokens are covered by a cached key/value cache, together with that cache
+        At least the last token is always left out, its logits are needed to pick the next token
+        '''
+        usable = len(token_ids) - 1
+        hashes = block_hashes(token_ids[:usable], self.block_size)
+        with self._lock:
+            best_key, best_length = self.__longest_prefix__(model_name, token_ids, usable, hashes)
+            if best_key is None:
+                self.misses += 1
+                return 0, None
+
+            self.entries.move_to_end(best_key)
+            entry = self.entries[best_key]
+            self.hits += 1
+            self.reused_tokens += best_length
+
+        # attention is causal, so the cache of a longer prompt holds the cache of each of its prefixes
+        past = tuple(tuple(tensor[:, :, :best_length, :] for tensor in layer) for layer in entry.past_key_values)
+        return best_length, past
+
+    def __longest_prefix__(self, model_name: str, token_ids: List[int], usable: int, hashes: List[int]) -> Tuple[tuple, int]:
+        for blocks in range(len(hashes), 0, -1):
+            keys = self.blocks.get((model_name, hashes[blocks - 1]))
+            if not keys:
+                continue
+
+            # entries sharing the prefix may go on matching for part of the next block
+            covered = blocks * self.block_size
+            best_key, best_length = None, 0
+            for key in keys:
+                tail = self.entries[key].token_ids[covered:covered + self.block_size]
+                length = covered + common_prefix_length(tail, token_ids[covered:usable])
+                if length > best_length:
+                    best_key, best_length = key, length
+
+            # a hash collision is all but impossible, but would hand out the cache of another prompt
+            if self.entries[best_key].token_ids[:covered] == tuple(token_ids[:covered]):
+                return best_key, best_length
+        return None, 0
+
+    def store(self, model_name: str, token_ids: List[int], past_key_values: "PastKeyValues"):
+        size_mb = sum(tensor.nelement() * tensor.element_size() for layer in past_key_values for tensor in layer) / 1024**2
+        if size_mb > self.memory_budget_mb:
+            return
+
+        key = (model_name, hash(tuple(token_ids)))
+        hashes = block_hashes(token_ids, self.block_size)
+        with self._lock:
+            if key in self.entries:
+                self.__remove__(key)
+            self.entries[key] = PrefixEntry(model_name, tuple(token_ids), past_key_values, size_mb, hashes)
+            for prefix_hash in hashes:
+                self.blocks.setdefault((model_name, prefix_hash), set()).add(key)
+
+            while self.used_memory_mb() > self.memory_budget_mb:
+                self.__remove__(next(iter(self.entries)))
+                self.evictions += 1
+
+    def __remove__(self, key: tuple):
+        entry = self.entries.pop(key)
+        for prefix_hash in entry.block_hashes:
+            keys = self.blocks[(entry.model_name, prefix_hash)]
+            keys.discard(key)
+            if not keys:
+                del self.blocks[(entry.model_name, prefix_hash)]
+
+    def clear(self, model_name: str):
+        with self._lock:
+            for key in [key for key, entry in self.entries.items() if entry.model_name == model_name]:
+                self.__remove__(key)
+
+    def used_memory_mb(self) -> float:
+        return sum(entry.size_mb for entry in self.entries.values())
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "reusedTokens": self.reused_tokens,
+                "entries": len(self.entries),
+                "usedMemoryMB": round(self.used_memory_mb(), 3),
+                "memoryBudgetMB": self.memory_budget_mb,
+            }
@@ -0,0 +1,264 @@
+import logging
+import queue
+import threading
+import torch
+import torch.nn.functional as F
+
+from dataclasses import dataclass
+from typing import List, Tuple
+from .decoding import DecodedToken, SamplingParams, mark_seen, select_tokens
+
+logger = logging.getLogger(__name__)
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, ...], ...]
+
+def pad_past(past: PastKeyValues, left: int) -> PastKeyValues:
+    '''
+    Left pads every key/value tensor ([batch, heads, seq, head_dim]) along the sequence dimension
+    '''
+    if left == 0:
+        return past
+    return tuple(tuple(F.pad(tensor, (0, 0, left, 0)) for tensor in layer) for layer in past)
+
+def cat_past(a: PastKeyValues, b: PastKeyValues) -> PastKeyValues:
+    return tuple(tuple(torch.cat([x, y], dim=0) for x, y in zip(layer_a, layer_b)) for layer_a, layer_b in zip(a, b))
+
+def select_past(past: PastKeyValues, index: torch.Tensor) -> PastKeyValues:
+    return tuple(tuple(tensor.index_select(0, index) for tensor in layer) for layer in past)
+
+def trim_past(past: PastKeyValues, left: int) -> PastKeyValues:
+    if left == 0:
+        return past
+    return tuple(tuple(tensor[:, :, left:, :] for tensor in layer) for layer in past)
+
+def supports_batching(model) -> bool:
+    '''
+    Continuous batching merges key/value caches of different requests, which needs a decoder-only model
+    returning the standard ([batch, heads, seq, head_dim]) cache layout
+    '''
+    if model.config.is_encoder_decoder:
+        return False
+
+    try:
+        with torch.inference_mode():
+            input_ids = torch.zeros((1, 2), dtype=torch.long, device=model.device)
+            outputs = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), use_cache=True, return_dict=True)
+    except Exception as e:
+        logger.info(f"Continuous batching disabled for {model.__class__.__name__}: {e}")
+        return False
+
+    past = outputs.past_key_values
+    return past is not None and all(
+        len(layer) == 2 and all(tensor.dim() == 4 and tensor.shape[0] == 1 and tensor.shape[2] == 2 for tensor in layer)
+        for layer in past
+    )
+
+class GenerationStream:
+    '''
+    Iterator over the DecodedTokens generated for one request
+    Closing it (or dropping out of the loop) removes the sequence from the batch at the next step
+    '''
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.cancelled = False
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.cancelled = True
+
+    def close(self):
+        self.cancelled = True
+        # wakes up a consumer waiting for the next token, the decode thread drops the sequence at its next step
+        self.queue.put(None)
+
+@dataclass
+class Sequence:
+    input_ids: List[int]
+    max_new_tokens: int
+    sampling: SamplingParams
+    stream: GenerationStream
+    generated: int = 0
+    # tokens of the prompt and the completion so far, only kept for the repetition penalty
+    seen: torch.Tensor = None
+
+class BatchScheduler:
+    '''
+    Continuous batching for one local model
+    Concurrent requests share a single left-padded batch, sequences join and leave it at token boundaries
+    Every sequence is sampled with its own parameters, the whole batch is selected from in one vectorized call
+    '''
+    def __init__(self, model, eos_token_ids: List[int], max_batch_size: int = 8, model_name: str = None, prefix_cache=None):
+        self.model = model
+        self.model_name = model_name
+        self.eos_token_ids = set(eos_token_ids)
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.waiting: List[Sequence] = []
+        self.thread = None
+        self._lock = threading.Lock()
+
+        self.__reset__()
+
+    def __reset__(self):
+        self.active: List[Sequence] = []
+        self.past = None
+        self.attention_mask = None
+        self.next_tokens = None
+
+    def submit(self, input_ids: List[int], max_new_tokens: int, sampling: SamplingParams = None) -> GenerationStream:
+        stream = GenerationStream()
+        sequence = Sequence(
+            input_ids=list(input_ids),
+            max_new_tokens=max_new_tokens,
+            sampling=sampling if sampling is not None else SamplingParams(top_k=1),
+            stream=stream
+        )
+
+        with self._lock:
+            self.waiting.append(sequence)
+            # the decode thread exits when idle, so evicted models are not kept alive by it
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__decode_loop__, name="local-batch-decode", daemon=True)
+                self.thread.start()
+
+        return stream
+
+    def __decode_loop__(self):
+        with torch.inference_mode():
+            while True:
+                with self._lock:
+                    free_slots = self.max_batch_size - len(self.active)
+                    admitted, self.waiting = self.waiting[:free_slots], self.waiting[free_slots:]
+
+                    if not admitted and not self.active:
+                        self.thread = None
+                        return
+
+                try:
+                    for sequence in admitted:
+                        if not sequence.stream.cancelled:
+                            self.__prefill__(sequence)
+
+                    if self.active:
+                        self.__step__()
+                except Exception as e:
+                    logger.error(f"Batched generation failed: {e}")
+                    # prefilled sequences are in both lists, each stream gets the error once
+                    for sequence in {id(sequence): sequence for sequence in self.active + admitted}.values():
+                        sequence.stream.queue.put(e)
+                    self.__reset__()
+
+    def __prefill__(self, sequence: Sequence):
+        reused, past = 0, None
+        if self.prefix_cache is not None:
+            reused, past = self.prefix_cache.lookup(self.model_name, sequence.input_ids)
+
+        input_ids = torch.tensor([sequence.input_ids[reused:]], dtype=torch.long, device=self.model.device)
+        attention_mask = torch.ones((1, len(sequence.input_ids)), dtype=torch.long, device=self.model.device)
+
+        outputs = self.model(
+            input_ids=input_ids, attention_mask=attention_mask, past_key_values=past, use_cache=True, return_dict=True
+        )
+        if self.prefix_cache is not None:
+            self.prefix_cache.store(self.model_name, sequence.input_ids, outputs.past_key_values)
+
+        logits = outputs.logits[:, -1, :]
+        if sequence.sampling.repetition_penalty != 1.0:
+            sequence.seen = mark_seen(torch.tensor([sequence.input_ids], device=logits.device), logits.shape[-1])[0]
+        next_token = self.__select_tokens__(logits, [sequence])[0]
+
+        if self.__emit__(sequence, next_token):
+            self.__join__(sequence, outputs.past_key_values, attention_mask, next_token.token_id)
+
+    def __join__(self, sequence: Sequence, past: PastKeyValues, attention_mask: torch.Tensor, next_token: int):
+        next_tokens = torch.tensor([[next_token]], dtype=torch.long, device=self.model.device)
+
+        if not self.active:
+            self.past, self.attention_mask, self.next_tokens = past, attention_mask, next_tokens
+        else:
+            length, batch_length = attention_mask.shape[1], self.attention_mask.shape[1]
+            past = pad_past(past, batch_length - length) if length < batch_length else past
+            attention_mask = F.pad(attention_mask, (max(batch_length - length, 0), 0))
+            self.past = pad_past(self.past, length - batch_length) if length > batch_length else self.past
+            self.attention_mask = F.pad(self.attention_mask, (max(length - batch_length, 0), 0))
+
+            self.past = cat_past(self.past, past)
+            self.attention_mask = torch.cat([self.attention_mask, attention_mask], dim=0)
+            self.next_tokens = torch.cat([self.next_tokens, next_tokens], dim=0)
+
+        self.active.append(sequence)
+
+    def __step__(self):
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        model_inputs = self.model.prepare_inputs_for_generation(
+            self.next_tokens, past_key_values=self.past, attention_mask=self.attention_mask, use_cache=True
+        )
+        outputs = self.model(**model_inputs, return_dict=True)
+        self.past = outputs.past_key_values
+
+        next_tokens = self.__select_tokens__(outputs.logits[:, -1, :], self.active)
+        keep = [i for i, (sequence, token) in enumerate(zip(self.active, next_tokens)) if self.__emit__(sequence, token)]
+
+        self.next_tokens = torch.tensor([token.token_id for token in next_tokens], dtype=torch.long, device=self.model.device)[:, None]
+        if len(keep) < len(self.active):
+            self.__leave__(keep)
+
+    def __leave__(self, keep: List[int]):
+        if not keep:
+            self.__reset__()
+            return
+
+        index = torch.tensor(keep, dtype=torch.long, device=self.model.device)
+        self.active = [self.active[i] for i in keep]
+        self.past = select_past(self.past, index)
+        self.attention_mask = self.attention_mask.index_select(0, index)
+        self.next_tokens = self.next_tokens.index_select(0, index)
+
+        # drop padding columns no remaining sequence attends to
+        padding = int((self.attention_mask.cumsum(dim=-1) == 0).all(dim=0).sum())
+        if padding:
+            self.past = trim_past(self.past, padding)
+            self.attention_mask = self.attention_mask[:, padding:]
+
+    def __select_tokens__(self, logits: torch.Tensor, sequences: List[Sequence]) -> List[DecodedToken]:
+        seen = None
+        if any(sequence.seen is not None for sequence in sequences):
+            seen = torch.stack([
+                sequence.seen if sequence.seen is not None else torch.zeros(logits.shape[-1], dtype=torch.bool, device=logits.device)
+                for sequence in sequences
+            ])
+        return select_tokens(logits, [sequence.sampling for sequence in sequences], seen)
+
+    def __emit__(self, sequence: Sequence, token: DecodedToken) -> bool:
+        '''
+        Hands the token to the request, returns whether the sequence stays in the batch
+        '''
+        if sequence.stream.cancelled:
+            sequence.stream.queue.put(None)
+            return False
+
+        sequence.generated += 1
+        if sequence.seen is not None:
+            sequence.seen[token.token_id] = True
+        sequence.stream.queue.put(token)
+
+        if token.token_id in self.eos_token_ids or sequence.generated >= sequence.max_new_tokens:
+            sequence.stream.queue.put(None)
+            return False
+        return True
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "active": len(self.active),
+                "waiting": len(self.waiting),
+                "maxBatchSize": self.max_batch_size,
+            }
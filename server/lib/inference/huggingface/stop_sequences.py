@@ -0,0 +1,98 @@
+import logging
+
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+class StopSequences:
+    '''
+    Aho-Corasick automaton over a set of stop sequences, built once per request
+    State n is the longest prefix of a stop sequence that the text seen so far ends with, its depth is how many
+    trailing characters could still turn into a stop sequence
+    '''
+    def __init__(self, stop_sequences: List[str]):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        # length of the longest stop sequence ending in a state, 0 if none does
+        self.match = [0]
+
+        for sequence in stop_sequences:
+            if sequence:
+                self.__add__(sequence)
+        self.__link__()
+
+    def __add__(self, sequence: str):
+        state = 0
+        for char in sequence:
+            if char not in self.transitions[state]:
+                self.transitions.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[state] + 1)
+                self.match.append(0)
+                self.transitions[state][char] = len(self.transitions) - 1
+            state = self.transitions[state][char]
+        self.match[state] = len(sequence)
+
+    def __link__(self):
+        # breadth first, so the failure state of every parent is known before its children
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for char, child in self.transitions[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.transitions[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.transitions[fail].get(char, 0)
+                self.match[child] = max(self.match[child], self.match[self.fail[child]])
+                queue.append(child)
+
+    def __bool__(self) -> bool:
+        return len(self.transitions) > 1
+
+    def step(self, state: int, char: str) -> int:
+        while state and char not in self.transitions[state]:
+            state = self.fail[state]
+        return self.transitions[state].get(char, 0)
+
+    def matcher(self) -> "StopSequenceMatcher":
+        return StopSequenceMatcher(self)
+
+class StopSequenceMatcher:
+    '''
+    Scans streamed text for the stop sequences, one character at a time
+    Text that could be the start of a stop sequence is held back until the next characters rule it out,
+    so a stop sequence never reaches the client, not even split across tokens
+    '''
+    def __init__(self, stop_sequences: StopSequences):
+        self.stop_sequences = stop_sequences
+        self.state = 0
+        self.held = ""
+        self.stopped = False
+
+    def feed(self, text: str) -> Tuple[str, bool]:
+        '''
+        Returns the text that is safe to send and whether a stop sequence was found, the text before it is sent
+        '''
+        if self.stopped:
+            return "", True
+
+        pending = self.held + text
+        offset = len(self.held)
+        for i, char in enumerate(text):
+            self.state = self.stop_sequences.step(self.state, char)
+            length = self.stop_sequences.match[self.state]
+            if length:
+                self.stopped = True
+                self.held = ""
+                return pending[:offset + i + 1 - length], True
+
+        depth = self.stop_sequences.depth[self.state]
+        self.held = pending[len(pending) - depth:] if depth else ""
+        return pending[:len(pending) - depth], False
+
+    def flush(self) -> str:
+        '''
+        Text held back when generation ended without a stop sequence
+        '''
+        held, self.held = self.held, ""
+        return "" if self.stopped else held
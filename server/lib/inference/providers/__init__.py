@@ -0,0 +1,2 @@
+from .base import GeneratedToken, ProviderBackend, ProviderCapabilities, ProviderHTTPError
+from .registry import ProviderRegistry
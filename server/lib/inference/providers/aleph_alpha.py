@@ -0,0 +1,36 @@
+from .base import GeneratedToken, ProviderBackend, ProviderCapabilities
+from ..rate_limits import RateLimitExceeded
+from ...lazy_import import lazy_import
+
+aleph_alpha_client = lazy_import("aleph_alpha_client")
+
+class AlephAlphaBackend(ProviderBackend):
+    # the completion is returned in one piece once it is done
+    capabilities = ProviderCapabilities(streaming=False, max_concurrency=4)
+
+    def generate(self, provider_details, inference_request, cancellation):
+        client = self.connection_pool.get_client(
+            "aleph-alpha", provider_details.api_key,
+            lambda: aleph_alpha_client.Client(provider_details.api_key),
+            session_attribute="session"
+        )
+
+        request = aleph_alpha_client.CompletionRequest(
+            prompt = aleph_alpha_client.Prompt.from_text(inference_request.prompt),
+            temperature= inference_request.model_parameters['temperature'],
+            maximum_tokens=inference_request.model_parameters['maximumLength'],
+            top_p=float(inference_request.model_parameters['topP']),
+            top_k=int(inference_request.model_parameters['topK']),
+            presence_penalty=float(inference_request.model_parameters['repetitionPenalty']),
+            stop_sequences=inference_request.model_parameters['stopSequences']
+        )
+
+        try:
+            response = client.complete(request, model=inference_request.model_name)
+        except RuntimeError as e:
+            # the client already retried with the Retry-After of the response, so there is no delay left to honor
+            if e.args and e.args[0] == 429:
+                raise RateLimitExceeded(f"Aleph Alpha API request exceeded rate limit: {e.args[1]}") from e
+            raise
+
+        yield GeneratedToken(response.completions[0].completion)
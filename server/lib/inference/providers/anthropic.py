@@ -0,0 +1,74 @@
+import json
+
+from .base import GeneratedToken, ProviderBackend, ProviderCapabilities
+from .helpers import close_response
+from ..rate_limits import RateLimitExceeded
+from ...lazy_import import lazy_import
+
+anthropic = lazy_import("anthropic")
+
+class AnthropicBackend(ProviderBackend):
+    capabilities = ProviderCapabilities(streaming=True, max_concurrency=8)
+
+    def generate(self, provider_details, inference_request, cancellation):
+        c = self.connection_pool.get_client(
+            "anthropic", provider_details.api_key,
+            lambda: anthropic.Client(provider_details.api_key),
+            session_attribute="_session"
+        )
+
+        # the request the client's completion_stream sends, made here to get hold of the HTTP response
+        response = c._request_raw("post", "/v1/complete", params={
+            "prompt": f"{anthropic.HUMAN_PROMPT} {inference_request.prompt}{anthropic.AI_PROMPT}",
+            "stop_sequences": [anthropic.HUMAN_PROMPT] + inference_request.model_parameters['stopSequences'],
+            "temperature": float(inference_request.model_parameters['temperature']),
+            "top_p": float(inference_request.model_parameters['topP']),
+            "max_tokens_to_sample": inference_request.model_parameters['maximumLength'],
+            "model": inference_request.model_name,
+            "stream": True,
+        })
+
+        # closing the response from the cancelling thread also ends a read waiting on the upstream connection
+        cancellation.on_cancel(lambda: close_response(response))
+
+        # the stream returns the whole completion so far with every event
+        completion = ""
+        try:
+            for data in self.__events__(response):
+                # the client streams the error body of a failed request as well
+                if "error" in data:
+                    error = data["error"] if isinstance(data["error"], dict) else {"message": data["error"]}
+                    if error.get("type") == "rate_limit_error":
+                        raise RateLimitExceeded(f"Anthropic API request exceeded rate limit: {error.get('message')}")
+                    raise Exception(f"{error.get('message')}")
+
+                new_completion = data["completion"]
+                yield GeneratedToken(new_completion[len(completion):])
+                completion = new_completion
+        finally:
+            response.close()
+
+    def __events__(self, response):
+        '''
+        Parses the server-sent events of a completion stream the way the client does, skipping pings
+        '''
+        awaiting_ping_data = False
+        for line in response.iter_lines():
+            if not line:
+                continue
+            if line == b"event: ping":
+                awaiting_ping_data = True
+                continue
+            if awaiting_ping_data:
+                awaiting_ping_data = False
+                continue
+            if line == b"data: [DONE]":
+                continue
+
+            line = line.decode("utf-8")
+            if line.startswith("data: "):
+                line = line[len("data: "):]
+            try:
+                yield json.loads(line)
+            except json.decoder.JSONDecodeError as e:
+                raise ValueError(f"Error processing stream data: {line}") from e
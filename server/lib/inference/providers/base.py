@@ -0,0 +1,101 @@
+import requests
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterator, Optional, Union
+from ..rate_limits import RateLimitExceeded
+
+if TYPE_CHECKING:
+    from .. import ProablityDistribution, ProviderDetails, InferenceRequest
+    from ..cancellation import CancellationToken
+    from ..connections import ConnectionPool
+    from ..huggingface.model_cache import ModelCache
+
+@dataclass
+class ProviderCapabilities:
+    '''
+    Args:
+        streaming (bool): tokens are streamed as they are generated instead of returned in one piece
+        logprobs (bool): tokens carry a probability and top n distribution
+        batching (bool): concurrent requests are decoded together, more of them cost little extra
+        max_concurrency (int): most requests the engine runs against the provider at once, None for no limit
+        local (bool): generation runs in this process on the local executor
+    '''
+    streaming: bool = True
+    logprobs: bool = False
+    batching: bool = False
+    max_concurrency: Optional[int] = None
+    local: bool = False
+
+    def to_dict(self) -> dict:
+        return {
+            "streaming": self.streaming,
+            "logprobs": self.logprobs,
+            "batching": self.batching,
+            "maxConcurrency": self.max_concurrency,
+            "local": self.local,
+        }
+
+@dataclass
+class GeneratedToken:
+    '''
+    Args:
+        token (str): generated text
+        probability (float): log probability of the token
+        top_n_distribution (ProablityDistribution): top n distribution of tokens
+    '''
+    token: str
+    probability: Union[float, None] = None
+    top_n_distribution: Union["ProablityDistribution", None] = None
+
+class ProviderHTTPError(Exception):
+    '''
+    Raised by a provider backend for a failed HTTP request
+    '''
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+class ProviderBackend:
+    '''
+    Generates text with one provider, InferenceManager turns the tokens into InferenceResults and announces them
+    Subclasses set capabilities and implement generate
+    '''
+    capabilities = ProviderCapabilities()
+
+    def __init__(self, connection_pool: "ConnectionPool", model_cache: "ModelCache"):
+        self.connection_pool = connection_pool
+        self.model_cache = model_cache
+
+    def generate(
+        self, provider_details: "ProviderDetails", inference_request: "InferenceRequest", cancellation: "CancellationToken"
+    ) -> Iterator[GeneratedToken]:
+        '''
+        Must be a generator, it is closed as soon as the request is cancelled so cleanup belongs in finally or with blocks
+        A blocking read of an upstream stream should also be closed from cancellation.on_cancel
+        '''
+        raise NotImplementedError
+
+    def is_deterministic(self, inference_request: "InferenceRequest") -> bool:
+        '''
+        Whether the request decodes greedily, so that identical requests get the same completion and may share one
+        in flight or replay a cached one, most APIs only do at temperature 0
+        '''
+        temperature = inference_request.model_parameters.get('temperature')
+        return temperature is not None and float(temperature) <= 0
+
+    def format_error(self, error: Exception) -> str:
+        '''
+        Error message shown to the user for an exception raised by generate
+        '''
+        return str(error)
+
+    def is_retryable(self, error: Exception) -> bool:
+        '''
+        Whether a request that failed with error before its first token is worth sending again
+        Rate limits, connection errors, timeouts and 5xx responses are
+        '''
+        if isinstance(error, (
+            RateLimitExceeded, requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError
+        )):
+            return True
+        return isinstance(error, ProviderHTTPError) and error.status_code >= 500
@@ -0,0 +1,41 @@
+import json
+
+from .base import GeneratedToken, ProviderBackend, ProviderCapabilities
+from .helpers import close_response, raise_for_status
+
+class CohereBackend(ProviderBackend):
+    capabilities = ProviderCapabilities(streaming=True, max_concurrency=8)
+
+    def generate(self, provider_details, inference_request, cancellation):
+        session = self.connection_pool.get_session("cohere", provider_details.api_key)
+
+        with session.post("https://api.cohere.ai/generate",
+            headers={
+                "Authorization": f"Bearer {provider_details.api_key}",
+                "Content-Type": "application/json",
+                "Cohere-Version": "2021-11-08",
+            },
+            data=json.dumps({
+                "prompt": inference_request.prompt,
+                "model": inference_request.model_name,
+                "temperature": float(inference_request.model_parameters['temperature']),
+                "p": float(inference_request.model_parameters['topP']),
+                "k": int(inference_request.model_parameters['topK']),
+                "stopSequences": inference_request.model_parameters['stopSequences'],
+                "frequencyPenalty": float(inference_request.model_parameters['frequencyPenalty']),
+                "presencePenalty": float(inference_request.model_parameters['presencePenalty']),
+                "return_likelihoods": "GENERATION",
+                "max_tokens": int(inference_request.model_parameters['maximumLength']),
+                "stream": True,
+            }),
+            stream=True,
+            timeout=self.connection_pool.timeout
+        ) as response:
+            raise_for_status(response)
+
+            # closing the response from the cancelling thread also ends a read waiting on the upstream connection
+            cancellation.on_cancel(lambda: close_response(response))
+
+            for token in response.iter_lines():
+                token_json = json.loads(token.decode('utf-8'))
+                yield GeneratedToken(token_json['text']) # token_json['likelihood']
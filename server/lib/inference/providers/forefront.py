@@ -0,0 +1,63 @@
+import json
+import urllib
+
+from .base import GeneratedToken, ProviderBackend, ProviderCapabilities
+from .helpers import close_response, raise_for_status, top_n_distribution
+from ...lazy_import import lazy_import
+
+sseclient = lazy_import("sseclient")
+
+class ForefrontBackend(ProviderBackend):
+    capabilities = ProviderCapabilities(streaming=True, logprobs=True, max_concurrency=4)
+
+    def generate(self, provider_details, inference_request, cancellation):
+        session = self.connection_pool.get_session("forefront", provider_details.api_key)
+
+        with session.post(
+                f"https://shared-api.forefront.link/organization/gPn2ZLSO3mTh/{inference_request.model_name}/completions/{provider_details.version_key}",
+                headers={
+                    "Authorization": f"Bearer {provider_details.api_key}",
+                    "Content-Type": "application/json",
+                },
+                data=json.dumps({
+                    "text": inference_request.prompt,
+                    "top_p": float(inference_request.model_parameters['topP']),
+                    "top_k": int(inference_request.model_parameters['topK']),
+                    "temperature":  float(inference_request.model_parameters['temperature']),
+                    "repetition_penalty":  float(inference_request.model_parameters['repetitionPenalty']),
+                    "length": int(inference_request.model_parameters['maximumLength']),
+                    "stop": inference_request.model_parameters['stopSequences'],
+                    "logprobs": 5,
+                    "stream": True,
+                }),
+                stream=True,
+                timeout=self.connection_pool.timeout
+            ) as response:
+            raise_for_status(response)
+            cancellation.on_cancel(lambda: close_response(response))
+
+            total_tokens = 0
+            aggregate_string_length = 0
+
+            for packet in sseclient.SSEClient(response).events():
+                if packet.event == "update":
+                    data = urllib.parse.unquote(packet.data)
+                    yield GeneratedToken(data[aggregate_string_length:])
+                    aggregate_string_length = len(data)
+                elif packet.event == "message":
+                    data = json.loads(packet.data)
+
+                    logprobs = data["logprobs"][0]
+                    tokens = logprobs["tokens"]
+                    token_logprobs = logprobs["token_logprobs"]
+
+                    for index, generated_token in enumerate(tokens[total_tokens:], start=total_tokens):
+                        yield GeneratedToken(
+                            generated_token,
+                            probability=token_logprobs[index],
+                            top_n_distribution=top_n_distribution(logprobs["top_logprobs"][index], generated_token)
+                        )
+
+                    total_tokens = len(tokens)
+                elif packet.event == "end":
+                    break
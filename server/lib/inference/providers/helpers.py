@@ -0,0 +1,69 @@
+import math
+import requests
+import socket
+
+from .. import ProablityDistribution
+from .base import ProviderHTTPError
+from ..rate_limits import RateLimitExceeded, parse_retry_after
+
+def raise_for_status(response: requests.Response):
+    '''
+    Raises RateLimitExceeded for a 429 and ProviderHTTPError for any other failed request
+    '''
+    if response.status_code == 429:
+        raise RateLimitExceeded(
+            f"Request failed: {response.status_code} {response.reason}",
+            retry_after=parse_retry_after(response.headers.get("Retry-After"))
+        )
+    if response.status_code != 200:
+        raise ProviderHTTPError(f"Request failed: {response.status_code} {response.reason}", response.status_code)
+
+def close_response(response: requests.Response):
+    '''
+    Ends a streamed response from another thread
+    Closing alone leaves a read that is waiting on the connection blocked until data arrives and races the reading thread,
+    shutting the socket down ends the read instead and the reading thread closes the response itself
+    '''
+    # the socket file http.client reads the body from, the connection drops its socket when it closes after the response
+    fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+    sock = getattr(getattr(fp, "raw", None), "_sock", None)
+    if sock is None:
+        response.close()
+        return
+
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def samples_greedily(model_parameters: dict) -> bool:
+    '''
+    Whether temperature and top k sampling pick the most likely token, top k 1 does whatever the temperature
+    '''
+    return int(model_parameters.get('topK', 0)) == 1 or float(model_parameters.get('temperature', 1)) <= 0
+
+def top_n_distribution(top_logprobs: dict, generated_token: str) -> ProablityDistribution:
+    '''
+    Builds the distribution of the top n candidates for a token, most likely first
+    '''
+    chosen_log_prob = 0
+    prob_dist = ProablityDistribution(
+        log_prob_sum=0, simple_prob_sum=0, tokens={},
+    )
+
+    for token, log_prob in top_logprobs.items():
+        if log_prob == -3000.0: continue # placeholder for candidates without a probability
+        simple_prob = round(math.exp(log_prob) * 100, 2)
+        prob_dist.tokens[token] = [log_prob, simple_prob]
+
+        if token == generated_token:
+            chosen_log_prob = round(log_prob, 2)
+
+        prob_dist.simple_prob_sum += simple_prob
+
+    prob_dist.tokens = dict(
+        sorted(prob_dist.tokens.items(), key=lambda item: item[1][0], reverse=True)
+    )
+    prob_dist.log_prob_sum = chosen_log_prob
+    prob_dist.simple_prob_sum = round(prob_dist.simple_prob_sum, 2)
+    return prob_dist
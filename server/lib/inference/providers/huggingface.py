@@ -0,0 +1,62 @@
+import json
+
+from .base import GeneratedToken, ProviderBackend, ProviderCapabilities
+from .helpers import close_response, raise_for_status, samples_greedily
+
+class HuggingFaceBackend(ProviderBackend):
+    capabilities = ProviderCapabilities(streaming=True, logprobs=True, max_concurrency=4)
+
+    def is_deterministic(self, inference_request):
+        return samples_greedily(inference_request.model_parameters)
+
+    def generate(self, provider_details, inference_request, cancellation):
+        session = self.connection_pool.get_session("huggingface", provider_details.api_key)
+
+        with session.post(
+            f"https://api-inference.huggingface.co/models/{inference_request.model_name}",
+            headers={"Authorization": f"Bearer {provider_details.api_key}"},
+            json={
+                "inputs": inference_request.prompt,
+                "stream": True,
+                "parameters": {
+                    "max_length": min(inference_request.model_parameters['maximumLength'], 250), # max out at 250 tokens per request, we should handle for this in client side but just in case
+                    "temperature": inference_request.model_parameters['temperature'],
+                    "top_k": inference_request.model_parameters['topK'],
+                    "top_p": inference_request.model_parameters['topP'],
+                    "repetition_penalty": inference_request.model_parameters['repetitionPenalty'],
+                    "stop_sequences": inference_request.model_parameters['stopSequences'],
+                },
+                "options": {
+                    "use_cache": False
+                }
+            },
+            stream=True,
+            timeout=self.connection_pool.timeout
+        ) as response:
+            content_type = response.headers["content-type"]
+
+            cancellation.on_cancel(lambda: close_response(response))
+
+            raise_for_status(response)
+
+            if content_type == "application/json":
+                return_data = json.loads(response.content.decode("utf-8"))
+                outputs = return_data[0]["generated_text"]
+                yield GeneratedToken(outputs.removeprefix(inference_request.prompt))
+                return
+
+            for line in response.iter_lines():
+                line = line.decode('utf-8')
+                if line == "":
+                    continue
+
+                response_json = json.loads(line[5:])
+                if "error" in line:
+                    error = response_json["error"]
+                    raise Exception(f"{error}")
+
+                token = response_json['token']
+                if token["special"]:
+                    continue
+
+                yield GeneratedToken(" " if token['id'] == 3 else token['text'], probability=token['logprob'])
@@ -0,0 +1,37 @@
+import logging
+
+from .base import ProviderBackend, ProviderCapabilities
+from .helpers import samples_greedily
+
+logger = logging.getLogger(__name__)
+
+class LocalBackend(ProviderBackend):
+    # bounded by the local executor, concurrent requests for one model share a decode batch
+    capabilities = ProviderCapabilities(streaming=True, logprobs=True, batching=True, local=True)
+
+    def generate(self, provider_details, inference_request, cancellation):
+        logger.info(f"Starting inference for {inference_request.uuid} - {inference_request.model_name}")
+
+        hf = self.model_cache.get(inference_request.model_name, provider_details.load_mode)
+        output = hf.generate(
+            prompt=inference_request.prompt,
+            max_length=int(inference_request.model_parameters['maximumLength']),
+            top_p=float(inference_request.model_parameters['topP']),
+            top_k=int(inference_request.model_parameters['topK']),
+            temperature=float(inference_request.model_parameters['temperature']),
+            repetition_penalty=float(inference_request.model_parameters['repetitionPenalty']),
+            stop_sequences=inference_request.model_parameters.get('stopSequences'),
+            cancellation=cancellation,
+            num_beams=int(inference_request.model_parameters.get('numBeams', 1)),
+            logprobs=5,
+        )
+
+        try:
+            yield from output
+        finally:
+            # stops decoding right away instead of when the output generator is collected
+            output.close()
+
+    def is_deterministic(self, inference_request):
+        # the decoder samples unless SamplingParams.greedy, beam search keeps the most likely hypotheses
+        return samples_greedily(inference_request.model_parameters) or int(inference_request.model_parameters.get('numBeams', 1)) > 1
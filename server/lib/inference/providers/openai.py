@@ -0,0 +1,136 @@
+from datetime import datetime
+from .base import GeneratedToken, ProviderBackend, ProviderCapabilities
+from .helpers import close_response, top_n_distribution
+from ..rate_limits import RateLimitExceeded, parse_retry_after
+from ...lazy_import import lazy_import
+
+openai = lazy_import("openai")
+
+# TODO: Add a meta field to the inference so we know when a model is chat vs text
+CHAT_MODELS = ["gpt-3.5-turbo", "gpt-4"]
+
+class OpenAIBackend(ProviderBackend):
+    capabilities = ProviderCapabilities(streaming=True, logprobs=True, max_concurrency=16)
+
+    def generate(self, provider_details, inference_request, cancellation):
+        if inference_request.model_name in CHAT_MODELS:
+            tokens = self.__chat_generation__(provider_details, inference_request, cancellation)
+        else:
+            tokens = self.__text_generation__(provider_details, inference_request, cancellation)
+
+        try:
+            yield from tokens
+        except openai.error.RateLimitError as e:
+            raise RateLimitExceeded(
+                f"OpenAI API request exceeded rate limit: {e}", retry_after=parse_retry_after(e.headers.get("retry-after"))
+            ) from e
+
+    def __stream__(self, api_key, resource, cancellation, **params):
+        '''
+        Sends a streaming create request for resource (openai.Completion or openai.ChatCompletion) and yields its events
+        The SDK keeps the HTTP response to itself, it is requested here so that closing it from the cancelling thread
+        also ends a read waiting for the first event, which frees the rate limit slot of a losing hedge right away
+        '''
+        requestor = openai.api_requestor.APIRequestor(api_key)
+        result = requestor.request_raw(
+            "post", resource.class_url(), params={**params, "stream": True}, stream=True, request_timeout=self.connection_pool.timeout
+        )
+        cancellation.on_cancel(lambda: close_response(result))
+
+        try:
+            response, streamed = requestor._interpret_response(result, stream=True)
+            for event in (response if streamed else [response]):
+                yield event.data
+        finally:
+            # drops the upstream HTTP stream when leaving early
+            result.close()
+
+    def __chat_generation__(self, provider_details, inference_request, cancellation):
+        current_date = datetime.now().strftime("%Y-%m-%d")
+
+        if inference_request.model_name == "gpt-4":
+            system_content = "You are GPT-4, a large language model trained by OpenAI. Answer as concisely as possible"
+        else:
+            system_content = f"You are ChatGPT, a large language model trained by OpenAI. Answer as concisely as possible. Knowledge cutoff: 2021-09-01 Current date: {current_date}"
+
+        response = self.__stream__(
+            provider_details.api_key, openai.ChatCompletion, cancellation,
+            model=inference_request.model_name,
+            messages = [
+                {"role": "system", "content": system_content},
+                {"role": "user", "content": inference_request.prompt},
+            ],
+            temperature=inference_request.model_parameters['temperature'],
+            max_tokens=inference_request.model_parameters['maximumLength'],
+            top_p=inference_request.model_parameters['topP'],
+            frequency_penalty=inference_request.model_parameters['frequencyPenalty'],
+            presence_penalty=inference_request.model_parameters['presencePenalty'],
+        )
+
+        try:
+            for event in response:
+                choice = event['choices'][0]
+                if choice['finish_reason'] == "stop":
+                    break
+
+                delta = choice['delta']
+
+                if "content" not in delta:
+                    continue
+
+                yield GeneratedToken(delta["content"])
+        finally:
+            response.close()
+
+    def __text_generation__(self, provider_details, inference_request, cancellation):
+        response = self.__stream__(
+            provider_details.api_key, openai.Completion, cancellation,
+            model=inference_request.model_name,
+            prompt=inference_request.prompt,
+            temperature=inference_request.model_parameters['temperature'],
+            max_tokens=inference_request.model_parameters['maximumLength'],
+            top_p=inference_request.model_parameters['topP'],
+            stop=None if len(inference_request.model_parameters['stopSequences']) == 0 else inference_request.model_parameters['stopSequences'],
+            frequency_penalty=inference_request.model_parameters['frequencyPenalty'],
+            presence_penalty=inference_request.model_parameters['presencePenalty'],
+            logprobs=5,
+        )
+
+        try:
+            for event in response:
+                choice = event['choices'][0]
+                generated_token = choice['text']
+                try:
+                    yield GeneratedToken(
+                        generated_token,
+                        probability=choice['logprobs']['token_logprobs'][0],
+                        top_n_distribution=top_n_distribution(choice["logprobs"]['top_logprobs'][0], generated_token)
+                    )
+                except IndexError:
+                    yield GeneratedToken(generated_token, probability=-1)
+        finally:
+            response.close()
+
+    def format_error(self, error):
+        if isinstance(error, openai.error.Timeout):
+            return f"OpenAI API request timed out: {error}"
+        elif isinstance(error, openai.error.APIError):
+            return f"OpenAI API returned an API Error: {error}"
+        elif isinstance(error, openai.error.APIConnectionError):
+            return f"OpenAI API request failed to connect: {error}"
+        elif isinstance(error, openai.error.InvalidRequestError):
+            return f"OpenAI API request was invalid: {error}"
+        elif isinstance(error, openai.error.AuthenticationError):
+            return f"OpenAI API request was not authorized: {error}"
+        elif isinstance(error, openai.error.PermissionError):
+            return f"OpenAI API request was not permitted: {error}"
+        return super().format_error(error)
+
+    def is_retryable(self, error):
+        if isinstance(error, (
+            openai.error.Timeout, openai.error.APIConnectionError, openai.error.ServiceUnavailableError, openai.error.TryAgain
+        )):
+            return True
+        elif isinstance(error, openai.error.APIError):
+            return error.http_status is None or error.http_status >= 500
+        return super().is_retryable(error)
@@ -0,0 +1,75 @@
+import importlib
+import logging
+import threading
+
+from typing import Type, Union
+from .base import ProviderBackend, ProviderCapabilities
+
+logger = logging.getLogger(__name__)
+
+# "module:Class", modules starting with a dot are relative to this package
+BUILTIN_PROVIDERS = {
+    "openai": ".openai:OpenAIBackend",
+    "cohere": ".cohere:CohereBackend",
+    "huggingface": ".huggingface:HuggingFaceBackend",
+    "forefront": ".forefront:ForefrontBackend",
+    "huggingface-local": ".local:LocalBackend",
+    "anthropic": ".anthropic:AnthropicBackend",
+    "aleph-alpha": ".aleph_alpha:AlephAlphaBackend",
+}
+
+# capabilities assumed for a provider without a backend, so the engine can still schedule and fail the request
+DEFAULT_CAPABILITIES = ProviderCapabilities()
+
+class ProviderRegistry:
+    '''
+    Maps provider names to their ProviderBackend
+    Backends are registered as "module:Class" and only imported and created when first used
+    '''
+    def __init__(self, **context):
+        self.context = context
+        self.specs = dict(BUILTIN_PROVIDERS)
+        self.classes = {}
+        self.backends = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, backend: Union[str, Type[ProviderBackend]]):
+        '''
+        Adds or replaces the backend of a provider, either a ProviderBackend subclass or a "module:Class" string
+        '''
+        with self._lock:
+            self.specs[name] = backend
+            self.classes.pop(name, None)
+            self.backends.pop(name, None)
+
+    def has_provider(self, name: str) -> bool:
+        return name in self.specs
+
+    def get_class(self, name: str) -> Type[ProviderBackend]:
+        with self._lock:
+            if name not in self.specs:
+                raise ValueError(f"Unknown model provider, {name}. Please register a ProviderBackend for it in ProviderRegistry")
+
+            if name not in self.classes:
+                spec = self.specs[name]
+                if isinstance(spec, str):
+                    module_name, class_name = spec.split(":")
+                    spec = getattr(importlib.import_module(module_name, package=__package__), class_name)
+                self.classes[name] = spec
+            return self.classes[name]
+
+    def get(self, name: str) -> ProviderBackend:
+        backend_class = self.get_class(name)
+        with self._lock:
+            if name not in self.backends:
+                logger.info(f"Loading {backend_class.__name__} for {name}")
+                self.backends[name] = backend_class(**self.context)
+            return self.backends[name]
+
+    def get_capabilities(self, name: str) -> ProviderCapabilities:
+        if not self.has_provider(name):
+            return DEFAULT_CAPABILITIES
+        return self.get_class(name).capabilities
+
+    def get_stats(self) -> dict:
+        return {name: self.get_capabilities(name).to_dict() for name in list(self.specs)}
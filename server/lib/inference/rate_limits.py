@@ -0,0 +1,243 @@
+import email.utils
+import logging
+import threading
+import time
+
+from collections import deque
+from typing import Dict, Optional, Tuple
+from .cancellation import CancellationToken
+
+logger = logging.getLogger(__name__)
+
+# how long to back off after a rate limit error without a Retry-After
+DEFAULT_RETRY_AFTER = 1.0
+
+class RateLimitExceeded(Exception):
+    '''
+    Raised by a provider backend when the provider rejected the request because of a rate limit
+    retry_after is the delay in seconds the provider asked for, None if it did not say
+    '''
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    '''
+    Seconds to wait from a Retry-After header, which holds either a number of seconds or an HTTP date
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+class TokenBucket:
+    '''
+    Refills at rate_per_minute and holds at most one minute worth
+    '''
+    def __init__(self, rate_per_minute: float):
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def __refill__(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        '''
+        Seconds until amount is available, a request larger than the bucket waits for a full bucket
+        '''
+        self.__refill__(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float, now: float):
+        self.__refill__(now)
+        self.tokens -= min(amount, self.capacity)
+
+class RateLimiter:
+    '''
+    Admits the requests to one provider and API key in arrival order
+    A request waits for the requests per minute and tokens per minute buckets, for the Retry-After of the last
+    rate limit error and for a free slot under the AIMD concurrency limit. The limit grows by one for every limit
+    requests that went through and is halved by a rate limit error, at most once for the requests sent at that limit
+    Without max_concurrency there is no concurrency limit until the first rate limit error
+    '''
+    def __init__(self, requests_per_minute: int = None, tokens_per_minute: int = None, max_concurrency: int = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = float(max_concurrency) if max_concurrency else None
+        self.decreased_at = 0.0
+        self.blocked_until = 0.0
+        self.queue = deque()
+        self.active = 0
+        self.condition = threading.Condition()
+
+        self.admitted = 0
+        self.rate_limited = 0
+        self.last_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.total_wait_ms = 0.0
+
+    def __delay__(self, tokens: int, now: float) -> Optional[float]:
+        '''
+        Seconds until the next request may start, None while it waits for a running request to finish
+        '''
+        if self.concurrency_limit is not None and self.active >= int(self.concurrency_limit):
+            return None
+
+        delay = self.blocked_until - now
+        if self.requests is not None:
+            delay = max(delay, self.requests.delay(1, now))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.delay(tokens, now))
+        return max(delay, 0.0)
+
+    def __wake__(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def acquire(self, tokens: int, cancellation: CancellationToken = None) -> Optional[float]:
+        '''
+        Waits for the turn of a request expected to use tokens tokens
+        Returns the time it was admitted at, to be passed to release, or None if it was cancelled while waiting
+        '''
+        if cancellation is not None:
+            cancellation.on_cancel(self.__wake__)
+
+        ticket = object()
+        start = time.monotonic()
+        with self.condition:
+            self.queue.append(ticket)
+            try:
+                while True:
+                    if cancellation is not None and cancellation.cancelled:
+                        return None
+
+                    timeout = None
+                    if self.queue[0] is ticket:
+                        now = time.monotonic()
+                        timeout = self.__delay__(tokens, now)
+                        if timeout == 0:
+                            break
+                    self.condition.wait(timeout)
+            finally:
+                self.queue.remove(ticket)
+                # the next request in line may be able to go now
+                self.condition.notify_all()
+
+            return self.__admit__(tokens, now, (now - start) * 1000)
+
+    def try_acquire(self, tokens: int) -> Optional[float]:
+        '''
+        Admits the request only if nobody is waiting and the limits allow it right now, for optional requests like hedges
+        '''
+        with self.condition:
+            now = time.monotonic()
+            if self.queue or self.__delay__(tokens, now) != 0:
+                return None
+            return self.__admit__(tokens, now)
+
+    def __admit__(self, tokens: int, now: float, wait_ms: float = None) -> float:
+        if self.requests is not None:
+            self.requests.take(1, now)
+        if self.tokens is not None:
+            self.tokens.take(tokens, now)
+        self.active += 1
+
+        if wait_ms is not None:
+            self.admitted += 1
+            self.last_wait_ms = wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            self.total_wait_ms += wait_ms
+        return now
+
+    def release(self, admitted_at: float, error: RateLimitExceeded = None):
+        with self.condition:
+            self.active -= 1
+            if error is not None:
+                self.rate_limited += 1
+                retry_after = error.retry_after if error.retry_after is not None else DEFAULT_RETRY_AFTER
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+                # requests sent before the last decrease were already accounted for by it
+                if admitted_at >= self.decreased_at:
+                    self.concurrency_limit = max(1.0, (self.concurrency_limit or self.active + 1) / 2)
+                    self.decreased_at = time.monotonic()
+                    logger.warning(f"Rate limited, backing off {retry_after:.1f}s with at most {int(self.concurrency_limit)} concurrent requests")
+            elif self.concurrency_limit is not None:
+                self.concurrency_limit += 1 / self.concurrency_limit
+                if self.max_concurrency is not None:
+                    self.concurrency_limit = min(self.concurrency_limit, float(self.max_concurrency))
+            self.condition.notify_all()
+
+    def get_stats(self) -> dict:
+        with self.condition:
+            return {
+                "queued": len(self.queue),
+                "active": self.active,
+                "concurrencyLimit": None if self.concurrency_limit is None else int(self.concurrency_limit),
+                "admitted": self.admitted,
+                "rateLimited": self.rate_limited,
+                "retryAfterMs": round(max(0.0, self.blocked_until - time.monotonic()) * 1000, 3),
+                "lastQueueWaitMs": round(self.last_wait_ms, 3),
+                "maxQueueWaitMs": round(self.max_wait_ms, 3),
+                "totalQueueWaitMs": round(self.total_wait_ms, 3),
+            }
+
+class RateLimits:
+    '''
+    One RateLimiter per provider and API key, users with their own API keys do not share a budget
+    limits maps a provider to its (requests per minute, tokens per minute), either may be None
+    '''
+    def __init__(self, limits: Dict[str, Tuple[Optional[int], Optional[int]]] = None):
+        self.limits = limits or {}
+        self.limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider: str, api_key: str, max_concurrency: int = None) -> RateLimiter:
+        key = (provider, api_key)
+        with self._lock:
+            if key not in self.limiters:
+                requests_per_minute, tokens_per_minute = self.limits.get(provider, (None, None))
+                self.limiters[key] = RateLimiter(requests_per_minute, tokens_per_minute, max_concurrency)
+            return self.limiters[key]
+
+    def get_stats(self) -> dict:
+        '''
+        Stats per provider, summed over its API keys, which are never reported
+        '''
+        with self._lock:
+            limiters = list(self.limiters.items())
+
+        stats = {}
+        for (provider, _), limiter in limiters:
+            limiter_stats = limiter.get_stats()
+            if provider not in stats:
+                stats[provider] = {**limiter_stats, "keys": 1}
+                continue
+
+            provider_stats = stats[provider]
+            provider_stats["keys"] += 1
+            for key, value in limiter_stats.items():
+                if key == "concurrencyLimit":
+                    continue
+                elif key in ("retryAfterMs", "maxQueueWaitMs"):
+                    provider_stats[key] = max(provider_stats[key], value)
+                elif key != "lastQueueWaitMs":
+                    provider_stats[key] += value
+
+        for provider_stats in stats.values():
+            admitted = provider_stats["admitted"]
+            provider_stats["avgQueueWaitMs"] = round(provider_stats.pop("totalQueueWaitMs") / admitted, 3) if admitted else 0.0
+        return stats
@@ -0,0 +1,103 @@
+import logging
+import random
+import threading
+
+from collections import defaultdict, deque
+from typing import Iterator, Optional
+from .cancellation import CancellationToken
+from .rate_limits import RateLimiter, RateLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+class RetryPolicy:
+    '''
+    Exponential backoff with full jitter, retry n waits a random delay of up to base_delay * 2**n seconds, capped at max_delay
+    A Retry-After sent with a rate limit error is waited out by the RateLimiter on top of this
+    '''
+    def __init__(self, max_retries: int = 2, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, retry: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+class Attempt:
+    '''
+    One request sent to a provider, it holds its RateLimiter slot until it is closed
+    Every attempt has its own cancellation token, so a losing hedge can be stopped without cancelling the request
+    '''
+    def __init__(
+        self, tokens: Iterator, cancellation: CancellationToken, limiter: RateLimiter = None, admitted_at: float = None, hedge: bool = False
+    ):
+        self.tokens = tokens
+        self.cancellation = cancellation
+        self.limiter = limiter
+        self.admitted_at = admitted_at
+        self.hedge = hedge
+        self.closed = False
+
+    def first(self):
+        '''
+        Waits for the first token, None if the stream ended without one
+        '''
+        try:
+            return next(self.tokens, None)
+        except Exception as e:
+            self.close(e)
+            raise
+
+    def close(self, error: Exception = None):
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            self.tokens.close()
+        finally:
+            if self.limiter is not None:
+                self.limiter.release(self.admitted_at, error if isinstance(error, RateLimitExceeded) else None)
+
+class AttemptStats:
+    '''
+    Recent times to first token and retry and hedge counts per provider
+    The p95 time to first token is only known once min_samples requests were timed
+    '''
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self.first_token = defaultdict(lambda: deque(maxlen=self.window))
+        self.counters = defaultdict(lambda: {"retries": 0, "hedges": 0, "hedgesWon": 0})
+        self._lock = threading.Lock()
+
+    def record_first_token(self, provider: str, seconds: float):
+        with self._lock:
+            self.first_token[provider].append(seconds)
+
+    def count(self, provider: str, counter: str):
+        with self._lock:
+            self.counters[provider][counter] += 1
+
+    def percentile(self, provider: str, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.first_token.get(provider, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            providers = set(self.first_token) | set(self.counters)
+            counters = {provider: dict(self.counters.get(provider, {"retries": 0, "hedges": 0, "hedgesWon": 0})) for provider in providers}
+            samples = {provider: len(self.first_token.get(provider, ())) for provider in providers}
+
+        stats = {}
+        for provider in providers:
+            p50, p95 = self.percentile(provider, 0.5), self.percentile(provider, 0.95)
+            stats[provider] = {
+                "firstTokenSamples": samples[provider],
+                "p50FirstTokenMs": None if p50 is None else round(p50 * 1000, 3),
+                "p95FirstTokenMs": None if p95 is None else round(p95 * 1000, 3),
+                **counters[provider],
+            }
+        return stats
@@ -0,0 +1,119 @@
+import logging
+import threading
+
+from typing import Iterator, List, Tuple
+from .cancellation import CancellationToken
+from .providers import GeneratedToken
+
+logger = logging.getLogger(__name__)
+
+class Flight:
+    '''
+    One upstream generation shared by identical requests
+    Every token is kept so that requests joining late get the whole completion, the generation is cancelled
+    once every request following it has left
+    '''
+    def __init__(self, key: str, uuid: str):
+        self.key = key
+        self.tokens: List[GeneratedToken] = []
+        self.done = False
+        self.error = None
+        self.subscribers = 1
+        self.cancellation = CancellationToken(uuid)
+        self.condition = threading.Condition()
+
+    def publish(self, generated: GeneratedToken):
+        with self.condition:
+            self.tokens.append(generated)
+            self.condition.notify_all()
+
+    def finish(self, error: Exception = None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def leave(self):
+        with self.condition:
+            self.subscribers -= 1
+            left = self.subscribers == 0
+            self.condition.notify_all()
+        if left:
+            self.cancellation.cancel()
+
+    def follow(self, cancellation: CancellationToken) -> Iterator[GeneratedToken]:
+        '''
+        Yields every token from the first one on, raises the error the generation failed with once it is replayed
+        '''
+        def wake():
+            with self.condition:
+                self.condition.notify_all()
+        cancellation.on_cancel(wake)
+
+        index = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: index < len(self.tokens) or self.done or cancellation.cancelled)
+                if cancellation.cancelled:
+                    return
+                if index >= len(self.tokens):
+                    if self.error is not None:
+                        raise self.error
+                    return
+                tokens = self.tokens[index:]
+
+            index += len(tokens)
+            yield from tokens
+
+class SingleFlight:
+    '''
+    Lets identical in-flight requests share one upstream generation instead of each starting their own
+    Requests are identical when their InferenceRequest.key is
+    '''
+    def __init__(self):
+        self.flights = {}
+        self._lock = threading.Lock()
+
+        self.started = 0
+        self.duplicates = 0
+        self.late_joiners = 0
+        self.max_subscribers = 1
+
+    def join(self, key: str, uuid: str) -> Tuple[Flight, bool]:
+        '''
+        Returns the flight for key and whether the caller leads it, the leader runs the generation and finishes the flight
+        '''
+        with self._lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                with flight.condition:
+                    # a flight that lost all of its requests is already shutting down
+                    joinable = not flight.done and not flight.cancellation.cancelled
+                    if joinable:
+                        flight.subscribers += 1
+                        self.duplicates += 1
+                        self.late_joiners += bool(flight.tokens)
+                        self.max_subscribers = max(self.max_subscribers, flight.subscribers)
+                if joinable:
+                    logger.info(f"Request {uuid} joined the in-flight generation of an identical request")
+                    return flight, False
+
+            flight = self.flights[key] = Flight(key, uuid)
+            self.started += 1
+            return flight, True
+
+    def finish(self, flight: Flight, error: Exception = None):
+        with self._lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+        flight.finish(error)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "activeFlights": len(self.flights),
+                "flights": self.started,
+                "duplicates": self.duplicates,
+                "lateJoiners": self.late_joiners,
+                "maxSubscribers": self.max_subscribers,
+            }
@@ -0,0 +1,23 @@
+import importlib.util
+import sys
+
+from types import ModuleType
+
+def lazy_import(name: str) -> ModuleType:
+    '''
+    Returns the module without running it, it is imported on first attribute access
+    Provider SDKs and the ML stack are only paid for by deployments that use them
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'", name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
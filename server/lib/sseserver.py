@@ -1,56 +1,290 @@
 # Thread Safe and Singular Global Instance of SSE Server
-import queue
+import json
 import logging
+import threading
+import time
+
+from collections import deque
+from typing import Callable, List, Optional
 
 logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+
+    def dumps(data) -> bytes:
+        return orjson.dumps(data)
+except ImportError:
+    def dumps(data) -> bytes:
+        return json.dumps(data, separators=(",", ":")).encode()
+
+class Event:
+    '''
+    A server-sent event, its wire format is encoded on first use and shared by every subscriber
+    data must not be changed once the event is published
+    '''
+    __slots__ = ("type", "data", "encoded")
+
+    def __init__(self, type: str, data: dict):
+        self.type = type
+        self.data = data
+        self.encoded = None
+
+    def encode(self) -> bytes:
+        if self.encoded is None:
+            # compact JSON never contains a newline, so a single data line is enough
+            self.encoded = b"event:" + self.type.encode() + b"\ndata:" + dumps(self.data) + b"\n\n"
+        return self.encoded
+
+    def __repr__(self):
+        return f"Event({self.type}, {self.data})"
+
+# what a subscription does with a new message once its buffer is full
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+BLOCK = "block"
+OVERFLOW_POLICIES = (DROP_OLDEST, COALESCE, BLOCK)
+
+class Subscription:
+    '''
+    Bounded ring buffer of messages for one listener
+    Once full, drop_oldest discards the oldest message, coalesce merges the message into the newest buffered one
+    (falling back to drop_oldest when merge returns None) and block makes the producer wait for the listener
+    A producer blocked for longer than block_timeout seconds closes the subscription as stalled
+    '''
+    def __init__(
+        self, sse_queue: "SSEQueue", maxsize: int = 256, policy: str = DROP_OLDEST,
+        merge: Callable[[Event, Event], Optional[Event]] = None, block_timeout: float = 30
+    ):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy}")
+
+        self.sse_queue = sse_queue
+        self.maxsize = maxsize
+        self.policy = policy
+        self.merge = merge
+        self.block_timeout = block_timeout
+        self.buffer = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.dropped = 0
+        self.coalesced = 0
+        self.stalled = False
+        self.max_depth = 0
+
+    def put(self, message: Event, block: bool = True) -> bool:
+        '''
+        Returns False if the subscription is closed
+        block=False never waits, a full buffer under the block policy then takes the message anyway
+        '''
+        with self.condition:
+            if self.closed:
+                return False
+
+            if len(self.buffer) >= self.maxsize:
+                if self.policy == BLOCK and block:
+                    if not self.condition.wait_for(lambda: len(self.buffer) < self.maxsize or self.closed, self.block_timeout):
+                        logger.warning(f"Listener did not read for {self.block_timeout}s, closing subscription")
+                        self.stalled = True
+                        self.__close__()
+                        return False
+                    if self.closed:
+                        return False
+                elif self.policy == COALESCE and self.merge is not None and self.buffer:
+                    merged = self.merge(self.buffer[-1], message)
+                    if merged is not None:
+                        self.buffer[-1] = merged
+                        self.coalesced += 1
+                        return True
+
+                if self.policy != BLOCK:
+                    self.buffer.popleft()
+                    self.dropped += 1
+
+            self.buffer.append(message)
+            self.max_depth = max(self.max_depth, len(self.buffer))
+            self.condition.notify_all()
+            return True
+
+    def get(self, timeout: float = None) -> Optional[Event]:
+        '''
+        Waits for the next message, returns None once the subscription is closed and drained or on timeout
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while not self.buffer:
+                if self.closed:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+            message = self.buffer.popleft()
+            self.condition.notify_all()
+            return message
+
+    def __close__(self):
+        self.closed = True
+        self.condition.notify_all()
+
+    def close(self):
+        '''
+        Unsubscribes, wakes up a blocked producer and drops buffered messages
+        '''
+        with self.condition:
+            self.__close__()
+            self.buffer.clear()
+        self.sse_queue.unsubscribe(self)
+
+    def qsize(self) -> int:
+        return len(self.buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 class SSEQueue:
-    def __init__(self):
-        self.listeners = []
+    def __init__(
+        self, maxsize: int = 256, policy: str = DROP_OLDEST,
+        merge: Callable[[Event, Event], Optional[Event]] = None, block_timeout: float = 30
+    ):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.merge = merge
+        self.block_timeout = block_timeout
+        self.listeners: List[Subscription] = []
+        self._lock = threading.Lock()
+
+        self.dropped = 0
+        self.coalesced = 0
+        self.stalled = 0
 
-    def listen(self):
+    def listen(self) -> Subscription:
         logger.info("LISTENING")
-        q = queue.Queue(maxsize=50) # what about multiprocessing.Queue?
-        self.listeners.append(q)
-        return q
-
-    def publish(self, message: str):
-        logger.debug(f"PUBLISHING {message}")
-        for i in reversed(range(len(self.listeners))):
-            try:
-                self.listeners[i].put_nowait(message)
-            except queue.Full:
-                del self.listeners[i]
+        subscription = Subscription(
+            self, maxsize=self.maxsize, policy=self.policy, merge=self.merge, block_timeout=self.block_timeout
+        )
+        with self._lock:
+            self.listeners.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            if subscription not in self.listeners:
+                return
+            self.listeners.remove(subscription)
+            # keep the counters of closed subscriptions around for the metrics
+            self.dropped += subscription.dropped
+            self.coalesced += subscription.coalesced
+            self.stalled += subscription.stalled
+
+    def publish(self, message: Event, block: bool = True) -> int:
+        '''
+        Returns the number of listeners the message was delivered to
+        '''
+        logger.debug("PUBLISHING %s", message)
+        with self._lock:
+            listeners = list(self.listeners)
+
+        delivered = 0
+        for subscription in listeners:
+            if subscription.put(message, block=block):
+                delivered += 1
+            elif subscription.stalled:
+                self.unsubscribe(subscription)
+        return delivered
+
+    def close(self):
+        with self._lock:
+            listeners = list(self.listeners)
+        for subscription in listeners:
+            subscription.close()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            listeners = list(self.listeners)
+            stats = {
+                "subscribers": len(listeners),
+                "queueDepth": 0,
+                "maxQueueDepth": 0,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "stalled": self.stalled,
+            }
+
+        for subscription in listeners:
+            stats["queueDepth"] += subscription.qsize()
+            stats["maxQueueDepth"] = max(stats["maxQueueDepth"], subscription.max_depth)
+            stats["dropped"] += subscription.dropped
+            stats["coalesced"] += subscription.coalesced
+        return stats
 
 class SSEQueueWithTopic:
-    def __init__(self):
+    def __init__(self, maxsize: int = 256, policy: str = DROP_OLDEST, block_timeout: float = 30):
         self.pubsub : dict[str, SSEQueue] = {}
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._lock = threading.Lock()
+        # counters of removed topics
+        self.retired = {"dropped": 0, "coalesced": 0, "stalled": 0}
 
-    def listen(self, topic: str):
+    def listen(self, topic: str) -> Subscription:
         logger.info(f"LISTENING TO: {topic}")
-        if topic not in self.pubsub:
-            raise ValueError(f"Channel {topic} not found")
-        return self.pubsub[topic].listen()
-
-    def publish(self, topic: str, message: str):
-        logger.debug(f"PUBLISHING TO: {topic} MESSAGE: {message}")
-        if topic not in self.pubsub:
-            raise ValueError(f"Topic {topic} not found")
-        self.pubsub[topic].announce(message=message)
-    
-    def add_topic(self, topic: str):
+        return self.get_topic(topic).listen()
+
+    def publish(self, topic: str, message: Event, block: bool = True) -> int:
+        logger.debug("PUBLISHING TO: %s MESSAGE: %s", topic, message)
+        return self.get_topic(topic).publish(message, block=block)
+
+    def add_topic(self, topic: str, maxsize: int = None, policy: str = None, merge: Callable[[Event, Event], Optional[Event]] = None):
+        '''
+        Creates the topic if needed, subscriptions use the given buffer size and overflow policy or the defaults
+        '''
         logger.info(f"SUBSCRIBING TO: {topic}")
-        if topic not in self.pubsub:
-            self.pubsub[topic] = SSEQueue()
-        return self.pubsub[topic]
-
-    def get_topic(self, topic: str):
-        logger.info(f"GETTING TOPIC: {topic}")
-        if topic not in self.pubsub:
-            raise ValueError(f"Topic {topic} not found")
-        return self.pubsub[topic]
-    
+        with self._lock:
+            if topic not in self.pubsub:
+                self.pubsub[topic] = SSEQueue(
+                    maxsize=maxsize or self.maxsize,
+                    policy=policy or self.policy,
+                    merge=merge,
+                    block_timeout=self.block_timeout
+                )
+            return self.pubsub[topic]
+
+    def get_topic(self, topic: str) -> SSEQueue:
+        logger.debug("GETTING TOPIC: %s", topic)
+        with self._lock:
+            if topic not in self.pubsub:
+                raise ValueError(f"Topic {topic} not found")
+            return self.pubsub[topic]
+
+    def has_topic(self, topic: str) -> bool:
+        with self._lock:
+            return topic in self.pubsub
+
     def remove_topic(self, topic: str):
         logger.info(f"REMOVING TOPIC: {topic}")
-        if topic not in self.pubsub:
-            raise ValueError(f"Topic {topic} not found")
-        del self.pubsub[topic]
\ No newline at end of file
+        with self._lock:
+            if topic not in self.pubsub:
+                raise ValueError(f"Topic {topic} not found")
+            sse_queue = self.pubsub.pop(topic)
+        sse_queue.close()
+
+        with self._lock:
+            for key in self.retired:
+                self.retired[key] += getattr(sse_queue, key)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            topics = list(self.pubsub.values())
+            stats = {"topics": len(topics), "subscribers": 0, "queueDepth": 0, "maxQueueDepth": 0, **self.retired}
+
+        for sse_queue in topics:
+            for key, value in sse_queue.get_stats().items():
+                stats[key] = max(stats[key], value) if key == "maxQueueDepth" else stats[key] + value
+        return stats
@@ -1,12 +1,17 @@
+import atexit
 import os
 import importlib.resources as pkg_resources
+import copy
 import json
 import logging
+import tempfile
+import threading
+import time
 
 from .event_emitter import EventEmitter, EVENTS
 from .entities import Model, Provider
 from dotenv import set_key, load_dotenv
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -21,11 +26,116 @@ if not config_dir:
 APP_DIR = os.path.join(config_dir, 'openplayground')
 os.makedirs(APP_DIR, exist_ok=True)
 
+class DebouncedWriter:
+    '''
+    Writes a file from a background thread, changes scheduled within window seconds of each other are coalesced into one write
+    The file is replaced atomically, readers never see a partially written file
+    '''
+    def __init__(self, path: str, render: Callable[[], str], window: float = 0.5, on_saved: Callable[[], None] = None):
+        self.path = path
+        self.render = render
+        self.window = window
+        self.on_saved = on_saved
+        self.pending = 0
+        self.deadline = None
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+
+        self.saves = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.last_save_ms = 0.0
+        self.max_save_ms = 0.0
+        self.total_save_ms = 0.0
+
+        self.thread = threading.Thread(target=self.__run__, name="storage-writer", daemon=True)
+        self.thread.start()
+        # the writer thread is a daemon, changes still waiting for their window are written on exit
+        atexit.register(self.flush)
+
+    def schedule(self):
+        '''
+        Requests a write, returns immediately
+        '''
+        with self.condition:
+            self.pending += 1
+            if self.deadline is None:
+                self.deadline = time.monotonic() + self.window
+            self.condition.notify()
+
+    def __run__(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                # the window starts at the first change, so a steady stream of changes still gets written
+                while self.pending and self.deadline - time.monotonic() > 0:
+                    self.condition.wait(self.deadline - time.monotonic())
+
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes pending changes right away
+        '''
+        with self.write_lock:
+            with self.condition:
+                events, self.pending, self.deadline = self.pending, 0, None
+            if not events:
+                return
+
+            start = time.perf_counter()
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(self.path)}.", suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(self.render())
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                logger.error(f'Failed to save {self.path}, retrying in {self.window}s: {e}')
+                self.failures += 1
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                # the changes are still unwritten, they are retried after another window along with newer ones
+                with self.condition:
+                    self.pending += events
+                    if self.deadline is None:
+                        self.deadline = time.monotonic() + self.window
+                    self.condition.notify()
+                return
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.saves += 1
+            self.coalesced += events - 1
+            self.last_save_ms = elapsed_ms
+            self.max_save_ms = max(self.max_save_ms, elapsed_ms)
+            self.total_save_ms += elapsed_ms
+            logger.info(f'Saved {self.path} ({events} changes, {elapsed_ms:.2f}ms)')
+
+        if self.on_saved is not None:
+            self.on_saved()
+
+    def get_stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "saves": self.saves,
+            "failures": self.failures,
+            "coalescedEvents": self.coalesced,
+            "lastSaveMs": round(self.last_save_ms, 3),
+            "maxSaveMs": round(self.max_save_ms, 3),
+            "avgSaveMs": round(self.total_save_ms / self.saves, 3) if self.saves else 0.0,
+        }
+
 class Storage:
-    def __init__(self, models_json_path: str = None, env_file_path: str = None):
+    def __init__(self, models_json_path: str = None, env_file_path: str = None, save_window: float = 0.5):
         self.event_emitter = EventEmitter()
         self.providers = []
         self.models = []
+        self.providers_by_name = {}
+        self.models_by_key = {}
+        self.models_by_name = {}
         self.models_json, self.models_json_path = self.__initialize_config__(models_json_path)
         self.env_file_path = env_file_path
 
@@ -42,7 +152,8 @@ class Storage:
                     capabilities=model.get("capabilities", []),
                     enabled=model.get("enabled", False),
                     status=model.get("status", "ready"),
-                    parameters=model.get("parameters", {})
+                    parameters=model.get("parameters", {}),
+                    load_mode=model.get("loadMode", None)
                 )
                 for model_name, model in provider['models'].items()
             ]
@@ -61,12 +172,25 @@ class Storage:
 
             self.models.extend(models)
 
+        for provider in self.providers:
+            self.providers_by_name[provider.name] = provider
+        for model in self.models:
+            self.__index_model__(model)
+
+        # serialized models.json entry per provider, only re-rendered when its version changes
+        self.fragments = {}
+        self.versions = {}
+        self._lock = threading.Lock()
+        self.writer = DebouncedWriter(
+            self.models_json_path, self.__render__, window=save_window,
+            on_saved=lambda: self.event_emitter.emit(EVENTS.SAVED_TO_DISK)
+        )
+
         for event in [
             EVENTS.MODEL_ADDED,
             EVENTS.MODEL_REMOVED,
             EVENTS.MODEL_STATUS_UPDATE,
             EVENTS.MODEL_UPDATED,
-            EVENTS.PROVIDER_API_KEY_UPDATE,
         ]:
             EventEmitter().on(event, self.__update___)
 
@@ -83,53 +207,64 @@ class Storage:
         if not os.path.exists(os.path.join(APP_DIR, 'models.json')):
             with open(os.path.join(APP_DIR, 'models.json'), 'w') as f:
                 f.write(original_models_json)
-        else:
-            original_models_json = json.loads(original_models_json)
 
-            with open(os.path.join(APP_DIR, 'models.json'), 'r') as f:
-                cached_models_json = json.load(f)
- 
-                cached_providers = cached_models_json.keys()
-                original_providers = original_models_json.keys()
+        with open(models_json_path, 'r') as f:
+            models_json = json.load(f)
+        self.__merge_original__(models_json, json.loads(original_models_json))
+        return models_json, models_json_path
 
-                provider_in_original_not_cache = [provider for provider in original_providers if provider not in cached_providers]
+    def __merge_original__(self, cached_models_json: dict, original_models_json: dict):
+        '''
+        Brings a models.json written by an older version up to date with the shipped one: providers and keys it lacks
+        are added, and parameters added to the defaults of a provider or to a shipped model are added to its models,
+        models added from the hub included, so requests using them pass validation
+        '''
+        cached_providers = cached_models_json.keys()
+        original_providers = original_models_json.keys()
 
-                for provider in provider_in_original_not_cache:
-                    cached_models_json[provider] = original_models_json[provider]
-                
-                cached_providers = cached_models_json.keys()
+        provider_in_original_not_cache = [provider for provider in original_providers if provider not in cached_providers]
 
-                for cached_provider in cached_providers:
-                    cached_provider_keys = cached_models_json[cached_provider].keys()
-                    original_provider_keys = original_models_json[cached_provider].keys()
+        for provider in provider_in_original_not_cache:
+            cached_models_json[provider] = original_models_json[provider]
 
-                    #keys in cache but not in original
-                    cache_keys_missing = [key for key in cached_provider_keys if key not in original_provider_keys]
-                    #keys in original but not in cache
-                    missing_original_keys = [key for key in original_provider_keys if key not in cached_provider_keys]
+        for cached_provider in cached_models_json.keys():
+            if cached_provider not in original_models_json:
+                continue
+            cached_provider_keys = cached_models_json[cached_provider].keys()
+            original_provider_keys = original_models_json[cached_provider].keys()
 
-                    for missing_cached_key in cache_keys_missing:
-                        del cached_models_json[cached_provider][missing_cached_key]
+            #keys in cache but not in original
+            cache_keys_missing = [key for key in cached_provider_keys if key not in original_provider_keys]
+            #keys in original but not in cache
+            missing_original_keys = [key for key in original_provider_keys if key not in cached_provider_keys]
 
-                    for missing_original_key in missing_original_keys:
-                        cached_models_json[cached_provider][missing_original_key] = original_models_json[cached_provider][missing_original_key]
+            for missing_cached_key in cache_keys_missing:
+                del cached_models_json[cached_provider][missing_cached_key]
 
-                    cached_provider_models = cached_models_json[cached_provider]['models'].keys()
-                    original_provider_models = original_models_json[cached_provider]['models'].keys()
+            for missing_original_key in missing_original_keys:
+                cached_models_json[cached_provider][missing_original_key] = original_models_json[cached_provider][missing_original_key]
 
-                    for cached_model in cached_provider_models:
-                        if cached_model not in original_provider_models:
-                            continue
+            default_parameters = cached_models_json[cached_provider].get('defaultParameters')
+            original_default_parameters = original_models_json[cached_provider].get('defaultParameters')
+            if default_parameters is not None and original_default_parameters is not None:
+                for parameter, value in original_default_parameters.items():
+                    default_parameters.setdefault(parameter, copy.deepcopy(value))
 
-                        cached_model_keys = cached_models_json[cached_provider]['models'][cached_model].keys()
-                        original_model_keys = original_models_json[cached_provider]['models'][cached_model].keys()
+            original_provider_models = original_models_json[cached_provider]['models']
 
-                        for original_model_key in original_model_keys:
-                            if original_model_key not in cached_model_keys:
-                                cached_models_json[cached_provider]['models'][cached_model][original_model_key] = original_models_json[cached_provider]['models'][cached_model][original_model_key]
+            for cached_model, cached_model_json in cached_models_json[cached_provider]['models'].items():
+                if cached_model in original_provider_models:
+                    original_model_json = original_provider_models[cached_model]
+                    for original_model_key in original_model_json.keys():
+                        if original_model_key not in cached_model_json:
+                            cached_model_json[original_model_key] = copy.deepcopy(original_model_json[original_model_key])
+                    missing_parameters = original_model_json.get('parameters', {})
+                else:
+                    # added from the hub, its parameters started out as the defaults of the provider
+                    missing_parameters = original_default_parameters or {}
 
-        with open(models_json_path, 'r') as f:
-            return json.load(f), models_json_path
+                for parameter, value in missing_parameters.items():
+                    cached_model_json.setdefault('parameters', {}).setdefault(parameter, copy.deepcopy(value))
 
     def get_models(self) -> List[Model]:
         return self.models
@@ -150,7 +285,10 @@ class Storage:
         return models_by_provider
     
     def get_model(self, model_name: str) -> Model:
-        return next((model for model in self.models if model.name == model_name), None)
+        return self.models_by_name.get(model_name)
+
+    def get_provider_model(self, provider_name: str, model_name: str) -> Model:
+        return self.models_by_key.get((provider_name, model_name))
     
     def get_providers(self) -> List[Provider]:
         return self.providers
@@ -159,14 +297,7 @@ class Storage:
         return [provider.name for provider in self.providers]
     
     def get_provider(self, provider_name: str) -> Provider:
-        return next(
-            (
-                provider
-                for provider in self.providers
-                if provider.name == provider_name
-            ),
-            None,
-        )
+        return self.providers_by_name.get(provider_name)
     
     def update_provider_api_key(self, provider_name: str, api_key: str):
         provider = self.get_provider(provider_name)
@@ -180,60 +311,122 @@ class Storage:
         set_key(self.env_file_path, f'{provider_name.upper()}_API_KEY', api_key)
         load_dotenv(self.env_file_path)
 
+        # API keys live in the env file, models.json is not rewritten for them
         self.event_emitter.emit(EVENTS.PROVIDER_API_KEY_UPDATE, provider_name)
     
+    def __index_model__(self, model: Model):
+        self.models_by_key[(model.provider, model.name)] = model
+        self.models_by_name.setdefault(model.name, model)
+
+    def __unindex_model__(self, model: Model):
+        if self.models_by_key.get((model.provider, model.name)) is model:
+            del self.models_by_key[(model.provider, model.name)]
+
+        if self.models_by_name.get(model.name) is model:
+            del self.models_by_name[model.name]
+            # another provider may serve a model with the same name
+            replacement = next((m for m in self.models if m.name == model.name), None)
+            if replacement is not None:
+                self.models_by_name[model.name] = replacement
+
+    def __replace_model__(self, model: Model):
+        current = self.models_by_key.get((model.provider, model.name))
+        if current is None or current is model:
+            return
+
+        self.models[self.models.index(current)] = model
+        self.models_by_key[(model.provider, model.name)] = model
+        if self.models_by_name.get(model.name) is current:
+            self.models_by_name[model.name] = model
+    
     def __update___(self, event: str, *args, **kwargs):
         if event == EVENTS.MODEL_ADDED:
             model = args[0]
             self.models.append(model)
+            self.__index_model__(model)
         elif event == EVENTS.MODEL_REMOVED:
             model = args[0]
             self.models.remove(model)
+            self.__unindex_model__(model)
+        elif event == EVENTS.MODEL_UPDATED:
+            self.__replace_model__(args[0])
+
+        if args and isinstance(args[0], Model):
+            self.__mark_dirty__(args[0].provider)
+        else:
+            self.__mark_dirty__()
        
         self.__save__()
 
     def update_model(self, model_name: str, model: Model):
-        for i, m in enumerate(self.models):
-            if m.name == model_name:
-                self.models[i] = model
-                break
+        provider = self.get_provider(model.provider)
+        if provider is not None:
+            provider.replace_model(model_name, model)
 
-        for provider in self.providers:
-            if provider.name == model.provider:
-                for i, m in enumerate(provider.models):
-                    if m.name == model_name:
-                        provider.models[i] = model
-                        break              
-                break
+        self.__replace_model__(model)
         self.event_emitter.emit(EVENTS.MODEL_UPDATED, model)
 
+    def __mark_dirty__(self, provider_name: str = None):
+        with self._lock:
+            for name in [provider_name] if provider_name is not None else list(self.providers_by_name):
+                self.versions[name] = self.versions.get(name, 0) + 1
+
     def __save__(self):
         '''
-        Saves the models.json file
+        Schedules a save of the models.json file, the write happens on the storage writer thread
+        '''
+        self.writer.schedule()
+
+    def flush(self):
+        '''
+        Writes pending changes to models.json right away
+        '''
+        self.writer.flush()
+
+    def __render_provider__(self, provider: Provider) -> str:
         '''
-        logger.info('Saving models.json')
-        new_json = {
-            provider.name: {
+        Serializes a copy of the provider, request threads may change its models while the writer thread renders it
+        '''
+        with self._lock:
+            provider_json = copy.deepcopy({
                 'models': {
                     model.name: {
                         'capabilities': model.capabilities,
                         'enabled': model.enabled,
                         'status': model.status,
                         'parameters': model.parameters,
+                        **({'loadMode': model.load_mode} if model.load_mode is not None else {}),
                     }
-                    for model in provider.models
+                    for model in list(provider.models)
                 },
                 'requiresAPIKey': provider.requires_api_key,
                 'remoteInference': provider.remote_inference,
                 'defaultParameters': provider.default_parameters,
                 'searchURL': provider.search_url,
-            }
-            for provider in self.providers
-        }
-        with open(self.models_json_path, 'w') as f:
-            json.dump(new_json, f, indent=4)
+            })
+        # nest the entry one level deeper, the result matches json.dump(..., indent=4) of the whole file
+        return json.dumps(provider_json, indent=4).replace('\n', '\n    ')
+
+    def __render__(self) -> str:
+        '''
+        Renders models.json, reusing the entries of providers that did not change since the last save
+        '''
+        entries = []
+        for provider in self.providers:
+            with self._lock:
+                version = self.versions.get(provider.name, 0)
+
+            cached = self.fragments.get(provider.name)
+            if cached is None or cached[0] != version:
+                cached = self.fragments[provider.name] = (version, self.__render_provider__(provider))
+            entries.append(f'    {json.dumps(provider.name)}: {cached[1]}')
+
+        if not entries:
+            return '{}'
+        return '{\n' + ',\n'.join(entries) + '\n}'
 
-        self.event_emitter.emit(EVENTS.SAVED_TO_DISK)
+    def get_stats(self) -> dict:
+        return self.writer.get_stats()
 
     def import_config(config_path: str):
         '''
@@ -0,0 +1,41 @@
+import pytest
+
+from server.lib.inference import InferenceManager, InferenceRequest, ProviderDetails
+from server.lib.inference.completion_cache import DETERMINISTIC, CompletionCache
+from server.lib.inference.providers import GeneratedToken
+from server.lib.inference.providers.local import LocalBackend
+
+class FakeSSEManager:
+    def publish(self, topic, message, block=True):
+        return 1
+
+class FakeBackend(LocalBackend):
+    '''
+    Decides determinism like the local backend, counts the completions it generates
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+
+    def generate(self, provider_details, inference_request, cancellation):
+        self.calls += 1
+        yield GeneratedToken("Hello")
+
+@pytest.mark.parametrize("parameters, greedy", [
+    ({"temperature": 1, "topK": 1}, True),
+    ({"temperature": 0.1, "topK": 40}, False),
+])
+def test_deterministic_mode_only_caches_greedy_requests(parameters, greedy):
+    manager = InferenceManager(FakeSSEManager(), completion_cache=CompletionCache(mode=DETERMINISTIC))
+    manager.get_providers().register("fake", FakeBackend)
+    backend = manager.get_providers().get("fake")
+
+    for i in range(2):
+        request = InferenceRequest(
+            uuid=f"request-{i}", model_name="model", model_tag="model", model_provider="fake",
+            model_parameters={"maximumLength": 1, "topP": 1, "repetitionPenalty": 1, **parameters}, prompt="Hi",
+        )
+        manager.get_announcer().register(request.uuid)
+        manager.text_generation(ProviderDetails(api_key="key", version_key=None), request)
+
+    assert backend.calls == (1 if greedy else 2)
@@ -0,0 +1,150 @@
+import random
+import time
+
+import pytest
+
+from tokenizers import Tokenizer, decoders, models, normalizers, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+from server.lib.inference.huggingface.detokenizer import IncrementalDetokenizer
+
+CORPUS = [
+    "Hello world, this is a test of the tokenizer.",
+    "Ünïcödé text — with emojis 😀🎉 and 漢字かな交じり文",
+    "def f(x):\n    return x * 2\n",
+    "  leading spaces and\ttabs\n\nnewlines",
+] * 50
+
+TEXTS = [
+    "The quick brown fox jumps over the lazy dog. ",
+    "Ünïcödé 😀🎉 漢字かな交じり文 ",
+    "def f(x):\n    return x * 2\n",
+    " spaced  out\ttext\n",
+]
+
+PROMPTS = ["", "Hello there", "漢字"]
+
+def byte_level_bpe() -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(CORPUS, trainers.BpeTrainer(
+        vocab_size=400, special_tokens=["<|endoftext|>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>")
+
+def bpe() -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.BPE(unk_token="[UNK]", end_of_word_suffix="</w>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.decoder = decoders.BPEDecoder(suffix="</w>")
+    tokenizer.train_from_iterator(CORPUS, trainers.BpeTrainer(
+        vocab_size=300, special_tokens=["[UNK]"], end_of_word_suffix="</w>"
+    ))
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="[UNK]")
+
+def sentencepiece_bpe() -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.BPE(byte_fallback=True, unk_token="<unk>"))
+    tokenizer.normalizer = normalizers.Sequence([normalizers.Prepend("▁"), normalizers.Replace(" ", "▁")])
+    tokenizer.decoder = decoders.Sequence([
+        decoders.Replace("▁", " "), decoders.ByteFallback(), decoders.Fuse(), decoders.Strip(" ", 1, 0)
+    ])
+    special_tokens = ["<unk>", "<s>", "</s>"] + [f"<0x{byte:02X}>" for byte in range(256)]
+    # emojis and kanji are left out of the vocabulary, they only come out of byte fallback pieces
+    tokenizer.train_from_iterator(
+        [text for text in CORPUS if "😀" not in text], trainers.BpeTrainer(vocab_size=300, special_tokens=special_tokens)
+    )
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>")
+
+def sentencepiece_unigram() -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.Unigram())
+    tokenizer.pre_tokenizer = pre_tokenizers.Metaspace()
+    tokenizer.decoder = decoders.Metaspace()
+    tokenizer.train_from_iterator(CORPUS, trainers.UnigramTrainer(
+        vocab_size=200, special_tokens=["<unk>"], unk_token="<unk>"
+    ))
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>")
+
+TOKENIZERS = {
+    "byte_level_bpe": byte_level_bpe,
+    "bpe": bpe,
+    "sentencepiece_bpe": sentencepiece_bpe,
+    "sentencepiece_unigram": sentencepiece_unigram,
+}
+
+@pytest.fixture(scope="module", params=list(TOKENIZERS))
+def tokenizer(request):
+    return TOKENIZERS[request.param]()
+
+def encode(tokenizer, text):
+    return tokenizer(text, add_special_tokens=False)["input_ids"]
+
+def decode(tokenizer, ids):
+    return tokenizer.decode(ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+def stream(tokenizer, prompt_ids, generated_ids):
+    detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids)
+    chunks = [detokenizer.add(token_id) for token_id in generated_ids]
+    chunks.append(detokenizer.flush())
+    return chunks
+
+def expected(tokenizer, prompt_ids, generated_ids):
+    prompt = decode(tokenizer, prompt_ids)
+    full = decode(tokenizer, prompt_ids + generated_ids)
+    assert full.startswith(prompt)
+    return full[len(prompt):]
+
+@pytest.mark.parametrize("prompt", PROMPTS)
+def test_streamed_text_matches_decode(tokenizer, prompt):
+    generator = random.Random(0)
+    prompt_ids = encode(tokenizer, prompt)
+    for _ in range(10):
+        generated_ids = encode(tokenizer, prompt + "".join(generator.choice(TEXTS) for _ in range(5)))[len(prompt_ids):]
+        assert "".join(stream(tokenizer, prompt_ids, generated_ids)) == expected(tokenizer, prompt_ids, generated_ids)
+
+@pytest.mark.parametrize("prompt", PROMPTS)
+def test_random_ids_match_decode(tokenizer, prompt):
+    # arbitrary ids split characters anywhere and leave incomplete UTF-8 sequences behind
+    generator = random.Random(1)
+    prompt_ids = encode(tokenizer, prompt)
+    for _ in range(20):
+        generated_ids = [generator.randrange(len(tokenizer)) for _ in range(30)]
+        assert "".join(stream(tokenizer, prompt_ids, generated_ids)) == expected(tokenizer, prompt_ids, generated_ids)
+
+@pytest.mark.parametrize("text", ["😀🎉", " 漢字かな", "Ünïcödé"])
+def test_multibyte_characters_are_never_split(tokenizer, text):
+    prompt_ids = encode(tokenizer, "Hello")
+    generated_ids = encode(tokenizer, "Hello" + text)[len(prompt_ids):]
+    chunks = stream(tokenizer, prompt_ids, generated_ids)
+    assert "".join(chunks) == expected(tokenizer, prompt_ids, generated_ids)
+    assert not any("�" in chunk for chunk in chunks)
+
+def test_emoji_is_split_across_byte_tokens():
+    # the cases above only test something if characters really span several tokens
+    for tokenizer in (byte_level_bpe(), sentencepiece_bpe()):
+        assert len(encode(tokenizer, "😀")) > 1
+
+@pytest.mark.parametrize("factory", [sentencepiece_bpe, sentencepiece_unigram])
+def test_sentencepiece_leading_space(factory):
+    tokenizer = factory()
+    prompt_ids = encode(tokenizer, "Hello")
+    generated_ids = encode(tokenizer, "Hello world")[len(prompt_ids):]
+    # the piece starting the word decodes without its space on its own
+    assert not decode(tokenizer, generated_ids[:1]).startswith(" ")
+    text = "".join(stream(tokenizer, prompt_ids, generated_ids))
+    assert text == expected(tokenizer, prompt_ids, generated_ids)
+    assert text.startswith(" w")
+
+def test_faster_than_decoding_everything(tokenizer):
+    token_ids = encode(tokenizer, "".join(TEXTS) * 20)[:600]
+    # the first decode of a tokenizer pays a one-time setup cost
+    stream(tokenizer, [], token_ids[:10])
+
+    start = time.perf_counter()
+    stream(tokenizer, [], token_ids)
+    incremental = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for end in range(1, len(token_ids) + 1):
+        decode(tokenizer, token_ids[:end])
+    full = time.perf_counter() - start
+
+    assert incremental * 3 < full
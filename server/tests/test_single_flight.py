@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+from server.lib.inference import InferenceManager, InferenceRequest, ProviderDetails
+from server.lib.inference.providers import GeneratedToken
+from server.lib.inference.providers.local import LocalBackend
+from server.lib.inference.single_flight import SingleFlight
+
+REQUESTS = 3
+
+class FakeSSEManager:
+    def __init__(self):
+        self.messages = {}
+        self._lock = threading.Lock()
+
+    def publish(self, topic, message, block=True):
+        with self._lock:
+            self.messages.setdefault(topic, []).append(message)
+        return 1
+
+class FakeBackend(LocalBackend):
+    '''
+    Decides determinism like the local backend, generates a fixed completion once released
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+        self.released = threading.Event()
+        self._lock = threading.Lock()
+
+    def generate(self, provider_details, inference_request, cancellation):
+        with self._lock:
+            self.calls += 1
+        self.released.wait(10)
+        for token in ["Hello", " world"]:
+            yield GeneratedToken(token)
+
+def wait_for(condition):
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+@pytest.mark.parametrize("parameters, greedy", [
+    ({"temperature": 1, "topK": 1}, True),
+    ({"temperature": 0, "topK": 40}, True),
+    ({"temperature": 0.7, "topK": 1, "numBeams": 4}, True),
+    ({"temperature": 0.1, "topK": 40}, False),
+])
+def test_only_greedy_requests_share_a_generation(parameters, greedy):
+    sse_manager = FakeSSEManager()
+    single_flight = SingleFlight()
+    manager = InferenceManager(sse_manager, single_flight=single_flight)
+    manager.get_providers().register("fake", FakeBackend)
+    backend = manager.get_providers().get("fake")
+
+    threads = []
+    for i in range(REQUESTS):
+        request = InferenceRequest(
+            uuid=f"request-{i}", model_name="model", model_tag="model", model_provider="fake",
+            model_parameters={"maximumLength": 2, "topP": 1, "repetitionPenalty": 1, **parameters}, prompt="Hi",
+        )
+        manager.get_announcer().register(request.uuid)
+        thread = threading.Thread(target=manager.text_generation, args=(ProviderDetails(api_key="key", version_key=None), request))
+        thread.start()
+        threads.append(thread)
+
+    # every request is either waiting on the generation it joined or has started its own
+    wait_for(lambda: backend.calls + single_flight.duplicates == REQUESTS)
+    backend.released.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert backend.calls == (1 if greedy else REQUESTS)
+    for i in range(REQUESTS):
+        tokens = [message.data["message"] for message in sse_manager.messages[f"request-{i}"] if message.type == "infer"]
+        assert "".join(tokens) == "Hello world"